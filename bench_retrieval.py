@@ -0,0 +1,497 @@
+"""知識ベース検索（search_knowledge）の速度と検索品質を測るベンチマーク
+
+使用方法:
+    python bench_retrieval.py --sizes 1000,10000 --languages ja,en --json results.json
+    python bench_retrieval.py --sizes 100000 --backends sqlite --compare results.json
+
+日本語・英語の合成の知識ベース（1エントリは split_text のチャンクと同じ約1000文字）を作り、
+検索の方式ごとに構築時間、メモリ使用量、クエリのレイテンシー、正解付きのクエリに対する
+recall@5 と MRR（上位5件まで）を測る。合成データは --seed から決定的に作るので、
+同じ引数で実行すれば別のコミットでも同じ知識ベースとクエリで比較できる。
+
+正解は「<名前>の<項目>は<値>です」という事実の文で、1〜3件のエントリに埋め込む。
+同じ名前の別の項目の文や、同じ項目の別の名前の文も他のエントリに埋め込むので、
+名前と項目の両方を考慮しない検索では正解が上位に来ない。
+
+検索の方式:
+    scan      変更前の search_knowledge と同じ全件走査（--scan-max-size より大きい場合は省略）
+    json      JSONストレージ（メモリ上の転置インデックス）の legacy / bm25
+    sqlite    SQLiteストレージ（一括取り込みと同じく最後にインデックスを作成）の legacy / bm25
+    semantic  SQLite とベクトル索引（HashingEmbedder）による semantic / hybrid
+
+メモリを正しく測るため、方式ごとに別のプロセスで構築と検索を行う。
+--compare で以前の結果のJSONと比較し、recall@5 か MRR が --max-quality-drop より下がった場合は
+終了コード 1 で終了する。
+"""
+import argparse
+import datetime
+import gc
+import heapq
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BACKENDS = {
+    "scan": ("legacy",),
+    "json": ("legacy", "bm25"),
+    "sqlite": ("legacy", "bm25"),
+    "semantic": ("semantic", "hybrid"),
+}
+
+# 事実の文に使う項目
+ATTRIBUTES = {
+    "ja": ["価格", "住所", "創業者", "発売日", "定員", "担当者", "締め切り", "営業時間", "電話番号", "重さ"],
+    "en": ["price", "address", "founder", "release date", "capacity", "manager", "deadline",
+           "opening hours", "phone number", "weight"],
+}
+
+PARTICLES = ["は", "が", "を", "に", "で", "と", "の", "から", "まで", "より"]
+ENDINGS = ["する。", "した。", "です。", "だった。", "している。", "できる。", "ではない。", "になる。"]
+EN_SYLLABLES = ["ka", "ro", "ten", "mi", "sa", "lor", "ve", "dan", "bri", "co", "nel", "ta", "pu", "gor",
+                "shi", "an", "el", "mon", "ti", "ra", "qu", "fen", "do", "ly", "sur", "wen", "ex", "ha"]
+# 常用漢字のあたりの範囲から語を作る
+KANJI = [chr(code) for code in range(0x4E00, 0x4E00 + 2000, 3)]
+KATAKANA = [chr(code) for code in range(0x30A2, 0x30F3) if chr(code) not in "ッャュョヮヰヱ"]
+
+
+def _zipf_cum_weights(size, exponent=1.0):
+    total = 0.0
+    cum_weights = []
+    for rank in range(1, size + 1):
+        total += 1.0 / rank ** exponent
+        cum_weights.append(total)
+    return cum_weights
+
+
+class SyntheticCorpus:
+    """決定的な合成の知識ベースと正解付きのクエリ
+
+    語彙はジップ分布で選び、クエリごとに事実の文（正解）と紛らわしい文を
+    無作為に選んだエントリに埋め込む。同じ引数からは常に同じデータを作る。
+
+    Args:
+        language (str): "ja" または "en"
+        size (int): エントリ数
+        queries (int): クエリ数
+        seed (int): 乱数の種
+        chunk_size (int): 1エントリの最大文字数（split_text のデフォルトと同じ）
+    """
+
+    def __init__(self, language, size, queries=200, seed=0, chunk_size=1000, vocab_size=20000):
+        if language not in ATTRIBUTES:
+            raise ValueError(f"Unknown language: {language}")
+        self.language = language
+        self.size = size
+        self.chunk_size = chunk_size
+        self.seed = seed
+        rng = random.Random(f"{seed}:{language}:{size}")
+        self.vocab = self._make_vocab(rng, vocab_size)
+        self.cum_weights = _zipf_cum_weights(len(self.vocab))
+        self.queries = []  # {"query": str, "relevant": [知識ID]}
+        self.plants = {}  # エントリの番号 -> 埋め込む文のリスト
+        self._plan_queries(rng, queries)
+
+    @staticmethod
+    def knowledge_id(index):
+        return f"doc-{index:07d}"
+
+    def _make_word(self, rng):
+        if self.language == "ja":
+            if rng.random() < 0.15:
+                return "".join(rng.choice(KATAKANA) for _ in range(rng.randint(3, 5)))
+            return "".join(rng.choice(KANJI) for _ in range(rng.randint(2, 3)))
+        return "".join(rng.choice(EN_SYLLABLES) for _ in range(rng.randint(1, 3)))
+
+    def _make_vocab(self, rng, vocab_size):
+        vocab = set()
+        while len(vocab) < vocab_size:
+            vocab.add(self._make_word(rng))
+        return sorted(vocab)
+
+    def _make_name(self, rng, used):
+        # 背景の語彙と重ならない固有名詞
+        while True:
+            if self.language == "ja":
+                name = "".join(rng.choice(KATAKANA) for _ in range(rng.randint(4, 6)))
+            else:
+                name = "".join(rng.choice(EN_SYLLABLES) for _ in range(rng.randint(3, 4))).capitalize()
+            if name not in used and name.lower() not in self.vocab:
+                used.add(name)
+                return name
+
+    def _fact(self, name, attribute, value):
+        if self.language == "ja":
+            return f"{name}の{attribute}は{value}です。"
+        return f"The {attribute} of {name} is {value}."
+
+    def _question(self, rng, name, attribute):
+        if self.language == "ja":
+            template = rng.choice(["{name}の{attribute}は何ですか", "{name}の{attribute}を教えて", "{name} {attribute}"])
+        else:
+            template = rng.choice(["What is the {attribute} of {name}?", "Tell me the {attribute} of {name}",
+                                   "{name} {attribute}"])
+        return template.format(name=name, attribute=attribute)
+
+    def _plan_queries(self, rng, count):
+        attributes = ATTRIBUTES[self.language]
+        used_names = set()
+        count = min(count, max(1, self.size // 4))
+        for _ in range(count):
+            name = self._make_name(rng, used_names)
+            attribute, other_attribute = rng.sample(attributes, 2)
+            relevant_count = rng.randint(1, 3)
+            documents = rng.sample(range(self.size), min(self.size, relevant_count + 3))
+            relevant, distractors = documents[:relevant_count], documents[relevant_count:]
+            value = str(rng.randint(100, 99999))
+            for index in relevant:
+                self.plants.setdefault(index, []).append(self._fact(name, attribute, value))
+            # 同じ名前の別の項目（2件）と、別の名前の同じ項目（1件）
+            for position, index in enumerate(distractors):
+                if position < 2:
+                    fact = self._fact(name, other_attribute, str(rng.randint(100, 99999)))
+                else:
+                    fact = self._fact(self._make_name(rng, used_names), attribute, value)
+                self.plants.setdefault(index, []).append(fact)
+            self.queries.append({
+                "query": self._question(rng, name, attribute),
+                "relevant": [self.knowledge_id(index) for index in relevant],
+            })
+
+    def _sentence(self, rng):
+        words = rng.choices(self.vocab, cum_weights=self.cum_weights, k=rng.randint(4, 12))
+        if self.language == "ja":
+            parts = []
+            for word in words[:-1]:
+                parts.append(word)
+                parts.append(rng.choice(PARTICLES))
+            parts.append(words[-1])
+            parts.append(rng.choice(ENDINGS))
+            return "".join(parts)
+        return " ".join(words).capitalize() + "."
+
+    def documents(self):
+        """(knowledge_id, entry) を順に返す"""
+        rng = random.Random(f"{self.seed}:{self.language}:{self.size}:documents")
+        separator = "" if self.language == "ja" else " "
+        timestamp = datetime.datetime(2024, 1, 1).isoformat()
+        for index in range(self.size):
+            sentences = []
+            length = 0
+            planted = self.plants.get(index, [])
+            budget = self.chunk_size - sum(len(s) + 1 for s in planted)
+            while True:
+                sentence = self._sentence(rng)
+                if length + len(sentence) + 1 > budget:
+                    break
+                sentences.append(sentence)
+                length += len(sentence) + 1
+            for sentence in planted:
+                sentences.insert(rng.randint(0, len(sentences)), sentence)
+            content = separator.join(sentences)
+            yield self.knowledge_id(index), {"content": content, "added_by": "bench", "timestamp": timestamp}
+
+
+# ---- 計測 ----
+
+def rss_bytes():
+    """現在の常駐メモリ（Linux 以外では最大値で代用する）"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def score_results(ranked_ids, relevant, k=5):
+    """(recall@k, 逆順位) を返す（上位 k 件に正解が無い場合の逆順位は 0）"""
+    top = ranked_ids[:k]
+    relevant = set(relevant)
+    recall = len(relevant.intersection(top)) / len(relevant) if relevant else 0.0
+    reciprocal_rank = next((1.0 / rank for rank, knowledge_id in enumerate(top, 1) if knowledge_id in relevant), 0.0)
+    return recall, reciprocal_rank
+
+
+# ---- 検索の方式 ----
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _scan_search(entries, query, limit=5):
+    """変更前の search_knowledge と同じく全てのエントリを採点する"""
+    from search_index import legacy_score
+
+    scored = []
+    for knowledge_id, entry in entries.items():
+        score = legacy_score(query, entry["content"])
+        if score > 0:
+            scored.append((score, knowledge_id))
+    return [knowledge_id for _, knowledge_id in heapq.nlargest(limit, scored)]
+
+
+def build_backend(backend, corpus, workdir, batch_size=1000):
+    """方式ごとに知識ベースを構築し、(検索関数の辞書, 構築時間の辞書) を返す
+
+    検索関数はクエリを受け取り、知識IDのリストを返す。
+    """
+    timings = {}
+    started = time.perf_counter()
+    if backend == "scan":
+        entries = dict(corpus.documents())
+        timings["load"] = time.perf_counter() - started
+        return {"legacy": lambda query: _scan_search(entries, query)}, timings
+
+    if backend == "json":
+        from knowledge_store import JSONKnowledgeStore
+
+        store = JSONKnowledgeStore(os.path.join(workdir, "knowledge_base.json"))
+        # ボットと同じく、追加のたびにメモリ上のインデックスを更新してファイルに保存する
+        store.add_many(list(corpus.documents()))
+        timings["index"] = time.perf_counter() - started
+    else:
+        from knowledge_store import SQLiteKnowledgeStore
+
+        store = SQLiteKnowledgeStore(os.path.join(workdir, "knowledge_base.db"))
+        for batch in _batches(corpus.documents(), batch_size * 5):
+            store.add_many(batch, update_index=False)
+        timings["load"] = time.perf_counter() - started
+        started = time.perf_counter()
+        store.rebuild_index()
+        timings["index"] = time.perf_counter() - started
+
+    if backend != "semantic":
+        return {
+            ranker: (lambda query, ranker=ranker: [kid for kid, _ in store.search(query, limit=5, ranker=ranker)])
+            for ranker in BACKENDS[backend]
+        }, timings
+
+    from vector_index import HashingEmbedder, VectorIndex, fuse_results
+
+    started = time.perf_counter()
+    embedder = HashingEmbedder()
+    vector_index = VectorIndex(os.path.join(workdir, "knowledge_vectors.f32"), embedder.dim, embedder.name)
+    for batch in _batches(store.iter_entries(), embedder.batch_size):
+        vectors = embedder.embed_documents([entry["content"] for _, entry in batch])
+        vector_index.add([knowledge_id for knowledge_id, _ in batch], vectors)
+    timings["vectors"] = time.perf_counter() - started
+
+    # bot.py の search_knowledge と同じ件数と統合方法
+    semantic_weight = float(os.getenv("SEMANTIC_WEIGHT", "0.5"))
+
+    def semantic(query):
+        results = vector_index.search(embedder.embed_query(query), k=20)
+        return [knowledge_id for knowledge_id, similarity in results if similarity > 0][:5]
+
+    def hybrid(query):
+        semantic_results = vector_index.search(embedder.embed_query(query), k=20)
+        keyword_results = [
+            (knowledge_id, score) for knowledge_id, _, score in store.search_with_scores(query, limit=20, ranker="bm25")
+        ]
+        return [knowledge_id for knowledge_id, _ in fuse_results(keyword_results, semantic_results, semantic_weight, 5)]
+
+    return {"semantic": semantic, "hybrid": hybrid}, timings
+
+
+def run_backend(backend, language, size, queries, seed, chunk_size, warmup):
+    """1つの方式を構築して全てのクエリを実行する（別のプロセスで呼び出す）"""
+    sys.path.insert(0, REPO_DIR)
+    corpus = SyntheticCorpus(language, size, queries=queries, seed=seed, chunk_size=chunk_size)
+    gc.collect()
+    rss_before = rss_bytes()
+    with tempfile.TemporaryDirectory(prefix="bench_retrieval_") as workdir:
+        searches, timings = build_backend(backend, corpus, workdir)
+        gc.collect()
+        rss_after = rss_bytes()
+        disk = directory_size(workdir)
+
+        results = []
+        for ranker, search in searches.items():
+            for item in corpus.queries[:warmup]:
+                search(item["query"])
+            latencies = []
+            recalls = []
+            reciprocal_ranks = []
+            for item in corpus.queries:
+                started = time.perf_counter()
+                ranked = search(item["query"])
+                latencies.append(time.perf_counter() - started)
+                recall, reciprocal_rank = score_results(ranked, item["relevant"])
+                recalls.append(recall)
+                reciprocal_ranks.append(reciprocal_rank)
+            total = sum(latencies)
+            results.append({
+                "language": language,
+                "size": size,
+                "backend": f"{backend}/{ranker}",
+                "queries": len(latencies),
+                "build_seconds": round(sum(timings.values()), 4),
+                "build_breakdown": {name: round(value, 4) for name, value in timings.items()},
+                "memory_bytes": max(0, rss_after - rss_before),
+                "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                "disk_bytes": disk,
+                "latency_ms": {
+                    "mean": round(total / len(latencies) * 1000, 3),
+                    "p50": round(percentile(latencies, 0.5) * 1000, 3),
+                    "p95": round(percentile(latencies, 0.95) * 1000, 3),
+                    "p99": round(percentile(latencies, 0.99) * 1000, 3),
+                    "max": round(max(latencies) * 1000, 3),
+                },
+                "qps": round(len(latencies) / total, 2) if total > 0 else None,
+                "recall_at_5": round(sum(recalls) / len(recalls), 4),
+                "mrr": round(sum(reciprocal_ranks) / len(reciprocal_ranks), 4),
+            })
+    return results
+
+
+# ---- 結果 ----
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result):
+    latency = result["latency_ms"]
+    print(
+        f"{result['language']:>2} {result['size']:>8} {result['backend']:<16} "
+        f"build {result['build_seconds']:8.2f}s  mem {result['memory_bytes'] / 1e6:8.1f} MB  "
+        f"disk {result['disk_bytes'] / 1e6:8.1f} MB  p50 {latency['p50']:8.2f} ms  p99 {latency['p99']:8.2f} ms  "
+        f"recall@5 {result['recall_at_5']:.3f}  MRR {result['mrr']:.3f}"
+    )
+
+
+def compare_results(results, baseline, current_args, max_quality_drop):
+    """以前の結果と比較して差を表示し、品質が下がった組み合わせの数を返す"""
+    previous = {(r["language"], r["size"], r["backend"]): r for r in baseline["results"]}
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}:")
+    for name in ("seed", "queries", "chunk_size"):
+        if name in baseline.get("args", {}) and baseline["args"][name] != current_args[name]:
+            # 合成データが変わるため、レイテンシーも品質もそのままでは比較できない
+            print(f"Warning: --{name.replace('_', '-')} differs from the baseline ({baseline['args'][name]})")
+    regressions = 0
+    for result in results:
+        old = previous.get((result["language"], result["size"], result["backend"]))
+        if old is None:
+            continue
+        ratio = result["latency_ms"]["p50"] / old["latency_ms"]["p50"] if old["latency_ms"]["p50"] else float("inf")
+        recall_delta = result["recall_at_5"] - old["recall_at_5"]
+        mrr_delta = result["mrr"] - old["mrr"]
+        regressed = recall_delta < -max_quality_drop or mrr_delta < -max_quality_drop
+        regressions += regressed
+        print(
+            f"{result['language']:>2} {result['size']:>8} {result['backend']:<16} "
+            f"p50 x{ratio:6.2f}  build x{result['build_seconds'] / max(old['build_seconds'], 1e-9):6.2f}  "
+            f"recall@5 {recall_delta:+.3f}  MRR {mrr_delta:+.3f}{'  REGRESSION' if regressed else ''}"
+        )
+    return regressions
+
+
+def parse_list(value, cast=str):
+    return [cast(item.strip()) for item in value.split(",") if item.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="知識ベース検索の速度と検索品質を測る")
+    parser.add_argument("--sizes", default="1000,10000", help="エントリ数（カンマ区切り、最大 1000000 程度）")
+    parser.add_argument("--languages", default="ja,en", help="ja, en（カンマ区切り）")
+    parser.add_argument("--backends", default=",".join(BACKENDS), help=f"{', '.join(BACKENDS)}（カンマ区切り）")
+    parser.add_argument("--queries", type=int, default=200, help="正解付きのクエリの数")
+    parser.add_argument("--warmup", type=int, default=10, help="計測前に実行するクエリの数")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="1エントリの最大文字数")
+    parser.add_argument("--scan-max-size", type=int, default=10000, help="全件走査を計測する最大のエントリ数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果をJSONで保存するファイル")
+    parser.add_argument("--compare", help="比較する以前の結果のJSON")
+    parser.add_argument("--max-quality-drop", type=float, default=0.01,
+                        help="--compare で許容する recall@5 と MRR の低下")
+    args = parser.parse_args(argv)
+
+    sizes = parse_list(args.sizes, int)
+    languages = parse_list(args.languages)
+    backends = parse_list(args.backends)
+    for backend in backends:
+        if backend not in BACKENDS:
+            parser.error(f"Unknown backend: {backend}")
+    for language in languages:
+        if language not in ATTRIBUTES:
+            parser.error(f"Unknown language: {language}")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": vars(args),
+        "results": [],
+    }
+    # 方式ごとに新しいプロセスで実行し、前の方式のメモリが計測に混ざらないようにする
+    context = multiprocessing.get_context("spawn")
+    for language in languages:
+        for size in sizes:
+            for backend in backends:
+                if backend == "scan" and size > args.scan_max_size:
+                    print(f"Skipping scan for {size} entries (--scan-max-size {args.scan_max_size})")
+                    continue
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    future = executor.submit(
+                        run_backend, backend, language, size, args.queries, args.seed, args.chunk_size, args.warmup
+                    )
+                    try:
+                        results = future.result()
+                    except ImportError as e:
+                        print(f"Skipping {backend}: {e}")
+                        continue
+                for result in results:
+                    print_result(result)
+                report["results"].extend(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Saved results to {args.json}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare_results(report["results"], baseline, report["args"], args.max_quality_drop):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
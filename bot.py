@@ -7,23 +7,88 @@ import json
 import datetime
 from collections import defaultdict
 import uuid
-import PyPDF2
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-import textwrap
 from googleapiclient.discovery import build
 import html
-import requests
-from bs4 import BeautifulSoup
-import re
 import base64
+import hashlib
+import asyncio
+import contextlib
+import math
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from gemini_client import GeminiClient
+from http_client import FETCH_ERRORS, HTTPClient
+from caching import PageCache, TTLCache, normalize_url
+from extractors import StreamingChunker, get_extractor, parse_html, supported_extensions
+from prompt_builder import PromptBuilder, TokenEstimator
+from scheduler import RateLimited, Rejected, RequestScheduler
+from session_pool import ChatSessionPool
+from singleflight import SingleFlight
+from streaming import EMPTY_REPLY_TEXT, StreamingReply, split_message
+from history_store import HistoryIndex, HistoryJournal, SQLiteHistoryStore, migrate_journal_to_sqlite
+from invalidation import InvalidationBus
+from knowledge_store import migrate_json_to_sqlite, open_knowledge_store
+from metrics import Metrics
+from message_index import IndexedMessage, MessageIndex, retention_cutoff, snowflake_from_time
+from sharding import parse_shard_ids
 
 # Load environment variables from .env file
 load_dotenv()
 
+# シャーディングの設定（複数のプロセスで動かす場合は launcher.py が設定する）
+# SHARD_COUNT: 全体のシャード数（0 の場合はシャーディングしない）
+# SHARD_IDS: このプロセスが担当するシャード（"0,1" や "0-3"、省略時は全て）
+# WORKER_ID: ワーカーの番号（ワーカーごとのファイル名や計測値のポートに使う）
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))
+SHARD_IDS = parse_shard_ids(os.getenv("SHARD_IDS", ""))
+WORKER_ID = int(os.getenv("WORKER_ID", "0"))
+SHARDED = SHARD_COUNT > 0
+
+# ワーカーごとに分けるファイル（ページのキャッシュやベクトルインデックス）の名前を返す関数
+def worker_file(path):
+    if not SHARDED or not path:
+        return path
+    return f"{path}.worker{WORKER_ID}"
+
+# 計測値（コマンドと内部処理のレイテンシー、エラー数など）を Prometheus 形式で公開するかどうかと、公開するアドレス
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() in ("1", "true", "yes")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 同じマシンの複数のワーカーが衝突しないように、ワーカーの番号だけポートをずらす
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108")) + WORKER_ID
+# 無効の場合は計測用のデコレーターが関数をそのまま返す
+metrics = Metrics(enabled=METRICS_ENABLED)
+
+class GeminiBot(commands.AutoShardedBot if SHARDED else commands.Bot):
+    """起動時と終了時に共有リソースを準備・解放するボット
+
+    シャーディングする場合は AutoShardedBot として、担当するシャードだけに接続する。
+    """
+
+    async def setup_hook(self):
+        # URLや画像の取得に使うHTTPセッションを作成
+        await http_client.start()
+        # 計測値のエンドポイント（無効の場合は何もしない）
+        await metrics.start(METRICS_HOST, METRICS_PORT)
+        # 他のワーカーからのキャッシュの無効化を受け取る
+        if invalidation_bus is not None:
+            invalidation_bus.start()
+
+    async def close(self):
+        await super().close()
+        # 書き込み中・書き込み待ちの会話履歴のジャーナルを書き終えてから終了する
+        await history_journal.flush_async()
+        await http_client.close()
+        await metrics.stop()
+        page_cache.save()
+
 # Initialize Discord bot with command prefix
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+if SHARDED:
+    bot = GeminiBot(command_prefix='!', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = GeminiBot(command_prefix='!', intents=intents)
 
 # コマンドのエイリアス設定
 COMMAND_ALIASES = {
@@ -62,6 +127,34 @@ genai.configure(api_key=GEMINI_API_KEY)
 model = genai.GenerativeModel('models/gemini-1.5-flash')
 print(f"Using Gemini model: models/gemini-1.5-flash")
 
+# Gemini APIへの同時リクエスト数の上限
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+
+# モデル呼び出しの受付スケジューラーの設定
+# 待たせておけるリクエスト数と、待ち時間の上限（秒）。上限を超える見込みのリクエストは断る
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "100"))
+SCHEDULER_MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", "60"))
+# ユーザーごと・サーバーごとの1分あたりのリクエスト数と、続けて送れるリクエスト数（0 で無制限）
+USER_REQUESTS_PER_MINUTE = float(os.getenv("USER_REQUESTS_PER_MINUTE", "6"))
+USER_REQUEST_BURST = int(os.getenv("USER_REQUEST_BURST", "3"))
+GUILD_REQUESTS_PER_MINUTE = float(os.getenv("GUILD_REQUESTS_PER_MINUTE", "60"))
+GUILD_REQUEST_BURST = int(os.getenv("GUILD_REQUEST_BURST", "20"))
+# サーバーごとの重み（"サーバーID:重み,..."、指定が無いサーバーは 1）
+SCHEDULER_GUILD_WEIGHTS = {
+    int(guild_id): float(weight)
+    for guild_id, weight in (
+        item.split(":", 1) for item in os.getenv("SCHEDULER_GUILD_WEIGHTS", "").split(",") if ":" in item
+    )
+}
+
+# 応答をストリーミングで逐次表示するかどうかと、メッセージを編集する間隔（秒）
+ENABLE_STREAMING = os.getenv("ENABLE_STREAMING", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+# プロンプトのトークン数の上限と、推定値をモデルのトークンカウンターで補正するかどうか
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "8000"))
+PROMPT_CALIBRATE_TOKENS = os.getenv("PROMPT_CALIBRATE_TOKENS", "false").lower() in ("1", "true", "yes")
+
 # Google Custom Search API Configuration
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GOOGLE_CSE_ID = os.getenv("GOOGLE_CSE_ID")
@@ -71,6 +164,24 @@ if ENABLE_WEB_SEARCH:
 else:
     print("Web search feature is disabled. Set GOOGLE_API_KEY and GOOGLE_CSE_ID in .env file to enable.")
 
+# URLや画像を取得するHTTPクライアントの設定（タイムアウトは秒）
+http_client = HTTPClient(
+    limit=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+    limit_per_host=int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "8")),
+    dns_cache_ttl=int(os.getenv("HTTP_DNS_CACHE_TTL", "300")),
+    keepalive_timeout=float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30")),
+    connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+    read_timeout=float(os.getenv("HTTP_READ_TIMEOUT", "10")),
+    total_timeout=float(os.getenv("HTTP_TOTAL_TIMEOUT", "30")),
+)
+
+# URLから取り出したページのキャッシュ（サイズはMB、有効期間は秒、ファイル名を空にすると保存しない）
+page_cache = PageCache(
+    max_bytes=int(float(os.getenv("PAGE_CACHE_MB", "32")) * 1024 * 1024),
+    ttl=float(os.getenv("PAGE_CACHE_TTL", "600")),
+    path=worker_file(os.getenv("PAGE_CACHE_FILE", "page_cache.json")) or None,
+)
+
 # AIの性格設定
 AI_PERSONALITY = """あなたは親しみやすく、フレンドリーな会話AIです。
 ユーザーからの質問に対して、丁寧かつカジュアルに回答してください。
@@ -83,83 +194,354 @@ AI_PERSONALITY = """あなたは親しみやすく、フレンドリーな会話
 # Conversation history storage
 # Structure: {user_id: [{"role": "user/bot", "content": "message", "timestamp": "time", "username": "username", "nickname": "nickname"}]}
 conversation_history = defaultdict(list)
-MAX_HISTORY_LENGTH = 10  # Maximum number of messages to keep in history per user
+MAX_HISTORY_LENGTH = int(os.getenv("MAX_HISTORY_LENGTH", "10"))  # Maximum number of messages to keep in history per user
 SAVE_CONVERSATION_HISTORY = True  # 会話履歴を保存するかどうかのフラグ
 
-# チャットセッションを保持する辞書
-chat_sessions = {}
+# チャットセッションのプールの設定
+# セッション数の上限、1セッションの履歴の上限（件数とKB）、使われていないセッションを破棄するまでの時間（秒）
+CHAT_SESSION_MAX = int(os.getenv("CHAT_SESSION_MAX", "1000"))
+CHAT_SESSION_MAX_MESSAGES = int(os.getenv("CHAT_SESSION_MAX_MESSAGES", "20"))
+CHAT_SESSION_MAX_KB = int(os.getenv("CHAT_SESSION_MAX_KB", "256"))
+CHAT_SESSION_IDLE_TTL = float(os.getenv("CHAT_SESSION_IDLE_TTL", "1800"))
+
+# Knowledge base storage
+# KNOWLEDGE_BACKEND: "sqlite"（デフォルト）または従来のJSONファイルを使う "json"
+KNOWLEDGE_BACKEND = os.getenv("KNOWLEDGE_BACKEND", "sqlite")
+KNOWLEDGE_JSON_FILE = "knowledge_base.json"
+KNOWLEDGE_DB_FILE = os.getenv("KNOWLEDGE_DB_FILE", "knowledge_base.db")
+# 知識ベース検索のランキング方法: "bm25"（デフォルト）または従来のスコアを使う "legacy"
+KNOWLEDGE_RANKER = os.getenv("KNOWLEDGE_RANKER", "bm25")
+knowledge_store = None
 
-# Knowledge base functions
-knowledge_base = {}
+# 知識の重複検出（完全な重複は常に除外し、近似重複の検出は設定で有効にする）
+DEDUP_NEAR_DUPLICATES = os.getenv("DEDUP_NEAR_DUPLICATES", "false").lower() in ("1", "true", "yes")
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.85"))
+
+# 意味検索の設定
+# SEARCH_MODE: "keyword"（デフォルト）、埋め込みのみの "semantic"、両方を組み合わせる "hybrid"
+SEARCH_MODE = os.getenv("SEARCH_MODE", "keyword")
+# EMBEDDER: Gemini の埋め込みAPIを使う "gemini" またはオフライン用の "hashing"
+EMBEDDER = os.getenv("EMBEDDER", "gemini")
+# hybrid モードで意味検索のスコアに掛ける重み（0〜1）
+SEMANTIC_WEIGHT = float(os.getenv("SEMANTIC_WEIGHT", "0.5"))
+# シャーディングする場合、ベクトルインデックスはワーカーごとに持つ
+# （埋め込みは1つのワーカーだけが計算し、知識ベースのデータベースを通じて他のワーカーと共有する）
+VECTOR_INDEX_FILE = worker_file(os.getenv("VECTOR_INDEX_FILE", "knowledge_vectors.f32"))
+embedder = None
+vector_index = None
+shared_vectors = None
+if SEARCH_MODE != "keyword":
+    # 意味検索を使う場合のみNumPyを読み込む
+    from vector_index import SharedVectorStore, VectorIndex, create_embedder, fuse_results
 
 # File to store conversation history
 HISTORY_FILE = "conversation_history.json"
 
+# 会話履歴ジャーナルの書き込み間隔（秒）と、スナップショットを作成するジャーナル件数
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.2"))
+HISTORY_COMPACT_THRESHOLD = int(os.getenv("HISTORY_COMPACT_THRESHOLD", "1000"))
+
+# 会話履歴の保存先: "journal"（1プロセス用）または複数のワーカーで共有する "sqlite"（シャーディング時のデフォルト）
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "sqlite" if SHARDED else "journal")
+HISTORY_DB_FILE = os.getenv("HISTORY_DB_FILE", "conversation_history.db")
+
+if HISTORY_BACKEND == "sqlite":
+    # 会話履歴は共有のデータベースに保存し、conversation_history はこのプロセスのキャッシュとして使う
+    history_journal = SQLiteHistoryStore(conversation_history, HISTORY_DB_FILE)
+elif HISTORY_BACKEND == "journal":
+    if SHARDED:
+        raise ValueError("HISTORY_BACKEND=journal cannot be shared between shard workers; use sqlite")
+    # 会話履歴はジャーナルに追記し、定期的にスナップショットへまとめる
+    history_journal = HistoryJournal(
+        conversation_history,
+        HISTORY_FILE,
+        flush_interval=HISTORY_FLUSH_INTERVAL,
+        compact_threshold=HISTORY_COMPACT_THRESHOLD,
+    )
+else:
+    raise ValueError(f"Unknown history backend: {HISTORY_BACKEND}")
+
+# ワーカー間でキャッシュの無効化を知らせるイベントバス（シャーディングする場合のみ）
+INVALIDATION_DB_FILE = os.getenv("INVALIDATION_DB_FILE", "invalidation.db")
+INVALIDATION_POLL_INTERVAL = float(os.getenv("INVALIDATION_POLL_INTERVAL", "0.5"))
+invalidation_bus = (
+    InvalidationBus(INVALIDATION_DB_FILE, poll_interval=INVALIDATION_POLL_INTERVAL) if SHARDED else None
+)
+
+def publish_invalidation(topic, key=None):
+    """他のワーカーに変更を知らせる（シャーディングしない場合は何もしない）"""
+    if invalidation_bus is None:
+        return
+    try:
+        invalidation_bus.publish(topic, key)
+    except Exception as e:
+        print(f"Error publishing invalidation {topic}: {e}")
+
+# !search_history 用の会話履歴の索引（conversation_history と同期して更新する）
+history_index = HistoryIndex()
+
+# チャンネルのメッセージ検索用のローカルインデックス（!search_messages と !search_all で使う）
+MESSAGE_INDEX_ENABLED = os.getenv("MESSAGE_INDEX_ENABLED", "true").lower() in ("1", "true", "yes")
+MESSAGE_INDEX_FILE = os.getenv("MESSAGE_INDEX_FILE", "message_index.db")
+# メッセージの保存期間（日）。MESSAGE_RETENTION_GUILDS は "サーバーID:日数,..." の形式でサーバーごとに上書きする（0 で保存しない）
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", "180"))
+MESSAGE_RETENTION_GUILDS = {
+    int(guild_id): int(days)
+    for guild_id, days in (
+        item.split(":", 1) for item in os.getenv("MESSAGE_RETENTION_GUILDS", "").split(",") if ":" in item
+    )
+}
+# 過去のメッセージを取り込む時の1ページの取得間隔（秒）
+MESSAGE_BACKFILL_INTERVAL = float(os.getenv("MESSAGE_BACKFILL_INTERVAL", "1.0"))
+message_index = MessageIndex(MESSAGE_INDEX_FILE) if MESSAGE_INDEX_ENABLED else None
+
+def message_retention_days(guild_id):
+    return MESSAGE_RETENTION_GUILDS.get(guild_id, MESSAGE_RETENTION_DAYS)
+
 # Load conversation history from file if it exists
 def load_conversation_history():
-    global conversation_history
     try:
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                # Convert from regular dict to defaultdict
-                history_data = json.load(f)
-                for user_id, messages in history_data.items():
-                    conversation_history[user_id] = messages
-            print(f"Loaded conversation history for {len(conversation_history)} users")
+        if HISTORY_BACKEND == "sqlite":
+            # 既存のジャーナル形式の履歴があれば初回のみ移行する
+            migrated = migrate_journal_to_sqlite(HISTORY_FILE, history_journal)
+            if migrated:
+                print(f"Migrated {migrated} history messages from {HISTORY_FILE}")
+        replayed = history_journal.load()
+        history_index.rebuild(conversation_history)
+        print(f"Loaded conversation history for {len(conversation_history)} users ({replayed} journal records replayed)")
     except Exception as e:
         print(f"Error loading conversation history: {e}")
 
-# Load knowledge base from file if it exists
+# Open the knowledge base storage
 def load_knowledge_base():
-    global knowledge_base
-    try:
-        with open('knowledge_base.json', 'r', encoding='utf-8') as f:
-            knowledge_base = json.load(f)
-    except FileNotFoundError:
-        knowledge_base = {}
-    except json.JSONDecodeError:
-        print("Error decoding knowledge base file. Starting with empty knowledge base.")
-        knowledge_base = {}
-
-# 知識ベースをファイルに保存する関数
-def save_knowledge_base():
+    global knowledge_store
+    if KNOWLEDGE_BACKEND == "json" and SHARDED:
+        raise ValueError("KNOWLEDGE_BACKEND=json cannot be shared between shard workers; use sqlite")
+    # 重複検出のインデックスはストレージが管理する（SQLiteの場合はデータベースに保存される）
+    dedup_options = {"near_duplicates": DEDUP_NEAR_DUPLICATES, "dedup_threshold": DEDUP_THRESHOLD}
+    if KNOWLEDGE_BACKEND == "json":
+        knowledge_store = open_knowledge_store("json", KNOWLEDGE_JSON_FILE, **dedup_options)
+    else:
+        knowledge_store = open_knowledge_store(KNOWLEDGE_BACKEND, KNOWLEDGE_DB_FILE, **dedup_options)
+        # 既存の knowledge_base.json があれば初回のみ移行する
+        try:
+            migrated = migrate_json_to_sqlite(KNOWLEDGE_JSON_FILE, knowledge_store)
+            if migrated:
+                print(f"Migrated {migrated} knowledge entries from {KNOWLEDGE_JSON_FILE}")
+        except Exception as e:
+            print(f"Error migrating knowledge base: {e}")
+    print(f"Loaded knowledge base with {len(knowledge_store)} entries ({KNOWLEDGE_BACKEND})")
+    
+    # 意味検索を使う場合はベクトルインデックスを開く（NumPyが必要）
+    global embedder, vector_index, shared_vectors
+    if SEARCH_MODE != "keyword":
+        embedder = create_embedder(EMBEDDER)
+        vector_index = VectorIndex(VECTOR_INDEX_FILE, embedder.dim, embedder.name)
+        if SHARDED:
+            shared_vectors = SharedVectorStore(KNOWLEDGE_DB_FILE, f"{embedder.name}:{embedder.dim}", embedder.dim)
+        print(f"Semantic search enabled ({SEARCH_MODE}, {embedder.name}): {len(vector_index)} vectors")
+
+# 埋め込みベクトルをまとめて計算してベクトルインデックスに追加する関数
+async def add_embeddings(entries):
+    """(knowledge_id, content) のリストの埋め込みを embedder.batch_size 件ずつ計算して保存する
+
+    シャーディングする場合は、他のワーカーが計算済みのベクトルを読み込み、残りのうち
+    このワーカーが確保できたものだけを計算して共有する（他のワーカーが計算中のものは
+    embeddings_added の通知で読み込む）。
+    """
+    if vector_index is None or not entries:
+        return
+    if shared_vectors is not None:
+        found_ids, vectors = shared_vectors.get_many([knowledge_id for knowledge_id, _ in entries])
+        vector_index.add(found_ids, vectors)
+        found = set(found_ids)
+        claimed = set(shared_vectors.claim(
+            [knowledge_id for knowledge_id, _ in entries if knowledge_id not in found], invalidation_bus.origin
+        ))
+        entries = [(knowledge_id, content) for knowledge_id, content in entries if knowledge_id in claimed]
+    loop = asyncio.get_running_loop()
+    for i in range(0, len(entries), embedder.batch_size):
+        batch = entries[i:i + embedder.batch_size]
+        knowledge_ids = [knowledge_id for knowledge_id, _ in batch]
+        try:
+            vectors = await loop.run_in_executor(None, embedder.embed_documents, [content for _, content in batch])
+        except Exception as e:
+            # 埋め込みに失敗しても学習自体は成功させる（起動時のバックフィルで補完される）
+            print(f"Error computing embeddings: {e}")
+            if shared_vectors is not None:
+                shared_vectors.release([knowledge_id for knowledge_id, _ in entries[i:]], invalidation_bus.origin)
+            return
+        vector_index.add(knowledge_ids, vectors)
+        if shared_vectors is not None:
+            shared_vectors.put(knowledge_ids, vectors)
+            publish_invalidation("embeddings_added", json.dumps(knowledge_ids))
+
+# 埋め込みが無いエントリの埋め込みを計算する関数
+async def backfill_embeddings():
+    if vector_index is None:
+        return
+    missing = []
+    for knowledge_id, entry in knowledge_store.iter_entries():
+        if knowledge_id not in vector_index:
+            missing.append((knowledge_id, entry["content"]))
+    if missing:
+        print(f"Computing embeddings for {len(missing)} knowledge entries...")
+        await add_embeddings(missing)
+
+# サーバーのメッセージをインデックスに追加する関数
+def index_message(message):
+    if message_index is None or message.guild is None or message_retention_days(message.guild.id) <= 0:
+        return
     try:
-        with open('knowledge_base.json', 'w', encoding='utf-8') as f:
-            json.dump(knowledge_base, f, ensure_ascii=False, indent=4)
+        message_index.add_message(message)
+        channel = message.channel
+        if channel.id in backfilled_channels:
+            # 最新まで取り込み済みのチャンネルは、受け取ったメッセージまで取り込み位置を進める
+            message_index.advance_backfill_cursor(channel.id, message.id)
+        elif channel.id not in backfill_queued_channels:
+            # まだ取り込んでいないチャンネル（起動後に作成されたチャンネルなど）は過去のメッセージから取り込む
+            # （取り込みが終わるまでは位置を進めず、停止していた間のメッセージを飛ばさないようにする）
+            start_backfill([channel])
     except Exception as e:
-        print(f"Error saving knowledge base: {e}")
+        print(f"Error indexing message {message.id}: {e}")
+
+# チャンネルの取り込み済みの位置より新しいメッセージを古い順に取り込む関数
+async def backfill_channel(channel, page_size=100):
+    """前回の取り込み位置（無ければ保存期間の開始時刻）から after= で順にページを取得する
+
+    取り込み位置はページごとに保存するので、再起動してもボットが停止していた間の
+    メッセージを含めて続きから取り込む。
+    """
+    cutoff = snowflake_from_time(retention_cutoff(message_retention_days(channel.guild.id)))
+    cursor = max(message_index.backfill_cursor(channel.id) or 0, cutoff)
+    count = 0
+    while True:
+        messages = [
+            message async for message in
+            channel.history(limit=page_size, after=discord.Object(id=cursor), oldest_first=True)
+        ]
+        if not messages:
+            break
+        count += message_index.add_messages(messages)
+        cursor = messages[-1].id
+        message_index.set_backfill_cursor(channel.id, cursor)
+        if len(messages) < page_size:
+            break
+        await asyncio.sleep(MESSAGE_BACKFILL_INTERVAL)
+    return count
+
+# このプロセスで取り込みを予約・実行中のチャンネルと、最新まで取り込み済みのチャンネル
+backfill_queued_channels = set()
+backfilled_channels = set()
+backfill_tasks = set()
+
+def queue_backfill(channels):
+    """まだ取り込んでいない、履歴を読めるチャンネルを予約してそのリストを返す"""
+    queued = []
+    for channel in channels:
+        if channel.id in backfill_queued_channels or channel.id in backfilled_channels:
+            continue
+        if message_retention_days(channel.guild.id) <= 0:
+            continue
+        permissions = channel.permissions_for(channel.guild.me)
+        if not (permissions.read_messages and permissions.read_message_history):
+            continue
+        backfill_queued_channels.add(channel.id)
+        queued.append(channel)
+    return queued
+
+async def backfill_channels(channels):
+    """予約したチャンネルを順に取り込み、終わったものを backfilled_channels に移す"""
+    for channel in channels:
+        try:
+            count = await backfill_channel(channel)
+            if count:
+                print(f"Indexed {count} messages from #{channel.name} ({channel.guild.name})")
+            backfilled_channels.add(channel.id)
+        except discord.HTTPException as e:
+            print(f"Error backfilling messages from #{channel.name}: {e}")
+        finally:
+            backfill_queued_channels.discard(channel.id)
+
+def start_backfill(channels):
+    """チャンネルの取り込みをバックグラウンドで開始する（参加したサーバーや新しいチャンネル用）"""
+    channels = queue_backfill(channels)
+    if channels:
+        task = asyncio.create_task(backfill_channels(channels))
+        backfill_tasks.add(task)
+        task.add_done_callback(backfill_tasks.discard)
+
+# メッセージインデックスの取り込みと保存期間の管理をバックグラウンドで行う関数
+async def maintain_message_index(prune_interval=3600):
+    await backfill_channels(queue_backfill(
+        channel for guild in bot.guilds for channel in guild.text_channels
+    ))
+    print(f"Message index: {message_index.count()} messages")
+    
+    while True:
+        for guild_id in message_index.guild_ids():
+            pruned = message_index.prune(guild_id, retention_cutoff(message_retention_days(guild_id)))
+            if pruned:
+                print(f"Pruned {pruned} indexed messages from guild {guild_id}")
+        await asyncio.sleep(prune_interval)
+
+# チャンネル内の検索語を含むメッセージを新しい順に探す関数
+async def find_channel_messages(channel, query, limit=10, scan_limit=100):
+    """インデックスから検索し、(メッセージのリスト, 件数) を返す
+
+    インデックスが無効な場合やDMでは、従来どおり直近 scan_limit 件のメッセージから探す。
+    """
+    if message_index is not None and getattr(channel, "guild", None) is not None:
+        return message_index.search(channel.id, query, limit=limit)
+    results = []
+    async for msg in channel.history(limit=scan_limit):
+        if query.lower() in msg.content.lower():
+            results.append(IndexedMessage(msg.id, channel.id, msg.author.name, msg.content, msg.created_at))
+    return results[:limit], len(results)
 
 # Save conversation history to file
+@metrics.timed("save_conversation_history")
 def save_conversation_history():
+    """会話履歴のスナップショットを作成し、ジャーナルを空にする"""
     if not SAVE_CONVERSATION_HISTORY:
         return  # 会話履歴を保存しない場合は何もしない
         
     try:
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(conversation_history, f, ensure_ascii=False, indent=4)
+        history_journal.close()
     except Exception as e:
         print(f"Error saving conversation history: {e}")
 
 # Add message to conversation history
+@metrics.timed("add_to_history")
 def add_to_history(user_id, role, content, username, nickname):
     if not SAVE_CONVERSATION_HISTORY:
         return  # 会話履歴を保存しない場合は何もしない
         
     timestamp = datetime.datetime.now().isoformat()
-    conversation_history[user_id].append({
+    message = {
         "role": role,
         "content": content,
         "timestamp": timestamp,
         "username": username,
         "nickname": nickname
-    })
+    }
     
-    # Limit history length
-    if len(conversation_history[user_id]) > MAX_HISTORY_LENGTH:
-        conversation_history[user_id].pop(0)
+    # 履歴に追加し、上限を超えた分を削除してジャーナルに記録
+    try:
+        trimmed = history_journal.append_message(user_id, message, MAX_HISTORY_LENGTH)
+    except Exception as e:
+        print(f"Error saving conversation history: {e}")
+        return
     
-    # Save to file
-    save_conversation_history()
+    # 検索用の索引も同じように更新する
+    if HISTORY_BACKEND == "sqlite":
+        # 他のワーカーの追加も含めてデータベースから読み直した履歴に合わせる
+        # （削除した件数はキャッシュが古い場合にずれるので使わない）
+        history_index.reset_user(user_id, conversation_history.get(user_id, []))
+    else:
+        history_index.add(user_id, message)
+        history_index.trim(user_id, trimmed)
+    publish_invalidation("history", user_id)
 
 # Format conversation history for Gemini API
 def format_history_for_gemini(user_id):
@@ -185,150 +567,419 @@ def format_history_for_gemini(user_id):
     
     return "\n\n".join(history_text_parts)
 
+# 保存されている会話履歴からチャットセッションの履歴を作る関数
+def build_chat_history(user_id):
+    """conversation_history の直近のやり取りを Gemini のチャット履歴の形式に変換する"""
+    history = []
+    for msg in conversation_history.get(user_id, [])[-CHAT_SESSION_MAX_MESSAGES:]:
+        role = "user" if msg["role"] == "user" else "model"
+        if history and history[-1]["role"] == role:
+            # 同じ役割が続く場合はまとめる
+            history[-1]["parts"][0] += "\n\n" + msg["content"]
+        else:
+            history.append({"role": role, "parts": [msg["content"]]})
+    # 履歴はユーザーの発言で始まり、モデルの応答で終わる必要がある
+    if history and history[0]["role"] != "user":
+        history = history[1:]
+    if history and history[-1]["role"] != "model":
+        history = history[:-1]
+    return history
+
 # Gemini APIで会話を開始する関数
 def start_gemini_chat(user_id):
     """Start a chat with Gemini API using conversation history"""
-    # 会話履歴を再現せず、新しいチャットを開始する
-    if user_id not in chat_sessions:
-        chat_sessions[user_id] = model.start_chat(history=[])
-    return chat_sessions[user_id]
-
-# テキストを分割する関数
-def split_text(text, chunk_size=1000, overlap=200):
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=overlap,
-        length_function=len,
+    # プールに無い（破棄された）場合は会話履歴から新しいチャットを作り直す
+    return model.start_chat(history=build_chat_history(user_id))
+
+# ユーザーごとのチャットセッションのプール
+chat_sessions = ChatSessionPool(
+    start_gemini_chat,
+    max_sessions=CHAT_SESSION_MAX,
+    max_messages=CHAT_SESSION_MAX_MESSAGES,
+    max_bytes=CHAT_SESSION_MAX_KB * 1024,
+    idle_ttl=CHAT_SESSION_IDLE_TTL,
+)
+
+# Gemini APIの非同期クライアント（全てのモデル呼び出しはこれを経由する）
+gemini = GeminiClient(model, chat_sessions.get, max_concurrency=GEMINI_MAX_CONCURRENCY)
+
+# ユーザーが起動するモデル呼び出しの受付（サーバーとユーザーの間で公平に順番を割り当てる）
+scheduler = RequestScheduler(
+    max_concurrency=GEMINI_MAX_CONCURRENCY,
+    max_queue=SCHEDULER_MAX_QUEUE,
+    max_wait=SCHEDULER_MAX_WAIT,
+    user_rate=USER_REQUESTS_PER_MINUTE / 60,
+    user_burst=USER_REQUEST_BURST,
+    guild_rate=GUILD_REQUESTS_PER_MINUTE / 60,
+    guild_burst=GUILD_REQUEST_BURST,
+    guild_weights=SCHEDULER_GUILD_WEIGHTS,
+)
+
+# 使われていないチャットセッションを定期的に破棄する関数
+async def expire_chat_sessions(interval=60):
+    while True:
+        await asyncio.sleep(interval)
+        if chat_sessions.expire_idle():
+            stats = chat_sessions.stats()
+            print(f"Chat sessions: {stats['sessions']} live, ~{stats['estimated_bytes'] // 1024} KB "
+                  f"(expired {stats['expired']}, evicted {stats['evicted']})")
+
+# プロンプトのトークン数の推定（補正係数は全リクエストで共有する）
+token_estimator = TokenEstimator()
+
+# 推定したトークン数をモデルのトークンカウンターで補正する関数
+async def calibrate_token_estimator(text):
+    try:
+        token_estimator.calibrate(text, await gemini.count_tokens(text))
+    except Exception as e:
+        print(f"Error counting tokens: {e}")
+
+# プロンプトを組み立ててトークン数を記録する関数
+def build_prompt(builder, command_name):
+    prompt = builder.build()
+    print(f"Prompt for !{command_name}: ~{prompt.tokens} tokens "
+          f"(budget {builder.budget}, dropped {prompt.dropped}, truncated {prompt.truncated})")
+    if PROMPT_CALIBRATE_TOKENS and token_estimator.needs_calibration():
+        asyncio.create_task(calibrate_token_estimator(prompt.text))
+    return prompt.text
+
+# 繰り返される質問への回答のキャッシュ
+# ANSWER_CACHE_MODE: "off"（デフォルト）、サーバー内で回答を共有する "shared"
+# （ユーザー名や会話履歴を使わずに回答する）、ユーザーごとに会話履歴も含めてキャッシュする "per_user"
+ANSWER_CACHE_MODE = os.getenv("ANSWER_CACHE_MODE", "off")
+answer_cache = TTLCache(
+    maxsize=int(os.getenv("ANSWER_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+)
+
+# 回答のキャッシュのキーを作る関数（キャッシュしない場合は None）
+def answer_cache_key(ctx, user_id, question, related_results):
+    """
+    正規化した質問と、検索された知識のIDと内容のハッシュ（版）をキーにする。
+    回答に使った知識が削除・変更されるか、別の知識が検索されるようになればキーが変わる。
+    サーバーごとに分け、per_user モードではユーザーと会話履歴もキーに含める。
+    """
+    if ANSWER_CACHE_MODE not in ("shared", "per_user"):
+        return None
+    # DMはユーザーごとに分ける
+    scope = f"guild:{ctx.guild.id}" if ctx.guild else f"dm:{user_id}"
+    knowledge_versions = tuple(
+        (knowledge_id, hashlib.sha1(entry["content"].encode("utf-8")).hexdigest())
+        for knowledge_id, entry in related_results
     )
-    return text_splitter.split_text(text)
-
-# PDFファイルからテキストを抽出する関数
-def extract_text_from_pdf(file_path):
-    with open(file_path, 'rb') as file:
-        reader = PyPDF2.PdfReader(file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
-        return text
-
-# テキストファイルからテキストを抽出する関数
-def extract_text_from_txt(file_path):
-    with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-        return file.read()
+    history_key = None
+    if ANSWER_CACHE_MODE == "per_user":
+        # チャットセッションに含まれる会話履歴（最新のユーザーメッセージ＝今回の質問を除く）
+        recent_history = conversation_history.get(user_id, [])[-(CHAT_SESSION_MAX_MESSAGES + 1):-1]
+        digest = hashlib.sha1()
+        for msg in recent_history:
+            digest.update(f"{msg['role']}\0{msg['content']}\0".encode("utf-8"))
+        history_key = (user_id, digest.hexdigest())
+    return (scope, normalize_search_query(question), knowledge_versions, history_key)
 
-# ファイルから学習する関数
-async def learn_from_file(file_path, user_id):
-    """ファイルから情報を抽出して知識ベースに追加する"""
-    file_extension = os.path.splitext(file_path)[1].lower()
+# 長いテキストを自然な区切りで分割して送信する関数
+@metrics.timed("discord_send")
+async def send_long_message(ctx, text, first_message=None):
+    # 空白だけの応答も送信できないので、空の応答と同じ表示にする
+    chunks = (split_message(text) if text.strip() else []) or [EMPTY_REPLY_TEXT]
+    if first_message is not None:
+        await first_message.edit(content=chunks[0], embed=None)
+        chunks = chunks[1:]
+    for chunk in chunks:
+        await ctx.send(chunk)
+
+# Geminiで応答を生成してDiscordに送信する関数
+async def generate_and_send(ctx, user_id, prompt, first_message=None, stateless=False):
+    """
+    応答を生成して送信し、応答のテキストを返す（呼び出し側で gemini.user_lock を保持すること）
+    
+    ストリーミングが有効な場合は最初のテキストが届いた時点でメッセージを送信し、
+    その後は一定間隔で編集して続きを表示する。応答が空の場合はどちらの場合も
+    EMPTY_REPLY_TEXT を表示し、空のテキストを返す（呼び出し側は会話履歴に追加しない）。
     
+    Args:
+        first_message (discord.Message, optional): 応答で上書きする「処理中」のメッセージ
+        stateless (bool): True の場合はユーザーのチャットセッション（会話履歴）を使わずに生成する
+    """
+    if ENABLE_STREAMING:
+        reply = StreamingReply(ctx, edit_interval=STREAM_EDIT_INTERVAL, first_message=first_message)
+        if stateless:
+            stream = gemini.generate_content_stream(prompt)
+        else:
+            stream = gemini.send_message_stream(user_id, prompt)
+        started = time.perf_counter()
+        first_chunk = metrics.enabled
+        try:
+            # ストリームの時間にはメッセージの編集も含まれるため、最初のテキストまでの時間も記録する
+            with metrics.stage("gemini_stream"):
+                async for text in stream:
+                    if first_chunk:
+                        metrics.observe_stage("gemini_first_chunk", time.perf_counter() - started)
+                        first_chunk = False
+                    await reply.append(text)
+        finally:
+            await stream.aclose()
+        with metrics.stage("discord_send"):
+            return await reply.finish(empty_text=EMPTY_REPLY_TEXT)
+    
+    with metrics.stage("gemini_send_message"):
+        if stateless:
+            response = await gemini.generate_content(prompt)
+        else:
+            response = await gemini.send_message(user_id, prompt)
+    
+    # Get response text safely
     try:
-        if file_extension == '.pdf':
-            text = extract_text_from_pdf(file_path)
-        elif file_extension == '.txt':
-            text = extract_text_from_txt(file_path)
+        response_text = response.text
+    except Exception as e:
+        response_text = f"エラーが発生しました: {str(e)}"
+    
+    await send_long_message(ctx, response_text, first_message=first_message)
+    return response_text
+
+# モデルを呼び出す順番を待つ関数
+@contextlib.asynccontextmanager
+async def model_slot(ctx, message=None):
+    """
+    スケジューラーの順番が来るまで待ち、ブロックを抜けるまで実行枠を使う
+    
+    待たされる場合は順番待ちの位置を message（無ければ新しく送信したメッセージ）に表示する。
+    
+    Yields:
+        discord.Message: 順番待ちを表示したメッセージ（待たなかった場合は message）
+    
+    Raises:
+        Rejected: リクエスト数の上限を超えた場合や、混雑していて受け付けられない場合
+    """
+    notice = [message, False]
+    
+    async def on_queued(position):
+        text = f"順番待ちです（{position}番目）。しばらくお待ちください..."
+        if notice[0] is None:
+            notice[0] = await ctx.send(text)
         else:
-            return f"サポートされていないファイル形式です: {file_extension}"
-        
-        # テキストを分割
-        chunks = split_text(text)
+            await notice[0].edit(content=text, embed=None)
+        notice[1] = True
+    
+    guild_id = ctx.guild.id if ctx.guild else None
+    async with scheduler.slot(str(ctx.author.id), guild_id, on_queued=on_queued):
+        if notice[1]:
+            await notice[0].edit(content="回答を生成しています...")
+        yield notice[0]
+
+# スケジューラーが断ったリクエストへの返答
+def rejection_message(error):
+    if isinstance(error, RateLimited):
+        return f"リクエストが多すぎます。{math.ceil(error.retry_after)}秒後にもう一度お試しください。"
+    return "現在混み合っているため、リクエストを受け付けられませんでした。しばらくしてからもう一度お試しください。"
+
+# スケジューラーの待ち状況を定期的にログに出力する関数
+async def report_scheduler_stats(interval=60):
+    last_admitted = None
+    while True:
+        await asyncio.sleep(interval)
+        stats = scheduler.stats()
+        if stats["admitted"] == last_admitted and not stats["queued"]:
+            continue
+        last_admitted = stats["admitted"]
+        print(f"Scheduler: {stats['queued']} queued (max {stats['max_depth']}), {stats['running']} running, "
+              f"wait p50 {stats['wait_p50']:.2f}s / p95 {stats['wait_p95']:.2f}s, "
+              f"admitted {stats['admitted']}, rate limited {stats['rate_limited']}, shed {stats['shed']}")
+
+# ファイルの抽出に使うプロセス数と、知識ベースにまとめて追加するチャンク数
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "2"))
+LEARN_BATCH_SIZE = int(os.getenv("LEARN_BATCH_SIZE", "100"))
+# 学習できる添付ファイルの最大サイズ（MB）
+LEARN_FILE_MAX_MB = float(os.getenv("LEARN_FILE_MAX_MB", "25"))
+
+# PDFなどの抽出はCPU負荷が高いため、イベントループを止めないよう別プロセスで行う（最初に使う時に作成）
+extract_executor = None
+
+def get_extract_executor():
+    global extract_executor
+    if extract_executor is None:
+        extract_executor = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+    return extract_executor
+
+# ファイルから学習する関数
+@metrics.timed("learn_from_file")
+async def learn_from_file(filename, data, user_id, progress=None):
+    """
+    ファイルから情報を抽出して知識ベースに追加する
+    
+    ページごとに抽出したテキストを少しずつチャンクに分割し、
+    LEARN_BATCH_SIZE 個ずつ知識ベースに追加する。
+    
+    Args:
+        filename (str): ファイル名（拡張子で抽出方法を選ぶ）
+        data (bytes): ファイルの内容
+        progress (callable, optional): (処理したページ数, 総ページ数) を受け取るコルーチン関数
+    """
+    extractor = get_extractor(filename)
+    if extractor is None:
+        return f"サポートされていないファイル形式です: {os.path.splitext(filename)[1].lower()}"
+    
+    try:
+        pages = extractor(data, get_extract_executor())
         
-        # 各チャンクを知識ベースに追加
+        chunker = StreamingChunker()
+        entries = []
         added_count = 0
-        for chunk in chunks:
-            # 空のチャンクはスキップ
-            if not chunk.strip():
-                continue
+        skipped_count = 0
+        
+        # 各チャンクを LEARN_BATCH_SIZE 個ずつまとめて知識ベースに追加（1バッチ1トランザクション）
+        async def add_batch():
+            nonlocal entries, added_count, skipped_count
+            # 既に学習済みの内容と重複するチャンクは追加しない
+            batch, skipped = knowledge_store.filter_duplicates(entries)
+            entries = []
+            skipped_count += skipped
+            if not batch:
+                return
+            added_count += knowledge_store.add_many(batch)
+            publish_invalidation("knowledge_added", json.dumps([knowledge_id for knowledge_id, _ in batch]))
+            await add_embeddings([(knowledge_id, entry["content"]) for knowledge_id, entry in batch])
+        
+        def collect(chunks):
+            for chunk in chunks:
+                # 空のチャンクはスキップ
+                if not chunk.strip():
+                    continue
                 
-            # 知識ベースに追加
-            knowledge_id = str(uuid.uuid4())
-            knowledge_base[knowledge_id] = {
-                "content": chunk,
-                "added_by": user_id,
-                "timestamp": datetime.datetime.now().isoformat()
-            }
-            added_count += 1
-        
-        # 知識ベースを保存
-        save_knowledge_base()
+                knowledge_id = str(uuid.uuid4())
+                entries.append((knowledge_id, {
+                    "content": chunk,
+                    "added_by": user_id,
+                    "timestamp": datetime.datetime.now().isoformat()
+                }))
         
+        try:
+            async for page_number, total_pages, text in pages:
+                collect(chunker.feed(text))
+                if len(entries) >= LEARN_BATCH_SIZE:
+                    await add_batch()
+                if progress is not None:
+                    await progress(page_number, total_pages)
+        finally:
+            await pages.aclose()
+        collect(chunker.finish())
+        if entries:
+            await add_batch()
+        
+        if skipped_count:
+            return f"ファイルから {added_count} 個のチャンクを学習しました（重複する {skipped_count} 個はスキップしました）。"
         return f"ファイルから {added_count} 個のチャンクを学習しました。"
     except Exception as e:
         return f"ファイルの処理中にエラーが発生しました: {str(e)}"
 
 # Add a piece of knowledge to the knowledge base
-def add_knowledge(content, user_id):
+@metrics.timed("add_knowledge")
+def add_knowledge(content, user_id, title=None):
+    """知識を追加して知識IDを返す（既に同じ内容を学習済みの場合は追加せずに None を返す）"""
+    if knowledge_store.find_duplicate(content) is not None:
+        return None
     knowledge_id = str(uuid.uuid4())
-    knowledge_base[knowledge_id] = {
+    entry = {
         "content": content,
         "added_by": user_id,
         "timestamp": datetime.datetime.now().isoformat()
     }
-    save_knowledge_base()
+    if title:
+        # タイトルはBM25Fのタイトルフィールドとして検索に使われる
+        entry["title"] = title
+    knowledge_store.add(knowledge_id, entry)
+    publish_invalidation("knowledge_added", json.dumps([knowledge_id]))
     return knowledge_id
 
 # Search for knowledge items related to the query
-def search_knowledge(query):
-    """Search for knowledge items related to the query"""
-    query_lower = query.lower()
-    
-    # 日本語の場合は文字単位で分割、英語の場合は単語単位で分割
-    has_japanese = any(ord(c) > 127 for c in query)
-    if has_japanese:
-        # 日本語の場合は2文字以上の部分文字列を抽出
-        query_words = []
-        for i in range(len(query_lower)):
-            for j in range(i+2, min(i+10, len(query_lower)+1)):
-                query_words.append(query_lower[i:j])
-    else:
-        # 英語の場合は単語単位で分割
-        query_words = [word for word in query_lower.split() if len(word) > 1]
-    
-    results = []
-    scores = {}
-    
-    for knowledge_id, data in knowledge_base.items():
-        content_lower = data["content"].lower()
-        score = 0
-        
-        # 完全一致の場合は高いスコア
-        if query_lower in content_lower:
-            score += 10
-            
-        # 部分一致の場合
-        if has_japanese:
-            # 日本語の場合は部分文字列のマッチを確認
-            for word in query_words:
-                if word in content_lower:
-                    score += 2
-                    
-                    # 出現回数も考慮
-                    score += content_lower.count(word) * 0.2
-        else:
-            # 英語の場合は単語単位でのマッチを確認
-            for word in query_words:
-                if word in content_lower:
-                    score += 3
-                    
-                    # 単語の出現回数も考慮
-                    score += content_lower.count(word) * 0.5
-        
-        if score > 0:
-            scores[knowledge_id] = score
+@metrics.timed("search_knowledge")
+def search_knowledge(query, query_vector=None, with_ids=False):
+    """Search for knowledge items related to the query
     
-    # スコアの高い順にソート（最大5つまで）
-    sorted_ids = sorted(scores.keys(), key=lambda x: scores[x], reverse=True)[:5]
+    with_ids=True の場合は (knowledge_id, entry) のリストを返す
+    """
+    if vector_index is None or query_vector is None:
+        # 転置インデックスで候補を絞り込み、スコアの高い順に最大5つまで返す
+        results = knowledge_store.search(query, limit=5, ranker=KNOWLEDGE_RANKER)
+        return results if with_ids else [entry for _, entry in results]
     
-    for knowledge_id in sorted_ids:
-        results.append(knowledge_base[knowledge_id])
+    semantic_results = vector_index.search(query_vector, k=20)
+    if SEARCH_MODE == "semantic":
+        ranked = [(knowledge_id, similarity) for knowledge_id, similarity in semantic_results if similarity > 0][:5]
+    else:
+        keyword_results = [
+            (knowledge_id, score)
+            for knowledge_id, _, score in knowledge_store.search_with_scores(query, limit=20, ranker=KNOWLEDGE_RANKER)
+        ]
+        ranked = fuse_results(keyword_results, semantic_results, SEMANTIC_WEIGHT, 5)
     
-    return results
+    entries = knowledge_store.get_many([knowledge_id for knowledge_id, _ in ranked])
+    results = [(knowledge_id, entries[knowledge_id]) for knowledge_id, _ in ranked if knowledge_id in entries]
+    return results if with_ids else [entry for _, entry in results]
+
+# クエリの埋め込みを計算してから知識ベースを検索する関数
+async def search_knowledge_async(query, with_ids=False):
+    query_vector = None
+    if vector_index is not None:
+        try:
+            query_vector = await asyncio.get_running_loop().run_in_executor(None, embedder.embed_query, query)
+        except Exception as e:
+            # 埋め込みに失敗した場合はキーワード検索だけを行う
+            print(f"Error computing query embedding: {e}")
+    return search_knowledge(query, query_vector, with_ids=with_ids)
 
 # 現在の日付と時間を取得する関数
 def get_current_datetime():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+# Google検索のクライアントは作成にコストがかかるため、スレッドごとに1度だけ作成して再利用する
+# （googleapiclient のサービスはスレッドセーフではないため、スレッド間では共有しない）
+_search_service_local = threading.local()
+search_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SEARCH_WORKERS", "2")), thread_name_prefix="search")
+
+# 検索結果のキャッシュ（同じクエリでAPIの呼び出し回数を消費しないようにする）
+search_cache = TTLCache(
+    maxsize=int(os.getenv("SEARCH_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("SEARCH_CACHE_TTL", "3600")),
+)
+
+def get_search_service():
+    service = getattr(_search_service_local, "service", None)
+    if service is None:
+        service = build("customsearch", "v1", developerKey=GOOGLE_API_KEY, cache_discovery=False)
+        _search_service_local.service = service
+    return service
+
+# 検索クエリを正規化する関数（キャッシュのキーに使う）
+def normalize_search_query(query):
+    return " ".join(query.casefold().split())
+
+def _google_search_sync(query, num_results):
+    service = get_search_service()
+    result = service.cse().list(q=query, cx=GOOGLE_CSE_ID, num=num_results).execute()
+    
+    search_results = []
+    if "items" in result:
+        for item in result["items"]:
+            # HTMLタグを除去してスニペットをクリーンアップ
+            snippet = html.unescape(item.get("snippet", ""))
+            
+            search_results.append({
+                "title": item.get("title", ""),
+                "link": item.get("link", ""),
+                "snippet": snippet
+            })
+    
+    return search_results
+
+# 同じURL・検索クエリ・回答の同時リクエストを1つにまとめる
+fetch_flight = SingleFlight()
+search_flight = SingleFlight()
+completion_flight = SingleFlight()
+
 # Google検索を実行する関数
-def google_search(query, num_results=5):
+@metrics.timed("google_search")
+async def google_search(query, num_results=5):
     """
     Google Custom Search APIを使用してウェブ検索を実行する
     
@@ -342,29 +993,30 @@ def google_search(query, num_results=5):
     if not ENABLE_WEB_SEARCH:
         return {"error": "Web search is not enabled. Set GOOGLE_API_KEY and GOOGLE_CSE_ID in .env file."}
     
+    # キャッシュにあればAPIを呼ばずに返す（search_cache.hits が節約したAPI呼び出しの回数）
+    cache_key = (normalize_search_query(query), num_results)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    # 同じクエリの検索が実行中ならその結果を待つ
+    results, _ = await search_flight.do(cache_key, lambda: _google_search(query, num_results, cache_key))
+    return results
+
+async def _google_search(query, num_results, cache_key):
     try:
-        service = build("customsearch", "v1", developerKey=GOOGLE_API_KEY)
-        result = service.cse().list(q=query, cx=GOOGLE_CSE_ID, num=num_results).execute()
-        
-        search_results = []
-        if "items" in result:
-            for item in result["items"]:
-                # HTMLタグを除去してスニペットをクリーンアップ
-                snippet = html.unescape(item.get("snippet", ""))
-                
-                search_results.append({
-                    "title": item.get("title", ""),
-                    "link": item.get("link", ""),
-                    "snippet": snippet
-                })
-        
+        # APIの呼び出しは同期的なので専用のスレッドで実行する
+        loop = asyncio.get_running_loop()
+        search_results = await loop.run_in_executor(search_executor, _google_search_sync, query, num_results)
+        search_cache.put(cache_key, search_results)
         return search_results
     except Exception as e:
         print(f"Google Search API error: {e}")
         return {"error": f"検索中にエラーが発生しました: {str(e)}"}
 
 # URLからコンテンツを取得する関数
-def extract_content_from_url(url, max_length=8000):
+@metrics.timed("extract_content_from_url")
+async def extract_content_from_url(url, max_length=8000):
     """
     指定されたURLからコンテンツを取得し、テキストとして返す
     
@@ -375,50 +1027,60 @@ def extract_content_from_url(url, max_length=8000):
     Returns:
         dict: 取得結果。成功した場合は title, content, url を含む。失敗した場合は error を含む。
     """
+    # 同じURLの取得が実行中ならその結果を待つ
+    try:
+        key = (max_length, normalize_url(url))
+    except ValueError:
+        key = (max_length, url)
+    result, shared = await fetch_flight.do(key, lambda: _extract_content_from_url(url, max_length))
+    if shared and "url" in result:
+        # 表記の異なるURLでまとめられた場合でも、呼び出し元が指定したURLを返す
+        result = dict(result, url=url)
+    return result
+
+async def _extract_content_from_url(url, max_length):
     try:
         # URLが有効かチェック
         if not url.startswith(('http://', 'https://')):
             return {"error": "無効なURLです。URLはhttp://またはhttps://で始まる必要があります。"}
         
-        # リクエストを送信
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()  # エラーがあれば例外を発生
+        # キャッシュが新しければそのまま返す
+        cache_key = f"{max_length}:{normalize_url(url)}"
+        cached, fresh = page_cache.lookup(cache_key)
+        if fresh:
+            return {"title": cached["title"], "content": cached["content"], "url": url}
+        
+        # 共有のHTTPセッションでリクエストを送信（古いキャッシュがあれば条件付きリクエスト）
+        headers = page_cache.conditional_headers(cached) if cached is not None else None
+        response = await http_client.fetch(url, headers=headers)
+        if response.status == 304 and cached is not None:
+            # 変更されていないので、ダウンロードとパースを省略する
+            page_cache.mark_revalidated(cache_key)
+            return {"title": cached["title"], "content": cached["content"], "url": url}
+        if response.status >= 400:
+            return {"error": f"URLからのコンテンツ取得中にエラーが発生しました: HTTP {response.status}"}
         
         # コンテンツタイプをチェック
         content_type = response.headers.get('Content-Type', '').lower()
         if 'text/html' not in content_type and 'application/xhtml+xml' not in content_type:
             return {"error": "このURLはHTMLページではありません。現在はHTMLページのみサポートしています。"}
         
-        # BeautifulSoupでHTMLをパース
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        # タイトルを取得
-        title = soup.title.string if soup.title else "タイトルなし"
-        
-        # 不要なタグを削除
-        for tag in soup(['script', 'style', 'head', 'header', 'footer', 'nav', 'aside']):
-            tag.decompose()
-        
-        # テキストを取得
-        text = soup.get_text(separator=' ', strip=True)
-        
-        # 余分な空白を削除
-        text = re.sub(r'\s+', ' ', text).strip()
-        
-        # 最大長に制限
-        if len(text) > max_length:
-            text = text[:max_length] + "...(省略)"
+        # パースはイベントループを止めないようにスレッドで行う
+        loop = asyncio.get_running_loop()
+        title, text = await loop.run_in_executor(None, parse_html, response.body, max_length)
+        page_cache.put(
+            cache_key, title, text,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+        )
         
         return {
             "title": title,
             "content": text,
             "url": url
         }
-    except requests.exceptions.RequestException as e:
-        return {"error": f"URLからのコンテンツ取得中にエラーが発生しました: {str(e)}"}
+    except FETCH_ERRORS as e:
+        return {"error": f"URLからのコンテンツ取得中にエラーが発生しました: {str(e) or type(e).__name__}"}
     except Exception as e:
         return {"error": f"予期しないエラーが発生しました: {str(e)}"}
 
@@ -434,12 +1096,37 @@ def add_aliases(command_name):
         return func
     return decorator
 
+embedding_backfill_task = None
+session_expiry_task = None
+message_index_task = None
+scheduler_stats_task = None
+
 @bot.event
 async def on_ready():
     print(f'{bot.user} has connected to Discord!')
     print(f'Bot is ready to use!')
-    # Load conversation history when bot starts
-    load_conversation_history()
+    if SHARDED:
+        print(shard_summary())
+    
+    # 埋め込みが無いエントリがあればバックグラウンドで計算する
+    global embedding_backfill_task
+    if vector_index is not None and embedding_backfill_task is None:
+        embedding_backfill_task = asyncio.create_task(backfill_embeddings())
+    
+    # 使われていないチャットセッションを定期的に破棄する
+    global session_expiry_task
+    if session_expiry_task is None:
+        session_expiry_task = asyncio.create_task(expire_chat_sessions())
+    
+    # モデル呼び出しの待ち状況を定期的に記録する
+    global scheduler_stats_task
+    if scheduler_stats_task is None:
+        scheduler_stats_task = asyncio.create_task(report_scheduler_stats())
+    
+    # チャンネルの過去のメッセージをインデックスに取り込み、保存期間を過ぎたものを削除する
+    global message_index_task
+    if message_index is not None and message_index_task is None:
+        message_index_task = asyncio.create_task(maintain_message_index())
     
     # エイリアス情報をログに出力
     print("\nコマンドエイリアス一覧:")
@@ -447,6 +1134,13 @@ async def on_ready():
         print(f"  !{cmd} -> {', '.join(['!' + alias for alias in aliases])}")
     print("\n")
 
+@bot.event
+async def on_guild_join(guild):
+    print(f"Joined guild {guild.name} ({guild.id})")
+    # 起動後に参加したサーバーのメッセージも過去の分から取り込む
+    if message_index is not None:
+        start_backfill(guild.text_channels)
+
 @bot.command(name="commands")
 @add_aliases("commands")
 async def commands_help(ctx):
@@ -468,10 +1162,11 @@ async def commands_help(ctx):
     **検索コマンド**
     `!search_messages <検索キーワード>` - チャンネル内のメッセージを検索する (エイリアス: `!sm`, `!メッセージ検索`)
     `!search_history <検索キーワード>` - あなたの会話履歴を検索する (エイリアス: `!sh`, `!履歴検索`)
+      `since:YYYY-MM-DD` `until:YYYY-MM-DD` で期間を、`page:N` でページを指定できます
     `!search_all <検索キーワード>` - チャンネルと会話履歴の両方を検索する (エイリアス: `!sa`, `!全検索`)
     
     **ファイルと画像関連**
-    `!learn_file` - 添付ファイルから学習する（PDFまたはテキストファイル） (エイリアス: `!lf`, `!ファイル学習`)
+    `!learn_file` - 添付ファイルから学習する（PDF、テキスト、Markdown、HTML、CSV、DOCX） (エイリアス: `!lf`, `!ファイル学習`)
     `!analyze_image [URL] [プロンプト]` - 画像を分析する。URLの代わりに画像を直接添付することも可能 (エイリアス: `!ai`, `!image`, `!画像`, `!画像分析`)
     
     **管理者コマンド**
@@ -492,69 +1187,80 @@ async def ask(ctx, *, question=None):
         try:
             user_id = str(ctx.author.id)
             
-            # Add user message to history
-            add_to_history(user_id, "user", question, ctx.author.name, getattr(ctx.author, 'nick', None) or ctx.author.name)
-            
-            # Search for related knowledge
-            related_knowledge = search_knowledge(question)
-            
-            # Format prompt with related knowledge only if relevant knowledge is found
-            current_datetime = get_current_datetime()
-            user_name = ctx.author.name
-            user_nickname = getattr(ctx.author, 'nick', None) or ctx.author.name
+            # 順番が来るまで待つ（待たされる場合は順番待ちの位置を表示し、そのメッセージを回答で上書きする）
+            async with model_slot(ctx) as queued_message:
+                # 同じユーザーの並行リクエストで履歴やセッションが混ざらないようにロックする
+                async with gemini.user_lock(user_id):
+                    # Add user message to history
+                    add_to_history(user_id, "user", question, ctx.author.name, getattr(ctx.author, 'nick', None) or ctx.author.name)
             
-            if related_knowledge:
-                context = "\n\n".join([f"{item['content']}" for item in related_knowledge])
-                base_prompt = f"{AI_PERSONALITY}\n\n現在の日時: {current_datetime}\n\n話しかけているユーザー: {user_name} (ニックネーム: {user_nickname})\n\n以下は質問に関連する情報です：\n\n{context}\n\n上記の情報を参考にしながら、以下の質問に回答してください。ただし、情報が不足していても、一般的な知識に基づいて回答し、「その情報はありません」などの否定的な言及はしないでください: {question}"
-            else:
-                # No related knowledge found, just use the question directly without mentioning knowledge base
-                base_prompt = f"{AI_PERSONALITY}\n\n現在の日時: {current_datetime}\n\n話しかけているユーザー: {user_name} (ニックネーム: {user_nickname})\n\n{question} この質問に回答してください。"
+                    # Search for related knowledge
+                    related_results = await search_knowledge_async(question, with_ids=True)
+                    related_knowledge = [entry for _, entry in related_results]
+                
+                    # 同じ質問への回答がキャッシュにあればそれを返す
+                    cache_key = answer_cache_key(ctx, user_id, question, related_results)
+                    # shared モードの回答は他のユーザーにも返すので、ユーザー名や会話履歴を使わずに生成する
+                    shared_answer = cache_key is not None and ANSWER_CACHE_MODE == "shared"
+                    cached_text = answer_cache.get(cache_key) if cache_key is not None else None
+                    if cached_text is not None:
+                        stats = answer_cache.stats()
+                        print(f"Answer cache hit (hit ratio {stats['hit_ratio']:.1%}, {stats['entries']} entries)")
+                        await send_long_message(ctx, cached_text, first_message=queued_message)
+                        add_to_history(user_id, "bot", cached_text, ctx.author.name, getattr(ctx.author, 'nick', None) or ctx.author.name)
+                        # チャットセッションにはこのやり取りが無いので、次回は会話履歴から作り直す
+                        chat_sessions.discard(user_id)
+                        return
             
-            # 会話履歴を含めたプロンプトを作成
-            if user_id in conversation_history and len(conversation_history[user_id]) > 2:
-                # 直近の会話を取得（最大10往復）
-                recent_history = conversation_history[user_id][-10:-1]  # 最新のユーザーメッセージを除く
-                history_text_parts = []
+                    # トークン数の上限内でプロンプトを組み立てる
+                    # 予算が足りない場合は順位の低い知識から切り詰め・削除する
+                    current_datetime = get_current_datetime()
+                    user_name = ctx.author.name
+                    user_nickname = getattr(ctx.author, 'nick', None) or ctx.author.name
                 
-                for msg in recent_history:
-                    # 古い形式の会話履歴に対応（username/nicknameフィールドがない場合）
-                    username = msg.get("username", "ユーザー")
-                    nickname = msg.get("nickname", username)
-                    
-                    if msg["role"] == "user":
-                        prefix = f"ユーザー ({username} / {nickname})"
-                    else:
-                        prefix = "アシスタント"
-                        
-                    history_text_parts.append(f"{prefix}: {msg['content']}")
+                    builder = PromptBuilder(PROMPT_TOKEN_BUDGET, token_estimator)
+                    builder.add(AI_PERSONALITY)
+                    builder.add(f"現在の日時: {current_datetime}")
+                    if not shared_answer:
+                        builder.add(f"話しかけているユーザー: {user_name} (ニックネーム: {user_nickname})")
                 
-                history_text = "\n\n".join(history_text_parts)
-                prompt_with_history = f"{base_prompt}\n\n以下は最近の会話履歴です。これを参考にして回答してください：\n\n{history_text}"
-            else:
-                prompt_with_history = base_prompt
-            
-            # Generate response using the model directly
-            chat = start_gemini_chat(user_id)
-            response = chat.send_message(prompt_with_history)
-            
-            # Get response text safely
-            response_text = ""
-            try:
-                response_text = response.text
-            except Exception as e:
-                response_text = f"エラーが発生しました: {str(e)}"
+                    # Include related knowledge only if relevant knowledge is found
+                    knowledge_section = builder.section(
+                        header="以下は質問に関連する情報です：",
+                        footer=f"上記の情報を参考にしながら、以下の質問に回答してください。ただし、情報が不足していても、一般的な知識に基づいて回答し、「その情報はありません」などの否定的な言及はしないでください: {question}",
+                        # No related knowledge found, just use the question directly without mentioning knowledge base
+                        empty_text=f"{question} この質問に回答してください。",
+                    )
+                    for rank, item in enumerate(related_knowledge):
+                        knowledge_section.add(item['content'], priority=100 - 10 * rank, truncatable=True)
+                
+                    # 会話履歴はチャットセッション（build_chat_history で作成）に含まれているので、
+                    # プロンプトには入れない（shared モードでは会話履歴を使わない）
+                    prompt = build_prompt(builder, "ask")
             
-            # Add bot response to history
-            add_to_history(user_id, "bot", response_text, ctx.author.name, getattr(ctx.author, 'nick', None) or ctx.author.name)
+                    # Generate and send the response without blocking the event loop
+                    if cache_key is None:
+                        response_text = await generate_and_send(ctx, user_id, prompt, first_message=queued_message)
+                    else:
+                        # キャッシュできる回答は、同じ質問が同時に来た場合に1回だけ生成する
+                        response_text, shared = await completion_flight.do(
+                            cache_key, lambda: generate_and_send(
+                                ctx, user_id, prompt, first_message=queued_message, stateless=shared_answer
+                            )
+                        )
+                        if shared:
+                            await send_long_message(ctx, response_text, first_message=queued_message)
+                        elif response_text.strip() and not response_text.startswith("エラーが発生しました"):
+                            answer_cache.put(cache_key, response_text)
+                        if shared or shared_answer:
+                            # チャットセッションを使わずに生成した回答なので、次回は会話履歴から作り直す
+                            chat_sessions.discard(user_id)
             
-            # Send response
-            if len(response_text) > 2000:
-                # Split into chunks of 2000 characters
-                chunks = [response_text[i:i+2000] for i in range(0, len(response_text), 2000)]
-                for chunk in chunks:
-                    await ctx.send(chunk)
-            else:
-                await ctx.send(response_text)
+                    # Add bot response to history（空の応答は追加しない）
+                    if response_text.strip():
+                        add_to_history(user_id, "bot", response_text, ctx.author.name, getattr(ctx.author, 'nick', None) or ctx.author.name)
+        except Rejected as e:
+            await ctx.send(rejection_message(e))
         except Exception as e:
             await ctx.send(f"エラーが発生しました: {str(e)}")
 
@@ -567,7 +1273,11 @@ async def learn(ctx, *, information=None):
         return
         
     user_id = str(ctx.author.id)
-    add_knowledge(information, user_id)
+    knowledge_id = add_knowledge(information, user_id)
+    if knowledge_id is None:
+        await ctx.send("その情報は既に学習済みです。")
+        return
+    await add_embeddings([(knowledge_id, information)])
     await ctx.send(f"ありがとうございます！新しい知識を学習しました。")
 
 @bot.command(name="search")
@@ -578,7 +1288,7 @@ async def search(ctx, *, query=None):
         await ctx.send("使用方法: `!search <キーワード>`")
         return
     
-    results = search_knowledge(query)
+    results = await search_knowledge_async(query)
     
     if results:
         response = f"「{query}」に関連する情報が見つかりました:\n\n"
@@ -595,14 +1305,19 @@ async def search(ctx, *, query=None):
 async def forget(ctx):
     """Forget conversation history with this user"""
     user_id = str(ctx.author.id)
-    if user_id in conversation_history:
-        del conversation_history[user_id]
-        save_conversation_history()
-        
-        # チャットセッションもリセット
-        if user_id in chat_sessions:
-            del chat_sessions[user_id]
+    async with gemini.user_lock(user_id):
+        if user_id in conversation_history:
+            history_journal.clear_user(user_id)
+            history_index.clear_user(user_id)
+            publish_invalidation("history", user_id)
             
+            # チャットセッションもリセット
+            chat_sessions.discard(user_id)
+            forgotten = True
+        else:
+            forgotten = False
+    
+    if forgotten:
         await ctx.send("会話履歴を忘れました。")
     else:
         await ctx.send("あなたとの会話履歴はありません。")
@@ -616,9 +1331,12 @@ async def forget_all(ctx):
         await ctx.send("この操作は管理者のみ実行できます。")
         return
         
-    global knowledge_base
-    knowledge_base = {}
-    save_knowledge_base()
+    knowledge_store.clear()
+    if vector_index is not None:
+        vector_index.clear()
+        if shared_vectors is not None:
+            shared_vectors.clear()
+    publish_invalidation("knowledge_cleared")
     await ctx.send("すべての知識を忘れました。")
 
 @bot.command(name="forget_topic")
@@ -629,11 +1347,12 @@ async def forget_topic(ctx, *, topic=None):
         await ctx.send("使用方法: `!forget_topic <トピック>`")
         return
         
-    global knowledge_base
-    
-    if topic in knowledge_base:
-        del knowledge_base[topic]
-        save_knowledge_base()
+    if knowledge_store.delete(topic):
+        if vector_index is not None:
+            vector_index.remove(topic)
+            if shared_vectors is not None:
+                shared_vectors.delete([topic])
+        publish_invalidation("knowledge_removed", topic)
         await ctx.send(f"「{topic}」に関する知識を忘れました。")
     else:
         await ctx.send(f"「{topic}」に関する知識は見つかりませんでした。")
@@ -656,7 +1375,7 @@ async def search_web(ctx, *, query=None):
             processing_msg = await ctx.send("ウェブ検索を実行中です...")
             
             # Google検索を実行
-            search_results = google_search(query)
+            search_results = await google_search(query)
             
             if isinstance(search_results, dict) and "error" in search_results:
                 await processing_msg.edit(content=f"エラー: {search_results['error']}")
@@ -685,32 +1404,30 @@ async def search_web(ctx, *, query=None):
             # 結果を送信
             await processing_msg.edit(content=None, embed=embed)
             
-            # 検索結果をAIに送信して回答を生成
-            result_text = "\n\n".join([f"タイトル: {r['title']}\n内容: {r['snippet']}\nURL: {r['link']}" for r in search_results])
+            # 検索結果をAIに送信して回答を生成（上位の結果を優先してトークン数の上限内に収める）
+            builder = PromptBuilder(PROMPT_TOKEN_BUDGET, token_estimator)
+            builder.add(AI_PERSONALITY)
+            builder.add(f"現在の日時: {get_current_datetime()}")
+            builder.add(f"話しかけているユーザー: {ctx.author.name}")
+            result_section = builder.section(header="以下はウェブ検索の結果です：")
+            for rank, r in enumerate(search_results):
+                result_section.add(f"タイトル: {r['title']}\n内容: {r['snippet']}\nURL: {r['link']}", priority=-rank, truncatable=True)
+            builder.add(f"上記の検索結果を参考にして、次の質問に回答してください: {query}")
+            prompt = build_prompt(builder, "search_web")
             
-            prompt = f"{AI_PERSONALITY}\n\n現在の日時: {get_current_datetime()}\n\n話しかけているユーザー: {ctx.author.name}\n\n以下はウェブ検索の結果です：\n\n{result_text}\n\n上記の検索結果を参考にして、次の質問に回答してください: {query}"
-            
-            # Geminiで回答を生成
+            # Geminiで回答を生成（検索結果の表示は残し、順番待ちは別のメッセージで知らせる）
             user_id = str(ctx.author.id)
-            chat = start_gemini_chat(user_id)
-            response = chat.send_message(prompt)
-            
-            # 回答を送信
-            response_text = response.text
-            
-            # 回答が長い場合は分割して送信
-            if len(response_text) > 2000:
-                # Split into chunks of 2000 characters
-                chunks = textwrap.wrap(response_text, width=2000, replace_whitespace=False, drop_whitespace=False)
-                for chunk in chunks:
-                    await ctx.send(chunk)
-            else:
-                await ctx.send(response_text)
-            
-            # 会話履歴に追加
-            add_to_history(user_id, "user", f"ウェブ検索: {query}", ctx.author.name, getattr(ctx.author, 'nick', None) or ctx.author.name)
-            add_to_history(user_id, "bot", response_text, ctx.author.name, getattr(ctx.author, 'nick', None) or ctx.author.name)
+            async with model_slot(ctx) as queued_message, gemini.user_lock(user_id):
+                # 回答を生成して送信（長い場合は自然な区切りで分割）
+                response_text = await generate_and_send(ctx, user_id, prompt, first_message=queued_message)
+                
+                # 会話履歴に追加（空の応答は追加しない）
+                if response_text.strip():
+                    add_to_history(user_id, "user", f"ウェブ検索: {query}", ctx.author.name, getattr(ctx.author, 'nick', None) or ctx.author.name)
+                    add_to_history(user_id, "bot", response_text, ctx.author.name, getattr(ctx.author, 'nick', None) or ctx.author.name)
             
+        except Rejected as e:
+            await ctx.send(rejection_message(e))
         except Exception as e:
             await ctx.send(f"エラーが発生しました: {str(e)}")
 
@@ -728,7 +1445,7 @@ async def learn_url(ctx, *, url=None):
             processing_msg = await ctx.send("URLからコンテンツを取得中です...")
             
             # URLからコンテンツを取得
-            result = extract_content_from_url(url)
+            result = await extract_content_from_url(url)
             
             if "error" in result:
                 await processing_msg.edit(content=f"エラー: {result['error']}")
@@ -743,7 +1460,11 @@ async def learn_url(ctx, *, url=None):
             
             # 知識ベースに追加
             user_id = str(ctx.author.id)
-            add_knowledge(knowledge_content, user_id)
+            knowledge_id = add_knowledge(knowledge_content, user_id, title=title)
+            if knowledge_id is None:
+                await processing_msg.edit(content=f"「{title}」のコンテンツは既に学習済みです。")
+                return
+            await add_embeddings([(knowledge_id, knowledge_content)])
             
             # 成功メッセージを送信
             await processing_msg.edit(content=f"「{title}」のコンテンツを学習しました。このURLの内容について質問できるようになりました。")
@@ -765,7 +1486,7 @@ async def ask_url(ctx, url=None, *, question=None):
             processing_msg = await ctx.send("URLからコンテンツを取得中です...")
             
             # URLからコンテンツを取得
-            result = extract_content_from_url(url)
+            result = await extract_content_from_url(url)
             
             if "error" in result:
                 await processing_msg.edit(content=f"エラー: {result['error']}")
@@ -780,30 +1501,28 @@ async def ask_url(ctx, url=None, *, question=None):
             
             # AIに質問を送信
             user_id = str(ctx.author.id)
-            prompt = f"{AI_PERSONALITY}\n\n現在の日時: {get_current_datetime()}\n\n話しかけているユーザー: {ctx.author.name}\n\n以下はウェブページの内容です：\n\nタイトル: {title}\nURL: {url}\n\n内容: {content}\n\n上記のウェブページの内容に基づいて、次の質問に回答してください: {question}"
+            # ページの内容はトークン数の上限に合わせて切り詰める
+            builder = PromptBuilder(PROMPT_TOKEN_BUDGET, token_estimator)
+            builder.add(AI_PERSONALITY)
+            builder.add(f"現在の日時: {get_current_datetime()}")
+            builder.add(f"話しかけているユーザー: {ctx.author.name}")
+            builder.add(f"以下はウェブページの内容です：\n\nタイトル: {title}\nURL: {url}")
+            builder.add(f"内容: {content}", required=False, truncatable=True)
+            builder.add(f"上記のウェブページの内容に基づいて、次の質問に回答してください: {question}")
+            prompt = build_prompt(builder, "ask_url")
             
             # Geminiで回答を生成
-            chat = start_gemini_chat(user_id)
-            response = chat.send_message(prompt)
-            
-            # 回答を送信
-            response_text = response.text
-            
-            # 処理中メッセージを削除
-            await processing_msg.delete()
-            
-            # 回答が長い場合は分割して送信
-            if len(response_text) > 2000:
-                chunks = textwrap.wrap(response_text, width=2000, replace_whitespace=False, drop_whitespace=False)
-                for chunk in chunks:
-                    await ctx.send(chunk)
-            else:
-                await ctx.send(response_text)
-            
-            # 会話履歴に追加
-            add_to_history(user_id, "user", f"URL「{title}」について質問: {question}", ctx.author.name, getattr(ctx.author, 'nick', None) or ctx.author.name)
-            add_to_history(user_id, "bot", response_text, ctx.author.name, getattr(ctx.author, 'nick', None) or ctx.author.name)
+            async with model_slot(ctx, processing_msg), gemini.user_lock(user_id):
+                # 処理中メッセージを回答で上書きして送信（長い場合は自然な区切りで分割）
+                response_text = await generate_and_send(ctx, user_id, prompt, first_message=processing_msg)
+                
+                # 会話履歴に追加（空の応答は追加しない）
+                if response_text.strip():
+                    add_to_history(user_id, "user", f"URL「{title}」について質問: {question}", ctx.author.name, getattr(ctx.author, 'nick', None) or ctx.author.name)
+                    add_to_history(user_id, "bot", response_text, ctx.author.name, getattr(ctx.author, 'nick', None) or ctx.author.name)
             
+        except Rejected as e:
+            await processing_msg.edit(content=rejection_message(e))
         except Exception as e:
             await ctx.send(f"エラーが発生しました: {str(e)}")
 
@@ -811,36 +1530,56 @@ async def ask_url(ctx, url=None, *, question=None):
 @add_aliases("learn_file")
 async def learn_file(ctx):
     """ファイルから学習する"""
+    supported = ", ".join(extension[1:].upper() for extension in supported_extensions())
     if not ctx.message.attachments:
-        await ctx.send("ファイルを添付してください。サポートされている形式: PDF, TXT")
+        await ctx.send(f"ファイルを添付してください。サポートされている形式: {supported}")
         return
     
     # 処理中のメッセージを送信
     processing_msg = await ctx.send("ファイルを処理中です...")
     
-    results = []
+    # ファイルごとの進捗（添付ファイルの順に表示する）
+    statuses = {attachment.id: f"{attachment.filename}: 待機中..." for attachment in ctx.message.attachments}
+    last_update = 0.0
     
-    # 全ての添付ファイルを処理
-    for attachment in ctx.message.attachments:
-        file_extension = os.path.splitext(attachment.filename)[1].lower()
-        
-        if file_extension not in ['.pdf', '.txt']:
-            results.append(f"{attachment.filename}: サポートされていないファイル形式です。PDFまたはTXTファイルを添付してください。")
-            continue
-        
-        # 一時ファイルとして保存
-        temp_file_path = f"temp_{attachment.filename}"
-        await attachment.save(temp_file_path)
+    async def update_progress(force=False):
+        nonlocal last_update
+        # メッセージの編集はレート制限があるため、最後の更新から2秒以上経った場合だけ行う
+        now = asyncio.get_running_loop().time()
+        if not force and now - last_update < 2.0:
+            return
+        last_update = now
+        await send_long_message(ctx, "\n\n".join(statuses.values()), first_message=processing_msg)
+    
+    async def process(attachment):
+        if get_extractor(attachment.filename) is None:
+            statuses[attachment.id] = f"{attachment.filename}: サポートされていないファイル形式です。{supported} ファイルを添付してください。"
+            return
         
-        # ファイルから学習
-        result = await learn_from_file(temp_file_path, str(ctx.author.id))
-        results.append(f"{attachment.filename}: {result}")
+        # ダウンロードする前にサイズを確認する
+        if attachment.size > LEARN_FILE_MAX_MB * 1024 * 1024:
+            statuses[attachment.id] = f"{attachment.filename}: ファイルが大きすぎます（最大 {LEARN_FILE_MAX_MB:g} MB）。"
+            return
         
-        # 一時ファイルを削除
-        os.remove(temp_file_path)
+        try:
+            # 一時ファイルに保存せず、メモリ上で処理する
+            data = await attachment.read()
+            
+            async def progress(page_number, total_pages):
+                statuses[attachment.id] = f"{attachment.filename}: 処理中... ({page_number}/{total_pages} ページ)"
+                await update_progress()
+            
+            # ファイルから学習
+            result = await learn_from_file(attachment.filename, data, str(ctx.author.id), progress=progress)
+            statuses[attachment.id] = f"{attachment.filename}: {result}"
+        except Exception as e:
+            statuses[attachment.id] = f"{attachment.filename}: ファイルの処理中にエラーが発生しました: {str(e)}"
+    
+    # 全ての添付ファイルを並行して処理
+    await asyncio.gather(*(process(attachment) for attachment in ctx.message.attachments))
     
     # 結果を送信
-    await processing_msg.edit(content="\n\n".join(results))
+    await update_progress(force=True)
 
 @bot.command(name="search_messages")
 @add_aliases("search_messages")
@@ -854,12 +1593,8 @@ async def search_messages(ctx, *, query=None):
         # 処理中のメッセージを送信
         processing_msg = await ctx.send(f"「{query}」を含むメッセージを検索中...")
         
-        # メッセージを検索（デフォルトで100件まで）
-        messages = []
-        async for msg in ctx.channel.history(limit=100):
-            messages.append(msg)
-        
-        results = [msg for msg in messages if query.lower() in msg.content.lower()]
+        # メッセージを検索（インデックスがあれば保存期間内の全てのメッセージから探す）
+        results, total = await find_channel_messages(ctx.channel, query, limit=10)
         
         if not results:
             await processing_msg.edit(content=f"「{query}」を含むメッセージは見つかりませんでした。")
@@ -867,14 +1602,13 @@ async def search_messages(ctx, *, query=None):
         
         # 検索結果を埋め込みメッセージとして表示
         embed = discord.Embed(
-            title=f"「{query}」の検索結果 ({len(results)}件)",
+            title=f"「{query}」の検索結果 ({total}件)",
             color=discord.Color.green(),
             timestamp=datetime.datetime.now()
         )
         
         # 最大10件まで表示
-        display_count = min(10, len(results))
-        for i, msg in enumerate(results[:display_count], 1):
+        for i, msg in enumerate(results, 1):
             # メッセージの内容を短く切り詰める（最大100文字）
             content = msg.content
             if len(content) > 100:
@@ -884,58 +1618,89 @@ async def search_messages(ctx, *, query=None):
             timestamp = msg.created_at.strftime("%Y/%m/%d %H:%M")
             
             embed.add_field(
-                name=f"{i}. {msg.author.name} ({timestamp})",
+                name=f"{i}. {msg.author_name} ({timestamp})",
                 value=content,
                 inline=False
             )
         
-        if len(results) > 10:
-            embed.set_footer(text=f"他 {len(results) - 10} 件の結果があります。より詳細な検索には !search_history コマンドをお使いください。")
+        if total > 10:
+            embed.set_footer(text=f"他 {total - 10} 件の結果があります。より詳細な検索には !search_history コマンドをお使いください。")
         
         await processing_msg.edit(content=None, embed=embed)
         
     except Exception as e:
         await ctx.send(f"検索中にエラーが発生しました: {str(e)}")
 
+# 検索クエリから日付とページの指定を取り出す関数
+def parse_history_query(query):
+    """「since:YYYY-MM-DD」「until:YYYY-MM-DD」「page:N」を取り出し、残りを検索語として返す
+
+    Returns:
+        tuple: (検索語, since, until, ページ番号)
+
+    Raises:
+        ValueError: 日付やページ番号の形式が正しくない場合
+    """
+    terms = []
+    since = until = None
+    page = 1
+    for word in query.split():
+        key, _, value = word.partition(":")
+        key = key.lower()
+        if key in ("since", "until") and value:
+            datetime.date.fromisoformat(value)
+            if key == "since":
+                since = value
+            else:
+                until = value
+        elif key == "page" and value:
+            page = int(value)
+            if page < 1:
+                raise ValueError("page must be 1 or greater")
+        else:
+            terms.append(word)
+    return " ".join(terms), since, until, page
+
 @bot.command(name="search_history")
 @add_aliases("search_history")
 async def search_history(ctx, *, query=None):
     """会話履歴から検索する"""
     if query is None:
-        await ctx.send("使用方法: `!search_history <検索キーワード>`")
+        await ctx.send("使用方法: `!search_history <検索キーワード> [since:YYYY-MM-DD] [until:YYYY-MM-DD] [page:N]`")
         return
     
     user_id = str(ctx.author.id)
     
     try:
-        # 処理中のメッセージを送信
-        processing_msg = await ctx.send(f"会話履歴から「{query}」を検索中...")
-        
-        # 会話履歴を読み込む
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                conversation_history = json.load(f)
-        else:
-            conversation_history = {}
-        
-        user_history = conversation_history.get(user_id, [])
-        query_lower = query.lower()
-        results = [entry for entry in user_history if query_lower in entry.get("content", "").lower()]
+        terms, since, until, page = parse_history_query(query)
+    except ValueError:
+        await ctx.send("日付は `since:2024-01-31` のように、ページは `page:2` のように指定してください。")
+        return
+    
+    try:
+        # メモリ上の索引から新しい順に検索する（ファイルは読まない）
+        page_size = 10
+        results, total = history_index.search(
+            user_id, terms, since=since, until=until, offset=(page - 1) * page_size, limit=page_size
+        )
         
         if not results:
-            await processing_msg.edit(content=f"会話履歴から「{query}」は見つかりませんでした。")
+            if total:
+                await ctx.send(f"会話履歴の「{query}」の検索結果は {total} 件で、{page} ページ目はありません。")
+            else:
+                await ctx.send(f"会話履歴から「{query}」は見つかりませんでした。")
             return
         
         # 検索結果を埋め込みメッセージとして表示
+        page_count = (total + page_size - 1) // page_size
         embed = discord.Embed(
-            title=f"会話履歴の検索結果: 「{query}」({len(results)}件)",
+            title=f"会話履歴の検索結果: 「{terms or query}」({total}件)",
             color=discord.Color.blue(),
             timestamp=datetime.datetime.now()
         )
         
-        # 最大10件まで表示
-        display_count = min(10, len(results))
-        for i, entry in enumerate(results[-display_count:], 1):  # 新しいものから表示
+        # 新しいものから最大10件まで表示
+        for i, entry in enumerate(results, (page - 1) * page_size + 1):
             # メッセージの内容を短く切り詰める（最大100文字）
             content = entry.get("content", "")
             if len(content) > 100:
@@ -951,10 +1716,12 @@ async def search_history(ctx, *, query=None):
                 inline=False
             )
         
-        if len(results) > 10:
-            embed.set_footer(text=f"他 {len(results) - 10} 件の結果があります。")
+        if page < page_count:
+            embed.set_footer(text=f"ページ {page}/{page_count}。次のページは「page:{page + 1}」を付けて検索してください。")
+        elif page_count > 1:
+            embed.set_footer(text=f"ページ {page}/{page_count}")
         
-        await processing_msg.edit(content=None, embed=embed)
+        await ctx.send(embed=embed)
         
     except Exception as e:
         await ctx.send(f"検索中にエラーが発生しました: {str(e)}")
@@ -972,22 +1739,11 @@ async def search_all(ctx, *, query=None):
         processing_msg = await ctx.send(f"「{query}」を検索中...")
         
         # チャンネル内のメッセージを検索
-        channel_results = []
-        async for msg in ctx.channel.history(limit=50):
-            if query.lower() in msg.content.lower():
-                channel_results.append(msg)
+        channel_results, channel_total = await find_channel_messages(ctx.channel, query, limit=5, scan_limit=50)
         
-        # 会話履歴を検索
+        # 会話履歴を検索（新しい順に最大5件）
         user_id = str(ctx.author.id)
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                conversation_history = json.load(f)
-        else:
-            conversation_history = {}
-        
-        user_history = conversation_history.get(user_id, [])
-        query_lower = query.lower()
-        history_results = [entry for entry in user_history if query_lower in entry.get("content", "").lower()]
+        history_results, history_total = history_index.search(user_id, query, limit=5)
         
         if not channel_results and not history_results:
             await processing_msg.edit(content=f"「{query}」を含む結果は見つかりませんでした。")
@@ -996,21 +1752,20 @@ async def search_all(ctx, *, query=None):
         # 検索結果を埋め込みメッセージとして表示
         embed = discord.Embed(
             title=f"「{query}」の検索結果",
-            description=f"チャンネル: {len(channel_results)}件, 会話履歴: {len(history_results)}件",
+            description=f"チャンネル: {channel_total}件, 会話履歴: {history_total}件",
             color=discord.Color.purple(),
             timestamp=datetime.datetime.now()
         )
         
         # チャンネルの検索結果（最大5件）
         if channel_results:
-            channel_display = min(5, len(channel_results))
             channel_text = ""
-            for i, msg in enumerate(channel_results[:channel_display], 1):
+            for i, msg in enumerate(channel_results, 1):
                 content = msg.content
                 if len(content) > 80:
                     content = content[:77] + "..."
                 timestamp = msg.created_at.strftime("%m/%d %H:%M")
-                channel_text += f"{i}. {msg.author.name} ({timestamp}): {content}\n\n"
+                channel_text += f"{i}. {msg.author_name} ({timestamp}): {content}\n\n"
             
             embed.add_field(
                 name="チャンネルのメッセージ",
@@ -1020,9 +1775,8 @@ async def search_all(ctx, *, query=None):
         
         # 会話履歴の検索結果（最大5件）
         if history_results:
-            history_display = min(5, len(history_results))
             history_text = ""
-            for i, entry in enumerate(history_results[-history_display:], 1):  # 新しいものから表示
+            for i, entry in enumerate(history_results, 1):  # 新しいものから表示
                 content = entry.get("content", "")
                 if len(content) > 80:
                     content = content[:77] + "..."
@@ -1048,6 +1802,9 @@ async def search_all(ctx, *, query=None):
 
 @bot.event
 async def on_message(message):
+    # チャンネルのメッセージ検索用のインデックスに追加する（エイリアスを置き換える前の内容）
+    index_message(message)
+    
     # Don't respond to our own messages
     if message.author == bot.user:
         return
@@ -1090,7 +1847,8 @@ async def on_message(message):
         content = content.strip()
         if content:
             ctx = await bot.get_context(message)
-            await ask(ctx, question=content)
+            with metrics.stage("mention"):
+                await ask(ctx, question=content)
 
 # 画像を分析する関数
 async def analyze_image_with_gemini(image_url, prompt=None):
@@ -1105,13 +1863,19 @@ async def analyze_image_with_gemini(image_url, prompt=None):
         str: 分析結果のテキスト
     """
     try:
-        # 画像をダウンロード
-        response = requests.get(image_url)
-        if response.status_code != 200:
-            return f"画像のダウンロードに失敗しました。ステータスコード: {response.status_code}"
+        # 画像をダウンロード（共有のHTTPセッションを使い、タイムアウトを適用）
+        try:
+            with metrics.stage("image_download"):
+                response = await http_client.fetch(image_url)
+        except FETCH_ERRORS as e:
+            return f"画像のダウンロードに失敗しました: {str(e) or type(e).__name__}"
+        if response.status != 200:
+            return f"画像のダウンロードに失敗しました。ステータスコード: {response.status}"
         
         # 画像データの取得
-        image_data = response.content
+        image_data = response.body
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        mime_type = content_type if content_type.startswith('image/') else "image/jpeg"
         
         # デフォルトのプロンプト
         if not prompt:
@@ -1122,13 +1886,14 @@ async def analyze_image_with_gemini(image_url, prompt=None):
             {
                 "parts": [
                     {"text": f"{AI_PERSONALITY}\n\n{prompt}"},
-                    {"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(image_data).decode('utf-8')}}
+                    {"inline_data": {"mime_type": mime_type, "data": base64.b64encode(image_data).decode('utf-8')}}
                 ]
             }
         ]
         
         # 画像分析を実行
-        response = model.generate_content(contents)
+        with metrics.stage("gemini_generate_content"):
+            response = await gemini.generate_content(contents)
         
         return response.text
     except Exception as e:
@@ -1150,22 +1915,177 @@ async def analyze_image(ctx, url=None, *, prompt=None):
     processing_msg = await ctx.send("画像を分析しています...")
     
     try:
-        # 画像分析を実行
-        result = await analyze_image_with_gemini(url, prompt)
-        
-        # 結果を送信
-        if len(result) > 2000:
-            # 長い結果は分割して送信
-            chunks = textwrap.wrap(result, width=2000, replace_whitespace=False, drop_whitespace=False)
-            await processing_msg.edit(content=chunks[0])
-            for chunk in chunks[1:]:
-                await ctx.send(chunk)
-        else:
-            await processing_msg.edit(content=result)
+        # 順番が来てから画像分析を実行
+        async with model_slot(ctx, processing_msg):
+            result = await analyze_image_with_gemini(url, prompt)
+        
+        # 結果を送信（長い結果は自然な区切りで分割）
+        await send_long_message(ctx, result, first_message=processing_msg)
+    except Rejected as e:
+        await processing_msg.edit(content=rejection_message(e))
     except Exception as e:
         await processing_msg.edit(content=f"エラーが発生しました: {str(e)}")
 
+# 編集・削除されたメッセージをインデックスに反映する（キャッシュに無いメッセージも対象にするため raw イベントを使う）
+@bot.event
+async def on_raw_message_edit(payload):
+    if message_index is not None and "content" in payload.data:
+        message_index.update_content(payload.message_id, payload.data["content"])
+
+@bot.event
+async def on_raw_message_delete(payload):
+    if message_index is not None:
+        message_index.delete_messages([payload.message_id])
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    if message_index is not None:
+        message_index.delete_messages(payload.message_ids)
+
+# ---- 他のワーカーでの変更の反映（シャーディングする場合のみ） ----
+
+def on_history_changed(user_id):
+    """他のワーカーで変わったユーザーの会話履歴を読み直し、古いチャットセッションを破棄する"""
+    messages = history_journal.reload_user(user_id)
+    history_index.reset_user(user_id, messages)
+    chat_sessions.discard(user_id)
+
+def on_knowledge_added(key):
+    # 重複検出のインデックスは共有のデータベースにあるので、埋め込みだけを更新する
+    # （埋め込みは最初に確保したワーカーだけが計算する。ingest.py で追加された知識も同じ）
+    if vector_index is not None:
+        entries = knowledge_store.get_many(json.loads(key))
+        asyncio.create_task(add_embeddings([(knowledge_id, entry["content"]) for knowledge_id, entry in entries.items()]))
+
+def on_embeddings_added(key):
+    """他のワーカーが計算したベクトルを読み込む"""
+    if vector_index is None:
+        return
+    knowledge_ids, vectors = shared_vectors.get_many(json.loads(key))
+    vector_index.add(knowledge_ids, vectors)
+
+def on_knowledge_removed(knowledge_id):
+    if vector_index is not None:
+        vector_index.remove(knowledge_id)
+        # ingest.py で削除された知識は共有のベクトルも残っているので削除する（削除済みなら何もしない）
+        shared_vectors.delete([knowledge_id])
+
+def on_knowledge_cleared(_):
+    if vector_index is not None:
+        vector_index.clear()
+
+if invalidation_bus is not None:
+    invalidation_bus.subscribe("history", on_history_changed)
+    invalidation_bus.subscribe("knowledge_added", on_knowledge_added)
+    invalidation_bus.subscribe("embeddings_added", on_embeddings_added)
+    invalidation_bus.subscribe("knowledge_removed", on_knowledge_removed)
+    invalidation_bus.subscribe("knowledge_cleared", on_knowledge_cleared)
+
+# ---- シャードの状態の記録 ----
+
+def shard_summary():
+    """このワーカーが担当するシャードとサーバー数を表す文字列"""
+    guild_counts = defaultdict(int)
+    for guild in bot.guilds:
+        guild_counts[guild.shard_id] += 1
+    shards = ", ".join(f"{shard_id} ({guild_counts[shard_id]} guilds)" for shard_id in sorted(bot.shards))
+    return f"Worker {WORKER_ID} (pid {os.getpid()}) owns shards {shards} of {bot.shard_count}"
+
+if SHARDED:
+    @bot.event
+    async def on_shard_ready(shard_id):
+        print(f"Shard {shard_id} is ready on worker {WORKER_ID}")
+
+    @bot.event
+    async def on_shard_disconnect(shard_id):
+        print(f"Shard {shard_id} disconnected on worker {WORKER_ID}")
+
+    @bot.event
+    async def on_shard_resumed(shard_id):
+        print(f"Shard {shard_id} resumed on worker {WORKER_ID}")
+
+# 計測値の登録（無効の場合は何もしない）
+if METRICS_ENABLED:
+    @bot.before_invoke
+    async def start_command_timer(ctx):
+        ctx.metrics_started = time.perf_counter()
+
+    @bot.after_invoke
+    async def record_command_time(ctx):
+        started = getattr(ctx, "metrics_started", None)
+        if started is not None:
+            metrics.observe_command(ctx.command.qualified_name, time.perf_counter() - started, ctx.command_failed)
+
+    metrics.callback("knowledge_entries", "知識ベースのエントリ数",
+                     lambda: len(knowledge_store) if knowledge_store is not None else None)
+    metrics.callback("history_users", "会話履歴があるユーザー数", lambda: len(conversation_history))
+    metrics.callback("history_messages", "会話履歴のメッセージ数",
+                     lambda: sum(len(messages) for messages in conversation_history.values()))
+    metrics.callback("chat_sessions", "メモリ上のチャットセッション数", lambda: chat_sessions.stats()["sessions"])
+    metrics.callback("scheduler_queue_depth", "モデル呼び出しの順番待ちの数", lambda: scheduler.stats()["queued"])
+    metrics.callback("scheduler_running", "実行中のモデル呼び出しの数", lambda: scheduler.stats()["running"])
+    metrics.callback("scheduler_wait_seconds", "直近のモデル呼び出しの待ち時間",
+                     lambda: {"0.5": scheduler.stats()["wait_p50"], "0.95": scheduler.stats()["wait_p95"]},
+                     label_name="quantile")
+    metrics.callback("scheduler_rejected_total", "断ったモデル呼び出しの数",
+                     lambda: {"rate_limited": scheduler.stats()["rate_limited"], "shed": scheduler.stats()["shed"]},
+                     kind="counter", label_name="reason")
+    metrics.callback("answer_cache_entries", "回答キャッシュのエントリ数", lambda: answer_cache.stats()["entries"])
+    metrics.callback("answer_cache_requests_total", "回答キャッシュの検索回数",
+                     lambda: {"hit": answer_cache.stats()["hits"], "miss": answer_cache.stats()["misses"]},
+                     kind="counter", label_name="result")
+    metrics.callback("answer_cache_hit_ratio", "回答キャッシュのヒット率", lambda: answer_cache.stats()["hit_ratio"])
+    metrics.callback("page_cache_entries", "ページキャッシュのエントリ数", lambda: page_cache.stats()["entries"])
+    metrics.callback("page_cache_bytes", "ページキャッシュのサイズ（バイト）", lambda: page_cache.stats()["bytes"])
+    metrics.callback("page_cache_requests_total", "ページキャッシュの検索回数",
+                     lambda: {"hit": page_cache.stats()["hits"], "miss": page_cache.stats()["misses"],
+                              "revalidated": page_cache.stats()["revalidations"]},
+                     kind="counter", label_name="result")
+    metrics.callback("page_cache_hit_ratio", "ページキャッシュのヒット率（再検証を含む）",
+                     lambda: page_cache.stats()["hit_ratio"])
+    metrics.callback("search_cache_entries", "検索結果のキャッシュのエントリ数", lambda: search_cache.stats()["entries"])
+    metrics.callback("search_cache_requests_total", "検索結果のキャッシュの検索回数",
+                     lambda: {"hit": search_cache.stats()["hits"], "miss": search_cache.stats()["misses"]},
+                     kind="counter", label_name="result")
+    metrics.callback("search_cache_hit_ratio", "検索結果のキャッシュのヒット率", lambda: search_cache.stats()["hit_ratio"])
+    # キャッシュのヒットと同時リクエストのまとめで呼び出さずに済んだ Custom Search API の回数
+    metrics.callback("search_api_calls_saved_total", "呼び出さずに済んだ検索APIの回数",
+                     lambda: search_cache.stats()["hits"] + search_flight.stats()["coalesced"], kind="counter")
+    flights = {"fetch": fetch_flight, "search": search_flight, "completion": completion_flight}
+    metrics.callback("singleflight_calls_total", "同時リクエストをまとめる処理の呼び出し回数",
+                     lambda: {name: flight.stats()["calls"] for name, flight in flights.items()},
+                     kind="counter", label_name="flight")
+    metrics.callback("singleflight_coalesced_total", "実行中の処理にまとめた呼び出しの回数",
+                     lambda: {name: flight.stats()["coalesced"] for name, flight in flights.items()},
+                     kind="counter", label_name="flight")
+    if message_index is not None:
+        metrics.callback("message_index_messages", "メッセージインデックスのメッセージ数", message_index.count)
+    if SHARDED:
+        metrics.callback("shard_latency_seconds", "担当するシャードのハートビートの遅延",
+                         lambda: {str(shard_id): shard.latency for shard_id, shard in bot.shards.items()},
+                         label_name="shard")
+        metrics.callback("invalidation_events_total", "送受信したキャッシュの無効化の数",
+                         lambda: {"published": invalidation_bus.published, "received": invalidation_bus.received},
+                         kind="counter", label_name="direction")
+
 # Run the bot
 if __name__ == "__main__":
     load_knowledge_base()
-    bot.run(DISCORD_TOKEN)
+    page_cache.load()
+    # Load conversation history before connecting so that reconnects don't reload it
+    load_conversation_history()
+    try:
+        bot.run(DISCORD_TOKEN)
+    finally:
+        gemini.close()
+        search_executor.shutdown(wait=False)
+        if extract_executor is not None:
+            extract_executor.shutdown(wait=False, cancel_futures=True)
+        save_conversation_history()
+        knowledge_store.close()
+        if shared_vectors is not None:
+            shared_vectors.close()
+        if message_index is not None:
+            message_index.close()
+        if invalidation_bus is not None:
+            invalidation_bus.close()
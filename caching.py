@@ -0,0 +1,201 @@
+"""キャッシュ関連のクラス"""
+import json
+import os
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+def normalize_url(url):
+    """キャッシュのキーとして使うためにURLを正規化する
+
+    スキームとホスト名を小文字にし、デフォルトポートとフラグメントを取り除き、
+    クエリパラメータを並べ替える。
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    port = parts.port
+    if port and not ((scheme == "http" and port == 80) or (scheme == "https" and port == 443)):
+        host = f"{host}:{port}"
+    path = parts.path or "/"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+class PageCache:
+    """URLから取り出したページ（タイトルと本文）のキャッシュ
+
+    合計サイズ（バイト）が max_bytes を超えたら最も長く使われていないものから削除する（LRU）。
+    ttl 秒を過ぎたエントリは古いものとして扱い、ETag / Last-Modified があれば
+    条件付きリクエストで再検証できる。
+
+    Args:
+        max_bytes (int): キャッシュ全体の最大サイズ（バイト）
+        ttl (float): エントリが新しいとみなされる時間（秒）
+        path (str, optional): 保存先のファイル。指定した場合は load() / save() で再起動後も使える
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl=600, path=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    @staticmethod
+    def _size(entry):
+        return len(entry["title"].encode("utf-8")) + len(entry["content"].encode("utf-8"))
+
+    def lookup(self, key):
+        """(エントリ, 新しいかどうか) を返す。新しいエントリが見つかった場合はヒットとして数える"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None, False
+        self.entries.move_to_end(key)
+        fresh = self.is_fresh(entry)
+        if fresh:
+            self.hits += 1
+        return entry, fresh
+
+    def is_fresh(self, entry):
+        return time.time() - entry["fetched_at"] < self.ttl
+
+    def conditional_headers(self, entry):
+        """再検証用のリクエストヘッダーを返す"""
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def put(self, key, title, content, etag=None, last_modified=None):
+        """ダウンロードしてパースしたページを追加する（ミスとして数える）"""
+        self.misses += 1
+        self.remove(key)
+        entry = {
+            "title": title,
+            "content": content,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": time.time(),
+        }
+        size = self._size(entry)
+        if size > self.max_bytes:
+            return entry
+        self.entries[key] = entry
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= self._size(evicted)
+        return entry
+
+    def mark_revalidated(self, key):
+        """304 Not Modified を受け取ったエントリの有効期限を延ばす"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry["fetched_at"] = time.time()
+            self.revalidations += 1
+        return entry
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= self._size(entry)
+
+    def stats(self):
+        """ヒット数などの統計を返す"""
+        lookups = self.hits + self.misses + self.revalidations
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "hit_ratio": (self.hits + self.revalidations) / lookups if lookups else 0.0,
+        }
+
+    def load(self):
+        """保存されたキャッシュを読み込む"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            for key, entry in saved:
+                self.entries[key] = entry
+                self.total_bytes += self._size(entry)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= self._size(evicted)
+        except Exception as e:
+            print(f"Error loading page cache: {e}")
+
+    def save(self):
+        """キャッシュをファイルに保存する（LRUの順序も保持する）"""
+        if not self.path:
+            return
+        try:
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(list(self.entries.items()), f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"Error saving page cache: {e}")
+
+
+class TTLCache:
+    """件数の上限と有効期間を持つLRUキャッシュ
+
+    Args:
+        maxsize (int): 保持する最大件数
+        ttl (float): エントリの有効期間（秒）
+    """
+
+    def __init__(self, maxsize=256, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (保存した時刻, 値)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self.entries.get(key)
+        if item is None or time.time() - item[0] >= self.ttl:
+            if item is not None:
+                del self.entries[key]
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = (time.time(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
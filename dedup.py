@@ -0,0 +1,311 @@
+"""知識ベースに追加するテキストの重複検出
+
+完全な重複は正規化した内容のハッシュで検出し、ほぼ同じ内容（近似重複）は
+文字単位のシングル（n-gram）の MinHash と LSH で検出する。文字単位なので
+日本語のように単語の区切りが無いテキストにもそのまま使える。
+"""
+import hashlib
+import unicodedata
+import zlib
+
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+def normalize_content(text):
+    """比較用にテキストを正規化する（NFKC、大文字小文字の統一、空白の正規化）"""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def content_hash(text):
+    return hashlib.sha256(normalize_content(text).encode("utf-8")).hexdigest()
+
+
+class MinHasher:
+    """文字シングルの MinHash 署名を計算する
+
+    Args:
+        num_perm (int): 署名の長さ（ハッシュ関数の数）
+        shingle_size (int): シングルの文字数
+        seed (int): ハッシュ関数の乱数の種（同じ値なら同じ署名になる）
+    """
+
+    def __init__(self, num_perm=128, shingle_size=5, seed=1):
+        # NumPyは近似重複の検出を有効にした場合だけ必要になる
+        import numpy as np
+        self._np = np
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, _MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+
+    def shingles(self, text):
+        # 空白は無視して文字の並びだけを比べる
+        text = "".join(normalize_content(text).split())
+        size = self.shingle_size
+        if len(text) <= size:
+            return {text} if text else set()
+        return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+    def signature(self, text):
+        np = self._np
+        shingles = self.shingles(text)
+        if not shingles:
+            return None
+        values = np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) & _MERSENNE_PRIME for shingle in shingles),
+            dtype=np.uint64, count=len(shingles),
+        )
+        hashed = (np.outer(values, self._a) + self._b) % _MERSENNE_PRIME
+        return hashed.min(axis=0)
+
+    def similarity(self, signature, other):
+        """2つの署名から Jaccard 類似度を推定する"""
+        return float(self._np.mean(signature == other))
+
+
+class Deduplicator:
+    """知識ベースのエントリの重複を検出する（メモリ上のインデックス）
+
+    near_duplicates=True の場合は、MinHash の署名を bands 個の帯に分けて
+    バケットに登録し（LSH）、同じバケットに入った候補の推定 Jaccard 類似度が
+    threshold 以上なら重複とみなす。
+
+    エントリの登録は知識ベースのストレージが保存に成功した後に行う（filter は登録しない）。
+
+    Args:
+        near_duplicates (bool): 近似重複も検出するかどうか
+        threshold (float): 近似重複とみなす類似度（0〜1）
+        num_perm (int): MinHash の署名の長さ（bands で割り切れること）
+        bands (int): LSH の帯の数
+        shingle_size (int): シングルの文字数
+    """
+
+    def __init__(self, near_duplicates=False, threshold=0.85, num_perm=128, bands=16, shingle_size=5):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.near_duplicates = near_duplicates
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.hasher = MinHasher(num_perm, shingle_size) if near_duplicates else None
+        self.hashes = {}  # 内容のハッシュ -> knowledge_id
+        self.ids = {}  # knowledge_id -> (内容のハッシュ, 署名)
+        self.buckets = {}  # (帯の番号, 帯の値) -> {knowledge_id}
+        # filter で計算したハッシュと署名（保存後の登録で使い回す）
+        self._computed = {}
+
+    @property
+    def config(self):
+        """保存した署名やバケットを使い回せるかどうかを判断するための設定の文字列"""
+        if not self.near_duplicates:
+            return "exact"
+        return f"minhash:{self.num_perm}:{self.bands}:{self.shingle_size}"
+
+    def _band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def _compute(self, content):
+        signature = self.hasher.signature(content) if self.near_duplicates else None
+        return content_hash(content), signature
+
+    def add(self, knowledge_id, content):
+        """エントリを登録する（既に登録されているIDは置き換える）"""
+        digest, signature = self._computed.pop(knowledge_id, None) or self._compute(content)
+        self._register(knowledge_id, digest, signature)
+
+    def add_many(self, entries):
+        """(knowledge_id, content) のリストを登録する"""
+        for knowledge_id, content in entries:
+            self.add(knowledge_id, content)
+
+    def _register(self, knowledge_id, digest, signature):
+        self.remove(knowledge_id)
+        self.hashes.setdefault(digest, knowledge_id)
+        self.ids[knowledge_id] = (digest, signature)
+        if signature is not None:
+            for key in self._band_keys(signature):
+                self.buckets.setdefault(key, set()).add(knowledge_id)
+
+    def remove(self, knowledge_id):
+        item = self.ids.pop(knowledge_id, None)
+        if item is None:
+            return
+        digest, signature = item
+        if self.hashes.get(digest) == knowledge_id:
+            del self.hashes[digest]
+        if signature is not None:
+            for key in self._band_keys(signature):
+                bucket = self.buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(knowledge_id)
+                    if not bucket:
+                        del self.buckets[key]
+
+    def clear(self):
+        self.hashes.clear()
+        self.ids.clear()
+        self.buckets.clear()
+        self._computed.clear()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _id_for_hash(self, digest):
+        return self.hashes.get(digest)
+
+    def _candidates(self, signature):
+        """LSHのバケットから {knowledge_id: 署名} の候補を集める"""
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(self.buckets.get(key, ()))
+        return {candidate: self.ids[candidate][1] for candidate in candidates}
+
+    def find_duplicate(self, content):
+        """内容が重複するエントリのIDを返す（無ければ None）"""
+        knowledge_id = self._id_for_hash(content_hash(content))
+        if knowledge_id is not None or not self.near_duplicates:
+            return knowledge_id
+        return self._find_similar(self.hasher.signature(content))
+
+    def _find_similar(self, signature):
+        """候補のうち類似度が threshold 以上で最も高いもののIDを返す"""
+        if signature is None:
+            return None
+        best_id, best_similarity = None, self.threshold
+        for candidate, other in self._candidates(signature).items():
+            similarity = self.hasher.similarity(other, signature)
+            if similarity >= best_similarity:
+                best_id, best_similarity = candidate, similarity
+        return best_id
+
+    def filter(self, entries):
+        """(knowledge_id, entry) のリストから重複を取り除く
+
+        既存のエントリとの重複に加えて、同じリスト内の重複も取り除く。
+        残したエントリは登録しないので、保存に成功した後に add / add_many で登録すること。
+
+        Returns:
+            tuple: (残したエントリのリスト, スキップした件数)
+        """
+        self._computed = {}
+        # 同じリスト内の重複を調べるための一時的なインデックス
+        batch = Deduplicator(self.near_duplicates, self.threshold, self.num_perm, self.bands, self.shingle_size)
+        kept = []
+        for knowledge_id, entry in entries:
+            digest = content_hash(entry["content"])
+            if self._id_for_hash(digest) is not None or digest in batch.hashes:
+                continue
+            signature = None
+            if self.near_duplicates:
+                signature = self.hasher.signature(entry["content"])
+                if self._find_similar(signature) is not None or batch._find_similar(signature) is not None:
+                    continue
+            batch._register(knowledge_id, digest, signature)
+            self._computed[knowledge_id] = (digest, signature)
+            kept.append((knowledge_id, entry))
+        return kept, len(entries) - len(kept)
+
+
+class SQLiteDeduplicator(Deduplicator):
+    """SQLiteに保存する重複検出のインデックス（SQLiteの知識ベースと同じデータベースを使う）
+
+    内容のハッシュと、近似重複の検出を有効にした場合は署名とLSHのバケットのキーを
+    インデックス付きのテーブルに保存し、検出時はクエリで調べる。起動時にインデックスを
+    作り直す必要が無く、複数のワーカープロセスで共有できる。
+    書き込みは呼び出し側のトランザクション内で行い、知識ベースの本体と常に同期させる。
+    """
+
+    def __init__(self, conn, near_duplicates=False, threshold=0.85, num_perm=128, bands=16, shingle_size=5):
+        super().__init__(near_duplicates, threshold, num_perm, bands, shingle_size)
+        self.conn = conn
+        self._create_tables()
+
+    def _create_tables(self):
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS dedup_hashes (knowledge_id TEXT PRIMARY KEY, hash TEXT NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS dedup_hashes_hash ON dedup_hashes (hash)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS dedup_signatures (knowledge_id TEXT PRIMARY KEY, signature BLOB NOT NULL)"
+            )
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS dedup_buckets (
+                    key BLOB NOT NULL,
+                    knowledge_id TEXT NOT NULL,
+                    PRIMARY KEY (key, knowledge_id)
+                ) WITHOUT ROWID"""
+            )
+
+    def reset(self):
+        """テーブルを作り直す（設定が変わって署名を使い回せない場合に使用）"""
+        with self.conn:
+            self.conn.execute("DROP TABLE IF EXISTS dedup_hashes")
+            self.conn.execute("DROP TABLE IF EXISTS dedup_signatures")
+            self.conn.execute("DROP TABLE IF EXISTS dedup_buckets")
+        self._create_tables()
+
+    def _bucket_keys(self, signature):
+        return [band.to_bytes(2, "big") + value for band, value in self._band_keys(signature)]
+
+    def add_many(self, entries):
+        hashes, signatures, buckets = [], [], []
+        for knowledge_id, content in entries:
+            digest, signature = self._computed.pop(knowledge_id, None) or self._compute(content)
+            hashes.append((knowledge_id, digest))
+            if signature is not None:
+                signatures.append((knowledge_id, signature.tobytes()))
+                buckets.extend((key, knowledge_id) for key in self._bucket_keys(signature))
+        self.conn.executemany("INSERT OR REPLACE INTO dedup_hashes (knowledge_id, hash) VALUES (?, ?)", hashes)
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO dedup_signatures (knowledge_id, signature) VALUES (?, ?)", signatures
+        )
+        self.conn.executemany("INSERT OR IGNORE INTO dedup_buckets (key, knowledge_id) VALUES (?, ?)", buckets)
+
+    def add(self, knowledge_id, content):
+        self.remove(knowledge_id)
+        self.add_many([(knowledge_id, content)])
+
+    def remove(self, knowledge_id):
+        row = self.conn.execute(
+            "SELECT signature FROM dedup_signatures WHERE knowledge_id = ?", (knowledge_id,)
+        ).fetchone()
+        if row is not None:
+            signature = self._np_signature(row[0])
+            self.conn.executemany(
+                "DELETE FROM dedup_buckets WHERE key = ? AND knowledge_id = ?",
+                ((key, knowledge_id) for key in self._bucket_keys(signature)),
+            )
+            self.conn.execute("DELETE FROM dedup_signatures WHERE knowledge_id = ?", (knowledge_id,))
+        self.conn.execute("DELETE FROM dedup_hashes WHERE knowledge_id = ?", (knowledge_id,))
+
+    def clear(self):
+        self.conn.execute("DELETE FROM dedup_hashes")
+        self.conn.execute("DELETE FROM dedup_signatures")
+        self.conn.execute("DELETE FROM dedup_buckets")
+        self._computed.clear()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM dedup_hashes").fetchone()[0]
+
+    def _np_signature(self, blob):
+        return self.hasher._np.frombuffer(blob, dtype=self.hasher._np.uint64)
+
+    def _id_for_hash(self, digest):
+        row = self.conn.execute("SELECT knowledge_id FROM dedup_hashes WHERE hash = ? LIMIT 1", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def _candidates(self, signature):
+        keys = self._bucket_keys(signature)
+        placeholders = ",".join("?" * len(keys))
+        rows = self.conn.execute(
+            f"""SELECT knowledge_id, signature FROM dedup_signatures WHERE knowledge_id IN (
+                    SELECT knowledge_id FROM dedup_buckets WHERE key IN ({placeholders})
+                )""",
+            keys,
+        )
+        return {knowledge_id: self._np_signature(blob) for knowledge_id, blob in rows}
@@ -0,0 +1,347 @@
+"""ファイルからテキストを取り出し、知識ベース用のチャンクに分割する
+
+ファイルの内容はメモリ上のバイト列として受け取り、一時ファイルには書き出さない。
+PDFはプロセスプールの各ワーカーに共有メモリで渡し、ワーカーは1回だけ開いて使い回す。
+"""
+import asyncio
+import codecs
+import csv
+import io
+import os
+import re
+import threading
+import zipfile
+from collections import deque
+from multiprocessing import shared_memory
+from xml.etree import ElementTree
+
+import PyPDF2
+from bs4 import BeautifulSoup
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+
+def split_text(text, chunk_size=1000, overlap=200):
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=overlap,
+        length_function=len,
+    )
+    return text_splitter.split_text(text)
+
+
+class StreamingChunker:
+    """少しずつ届くテキストを split_text と同じ方法でチャンクに分割する
+
+    受け取ったテキストがチャンク buffer_chunks 個分たまるごとに分割し、
+    最後の（まだ続きがあるかもしれない）チャンクだけを次の分割に持ち越す。
+    文書全体を1つの文字列にしないので、メモリ使用量はバッファの大きさで決まる。
+    """
+
+    def __init__(self, chunk_size=1000, overlap=200, buffer_chunks=8):
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.buffer_size = chunk_size * buffer_chunks
+        self._parts = []
+        self._length = 0
+
+    def feed(self, text):
+        """テキストを追加し、確定したチャンクのリストを返す"""
+        if not text:
+            return []
+        self._parts.append(text)
+        self._length += len(text)
+        if self._length < self.buffer_size:
+            return []
+        chunks = split_text("".join(self._parts), self.chunk_size, self.overlap)
+        if len(chunks) <= 1:
+            return []
+        rest = chunks[-1]
+        self._parts = [rest]
+        self._length = len(rest)
+        return chunks[:-1]
+
+    def finish(self):
+        """残りのテキストを分割して返す"""
+        text = "".join(self._parts)
+        self._parts = []
+        self._length = 0
+        return split_text(text, self.chunk_size, self.overlap) if text.strip() else []
+
+
+def chunk_document(filename, data, chunk_size=1000, overlap=200):
+    """ファイルの内容を抽出してチャンクのリストを返す（同期版。別プロセスからの一括取り込み用）
+
+    ボットの learn_from_file と同じ抽出関数と StreamingChunker を使う。
+    """
+    extractor = get_extractor(filename)
+    if extractor is None:
+        raise ValueError(f"サポートされていないファイル形式です: {os.path.splitext(filename)[1].lower()}")
+
+    async def collect():
+        chunker = StreamingChunker(chunk_size, overlap)
+        chunks = []
+        async for _, _, text in extractor(data, None):
+            chunks.extend(chunker.feed(text))
+        chunks.extend(chunker.finish())
+        return [chunk for chunk in chunks if chunk.strip()]
+
+    return asyncio.run(collect())
+
+
+# HTMLからタイトルと本文を取り出す関数
+def parse_html(content, max_length=8000):
+    """HTMLをパースしてタイトルと本文のテキストを返す（CPU負荷が高いためスレッドで実行する）"""
+    # BeautifulSoupでHTMLをパース
+    soup = BeautifulSoup(content, 'html.parser')
+
+    # タイトルを取得
+    title = soup.title.string if soup.title and soup.title.string else "タイトルなし"
+
+    # 不要なタグを削除
+    for tag in soup(['script', 'style', 'head', 'header', 'footer', 'nav', 'aside']):
+        tag.decompose()
+
+    # テキストを取得
+    text = soup.get_text(separator=' ', strip=True)
+
+    # 余分な空白を削除
+    text = re.sub(r'\s+', ' ', text).strip()
+
+    # 最大長に制限
+    if len(text) > max_length:
+        text = text[:max_length] + "...(省略)"
+
+    return str(title), text
+
+
+# ---- 抽出関数の登録 ----
+
+# 拡張子 -> (data, executor) を受け取って (ページ番号, 総ページ数, テキスト) を返す非同期ジェネレーター関数
+EXTRACTORS = {}
+
+
+def register_extractor(*extensions):
+    """拡張子に対応する抽出関数を登録するデコレーター"""
+    def decorator(func):
+        for extension in extensions:
+            EXTRACTORS[extension] = func
+        return func
+    return decorator
+
+
+def get_extractor(filename):
+    """ファイル名の拡張子に対応する抽出関数を返す（対応していない場合は None）"""
+    return EXTRACTORS.get(os.path.splitext(filename)[1].lower())
+
+
+def supported_extensions():
+    return sorted(EXTRACTORS)
+
+
+# ---- PDF（プロセスプールで実行する関数） ----
+
+# ワーカーが開いているPDF（共有メモリの名前とリーダー）。使い終わったら破棄する
+_worker_pdf = {}
+_worker_pdf_lock = threading.Lock()
+# 最後のページを読まなかったワーカーは、この秒数使われなかったPDFを破棄する
+PDF_READER_IDLE = 5.0
+
+
+def _page_texts(reader, start, end):
+    """start から end - 1 ページ目までのテキストのリストを返す"""
+    return [(reader.pages[i].extract_text() or "") + "\n" for i in range(start, end)]
+
+
+def _release_worker_pdf(name=None):
+    """ワーカーが開いているPDFを破棄する（name を指定した場合はそのPDFの場合だけ）"""
+    with _worker_pdf_lock:
+        if name is not None and _worker_pdf.get("name") != name:
+            return
+        timer = _worker_pdf.get("timer")
+        if timer is not None:
+            timer.cancel()
+        _worker_pdf.clear()
+
+
+def _shared_pdf_reader(name, size):
+    """共有メモリのPDFのリーダーを返す（同じワーカーで同じPDFを何度もパースしない）"""
+    with _worker_pdf_lock:
+        timer = _worker_pdf.pop("timer", None)
+        if timer is not None:
+            timer.cancel()
+        if _worker_pdf.get("name") == name:
+            return _worker_pdf["reader"]
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        data = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    reader = PyPDF2.PdfReader(io.BytesIO(data))
+    with _worker_pdf_lock:
+        _worker_pdf.clear()
+        _worker_pdf.update(name=name, reader=reader)
+    return reader
+
+
+def _finish_worker_pdf(name, last):
+    """ジョブの終わりに、最後のページまで読んだPDFを破棄し、それ以外は使われなくなったら破棄する"""
+    if last:
+        _release_worker_pdf(name)
+        return
+    with _worker_pdf_lock:
+        if _worker_pdf.get("name") != name:
+            return
+        timer = threading.Timer(PDF_READER_IDLE, _release_worker_pdf, args=(name,))
+        timer.daemon = True
+        _worker_pdf["timer"] = timer
+        timer.start()
+
+
+def _shared_pdf_page_count(name, size):
+    try:
+        return len(_shared_pdf_reader(name, size).pages)
+    finally:
+        _finish_worker_pdf(name, False)
+
+
+def _extract_shared_pdf_pages(name, size, start, end, total):
+    try:
+        return _page_texts(_shared_pdf_reader(name, size), start, end)
+    finally:
+        _finish_worker_pdf(name, end >= total)
+
+
+@register_extractor(".pdf")
+async def iter_pdf_pages(data, executor, pages_per_job=16, max_pending=4):
+    """PDFのページのテキストを順番に返す非同期ジェネレーター
+
+    PDFを共有メモリに1回だけコピーし、pages_per_job ページずつプロセスプールで抽出する。
+    ジョブには共有メモリの名前とページの範囲だけを渡し、各ワーカーはPDFを1回だけ開いて使い回す。
+    同時に実行する数を max_pending に制限して、読み終わっていないページがたまりすぎないようにする。
+    executor が None の場合は、このプロセスでPDFを1回だけ開いて順に抽出する。
+
+    Yields:
+        tuple: (ページ番号（1から）, 総ページ数, テキスト)
+    """
+    loop = asyncio.get_running_loop()
+    if executor is None:
+        reader = await loop.run_in_executor(None, PyPDF2.PdfReader, io.BytesIO(data))
+        total = len(reader.pages)
+        for start in range(0, total, pages_per_job):
+            end = min(total, start + pages_per_job)
+            texts = await loop.run_in_executor(None, _page_texts, reader, start, end)
+            for offset, text in enumerate(texts):
+                yield start + offset + 1, total, text
+        return
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    pending = deque()
+    try:
+        shm.buf[:len(data)] = data
+        total = await loop.run_in_executor(executor, _shared_pdf_page_count, shm.name, len(data))
+        next_page = 0
+        page_number = 0
+        while next_page < total or pending:
+            while next_page < total and len(pending) < max_pending:
+                end = min(total, next_page + pages_per_job)
+                pending.append(loop.run_in_executor(
+                    executor, _extract_shared_pdf_pages, shm.name, len(data), next_page, end, total
+                ))
+                next_page = end
+            for text in await pending.popleft():
+                page_number += 1
+                yield page_number, total, text
+    finally:
+        for future in pending:
+            future.cancel()
+        # 開いた後のリーダーはコピーしたデータを読むので、実行中のジョブがあっても削除してよい
+        shm.close()
+        shm.unlink()
+
+
+# ---- テキスト系の形式 ----
+
+@register_extractor(".txt", ".md", ".markdown")
+async def iter_text(data, executor=None, block_size=64 * 1024):
+    """UTF-8のテキストを block_size バイトずつデコードして返す（ページは1つとして数える）"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="ignore")
+    view = memoryview(data)
+    for start in range(0, len(view), block_size):
+        text = decoder.decode(view[start:start + block_size])
+        if text:
+            yield 1, 1, text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield 1, 1, text
+
+
+def _html_to_text(data):
+    soup = BeautifulSoup(data, "html.parser")
+    for tag in soup(["script", "style", "head", "nav"]):
+        tag.decompose()
+    return soup.get_text(separator="\n", strip=True)
+
+
+@register_extractor(".html", ".htm")
+async def iter_html(data, executor):
+    text = await asyncio.get_running_loop().run_in_executor(executor, _html_to_text, data)
+    yield 1, 1, text
+
+
+@register_extractor(".csv")
+async def iter_csv(data, executor=None, rows_per_block=200):
+    """CSVの各行を「列名: 値」の形式のテキストにして返す（1行目を列名として扱う）"""
+    text = codecs.decode(data, "utf-8-sig", errors="ignore")
+    reader = csv.reader(io.StringIO(text))
+    header = next(reader, None)
+    if header is None:
+        return
+    lines = []
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        lines.append(", ".join(f"{name}: {value}" for name, value in zip(header, row) if value.strip()))
+        if len(lines) >= rows_per_block:
+            yield 1, 1, "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield 1, 1, "\n".join(lines) + "\n"
+
+
+_WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# ZIP内のファイルを展開した後のサイズの上限（添付ファイルの上限 LEARN_FILE_MAX_MB と同じ）
+# 小さなZIPが巨大なデータに展開されてメモリを使い切るのを防ぐ
+MAX_UNCOMPRESSED_BYTES = int(float(os.getenv("LEARN_FILE_MAX_MB", "25")) * 1024 * 1024)
+
+
+def _read_zip_member(archive, name, max_bytes=None):
+    """ZIP内のファイルを展開後のサイズを確認してから読む"""
+    max_bytes = MAX_UNCOMPRESSED_BYTES if max_bytes is None else max_bytes
+    info = archive.getinfo(name)
+    if info.file_size > max_bytes:
+        raise ValueError(f"展開後のサイズが大きすぎます（{name}: {info.file_size} バイト）")
+    # ヘッダーのサイズが実際と異なる場合に備えて、上限を超えた時点で読むのをやめる
+    with archive.open(info) as member:
+        content = member.read(max_bytes + 1)
+    if len(content) > max_bytes:
+        raise ValueError(f"展開後のサイズが大きすぎます（{name}）")
+    return content
+
+
+def _docx_to_text(data):
+    """DOCX（ZIP内の word/document.xml）から段落のテキストを取り出す"""
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        root = ElementTree.fromstring(_read_zip_member(archive, "word/document.xml"))
+    paragraphs = []
+    for paragraph in root.iter(f"{_WORD_NAMESPACE}p"):
+        text = "".join(node.text or "" for node in paragraph.iter(f"{_WORD_NAMESPACE}t"))
+        if text.strip():
+            paragraphs.append(text)
+    return "\n\n".join(paragraphs)
+
+
+@register_extractor(".docx")
+async def iter_docx(data, executor):
+    text = await asyncio.get_running_loop().run_in_executor(executor, _docx_to_text, data)
+    yield 1, 1, text
@@ -0,0 +1,117 @@
+"""Gemini APIへのアクセスをイベントループから切り離すための非同期クライアント"""
+import asyncio
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+class GeminiClient:
+    """Gemini APIの呼び出しを非同期で実行するクライアント
+
+    ライブラリの非同期API (send_message_async / generate_content_async) があればそれを使い、
+    無い場合は上限付きのスレッドプールで同期APIを実行する。
+    同時に実行できるリクエスト数は max_concurrency で制限する。
+
+    Args:
+        model: genai.GenerativeModel のインスタンス
+        session_factory (callable): user_id を受け取ってチャットセッションを返す関数
+        max_concurrency (int): Gemini APIへの同時リクエスト数の上限
+    """
+
+    def __init__(self, model, session_factory, max_concurrency=4):
+        self.model = model
+        self.session_factory = session_factory
+        self.max_concurrency = max(1, max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="gemini")
+        # セマフォはイベントループ上で初めて使われた時に作成する
+        self._semaphore = None
+        # user_id -> [Lock, 参照数]
+        self._user_locks = {}
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @contextlib.asynccontextmanager
+    async def user_lock(self, user_id):
+        """ユーザーごとの排他ロック
+
+        同じユーザーのリクエストが並行して実行され、チャットセッションや会話履歴が
+        混ざらないようにする。使われなくなったロックは自動的に破棄する。
+        """
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user_id]
+
+    async def _call(self, async_func, sync_func, *args, **kwargs):
+        async with self._get_semaphore():
+            if async_func is not None:
+                return await async_func(*args, **kwargs)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, lambda: sync_func(*args, **kwargs))
+
+    async def send_message(self, user_id, prompt):
+        """ユーザーのチャットセッションにメッセージを送信する
+
+        呼び出し側で user_lock(user_id) を保持していることを前提とする。
+        """
+        chat = self.session_factory(user_id)
+        return await self._call(getattr(chat, "send_message_async", None), chat.send_message, prompt)
+
+    def send_message_stream(self, user_id, prompt):
+        """ユーザーのチャットセッションにメッセージを送信し、応答のテキストを届いた順に返す
+
+        呼び出し側で user_lock(user_id) を保持していることを前提とする。
+        ストリームを読み終わるまで同時実行数の枠を使い続ける。
+        """
+        chat = self.session_factory(user_id)
+        return self._stream(getattr(chat, "send_message_async", None), chat.send_message, prompt)
+
+    def generate_content_stream(self, contents):
+        """チャットセッションを使わずにコンテンツを生成し、応答のテキストを届いた順に返す"""
+        return self._stream(
+            getattr(self.model, "generate_content_async", None), self.model.generate_content, contents
+        )
+
+    async def _stream(self, async_func, sync_func, contents):
+        async with self._get_semaphore():
+            if async_func is None:
+                # 非同期APIが無い場合はまとめて受け取る
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(self._executor, sync_func, contents)
+                yield response.text
+                return
+            response = await async_func(contents, stream=True)
+            async for chunk in response:
+                try:
+                    text = chunk.text
+                except (ValueError, IndexError):
+                    # 安全フィルターなどでテキストを含まないチャンク
+                    continue
+                if text:
+                    yield text
+
+    async def generate_content(self, contents):
+        """チャットセッションを使わずにコンテンツを生成する"""
+        return await self._call(
+            getattr(self.model, "generate_content_async", None), self.model.generate_content, contents
+        )
+
+    async def count_tokens(self, contents):
+        """モデルのトークンカウンターでトークン数を数える"""
+        response = await self._call(
+            getattr(self.model, "count_tokens_async", None), self.model.count_tokens, contents
+        )
+        return response.total_tokens
+
+    def close(self):
+        """スレッドプールを停止する"""
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,505 @@
+"""会話履歴の永続化
+
+1つのプロセスで動かす場合は追記型ジャーナルと定期的なスナップショット（HistoryJournal）、
+複数のプロセス（シャードのワーカー）で共有する場合は SQLite（SQLiteHistoryStore）に保存する。
+"""
+import asyncio
+import glob
+import json
+import os
+import sqlite3
+import unicodedata
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# スナップショット内でジャーナルの管理情報を保存するキー（ユーザーIDとは衝突しない）
+META_KEY = "__journal__"
+
+
+class HistoryJournal:
+    """会話履歴を追記型のジャーナルで保存するクラス
+
+    メッセージの追加・削除はジャーナルファイルに1行1件のJSONとして追記し、
+    短い間隔でまとめて書き込む（グループコミット）。書き込みと fsync は
+    イベントループを止めないように書き込み用のスレッドで行う。ジャーナルが一定量たまると
+    履歴全体をスナップショットとして書き出し（コンパクション）、古いジャーナルを削除する。
+
+    ファイル構成:
+        <snapshot_path>            履歴全体のスナップショット
+        <snapshot_path>.journal    現在書き込み中のジャーナル
+        <snapshot_path>.journal.N  コンパクション待ちのジャーナル
+
+    Args:
+        history (dict): 会話履歴を保持する辞書 {user_id: [message, ...]}
+        snapshot_path (str): スナップショットファイルのパス
+        flush_interval (float): ジャーナルをまとめて書き込む間隔（秒）
+        compact_threshold (int): コンパクションを行うジャーナルの件数
+        fsync (bool): 書き込みごとにディスクへ同期するかどうか
+    """
+
+    def __init__(self, history, snapshot_path, flush_interval=0.2, compact_threshold=1000, fsync=True):
+        self.history = history
+        self.snapshot_path = snapshot_path
+        self.journal_path = f"{snapshot_path}.journal"
+        self.flush_interval = flush_interval
+        self.compact_threshold = compact_threshold
+        self.fsync = fsync
+        self._pending = []
+        self._flush_handle = None
+        self._flush_task = None
+        # ジャーナルのファイル操作は順番を保つために1つのスレッドで行う
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-journal")
+        self._journal_file = None
+        self._records_since_compact = 0
+        self._compacting = False
+        self._compacted_segment = 0
+
+    # ---- 読み込み ----
+
+    def _segment_paths(self):
+        """コンパクション待ちのジャーナルを番号順に返す"""
+        segments = []
+        for path in glob.glob(f"{glob.escape(self.journal_path)}.*"):
+            suffix = path.rsplit(".", 1)[1]
+            if suffix.isdigit():
+                segments.append((int(suffix), path))
+        return sorted(segments)
+
+    def _apply(self, record):
+        op = record.get("op")
+        user_id = record.get("user_id")
+        if op == "append":
+            self.history[user_id].append(record["message"])
+        elif op == "trim":
+            del self.history[user_id][:record.get("count", 1)]
+            if not self.history[user_id]:
+                del self.history[user_id]
+        elif op == "clear":
+            self.history.pop(user_id, None)
+
+    def _replay(self, path):
+        count = 0
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中でクラッシュした末尾の行は無視する
+                    print(f"Skipping corrupted journal line in {path}")
+                    continue
+                self._apply(record)
+                count += 1
+        return count
+
+    def load(self):
+        """スナップショットを読み込み、ジャーナルを再生して履歴を復元する"""
+        self.history.clear()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                content = f.read()
+            data = json.loads(content) if content.strip() else {}
+            meta = data.pop(META_KEY, {})
+            self._compacted_segment = meta.get("compacted_segment", 0)
+            for user_id, messages in data.items():
+                self.history[user_id] = messages
+
+        replayed = 0
+        for number, path in self._segment_paths():
+            if number <= self._compacted_segment:
+                # スナップショットに反映済み（削除前にクラッシュした）
+                os.remove(path)
+                continue
+            replayed += self._replay(path)
+        if os.path.exists(self.journal_path):
+            replayed += self._replay(self.journal_path)
+        self._records_since_compact = replayed
+        return replayed
+
+    # ---- 書き込み ----
+
+    def append_message(self, user_id, message, max_length):
+        """メッセージを追加し、上限を超えた古いメッセージを削除する
+
+        Returns:
+            int: 削除した古いメッセージの件数
+        """
+        self.history[user_id].append(message)
+        self._record({"op": "append", "user_id": user_id, "message": message})
+        overflow = len(self.history[user_id]) - max_length
+        if overflow > 0:
+            del self.history[user_id][:overflow]
+            self._record({"op": "trim", "user_id": user_id, "count": overflow})
+            return overflow
+        return 0
+
+    def clear_user(self, user_id):
+        """ユーザーの会話履歴を削除する"""
+        self.history.pop(user_id, None)
+        self._record({"op": "clear", "user_id": user_id})
+
+    def _record(self, record):
+        self._pending.append(json.dumps(record, ensure_ascii=False))
+        self._records_since_compact += 1
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # イベントループ外（起動処理など）では即座に書き込む
+            self.flush()
+            return
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.flush_interval, self._on_flush_timer)
+
+    def _on_flush_timer(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.get_running_loop().create_task(self._flush_and_compact())
+
+    async def _flush_and_compact(self):
+        try:
+            await self.flush_async()
+        except Exception as e:
+            print(f"Error writing conversation history journal: {e}")
+            return
+        if self._records_since_compact >= self.compact_threshold and not self._compacting:
+            await self.compact_async()
+
+    def _take_pending(self):
+        """たまっているジャーナルレコードを取り出す（イベントループのスレッドで呼ぶ）"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        lines, self._pending = self._pending, []
+        return lines
+
+    def _write(self, lines):
+        """ジャーナルに追記する（書き込み用のスレッドで実行する）"""
+        if not lines:
+            return
+        if self._journal_file is None:
+            self._journal_file = open(self.journal_path, "a", encoding="utf-8")
+        self._journal_file.write("\n".join(lines) + "\n")
+        self._journal_file.flush()
+        if self.fsync:
+            os.fsync(self._journal_file.fileno())
+
+    def flush(self):
+        """たまっているジャーナルレコードをまとめて書き込む（書き込みが終わるまで待つ）"""
+        self._writer.submit(self._write, self._take_pending()).result()
+
+    async def flush_async(self):
+        """たまっているジャーナルレコードを書き込み用のスレッドで書き込む
+
+        書き込み用のスレッドは1つなので、先に始めた書き込みが全て終わってから戻る。
+        """
+        await asyncio.get_running_loop().run_in_executor(self._writer, self._write, self._take_pending())
+
+    # ---- コンパクション ----
+
+    def _snapshot(self):
+        """コンパクションするスナップショットとして履歴のコピーを返す（イベントループのスレッドで呼ぶ）"""
+        self._records_since_compact = 0
+        # メッセージの辞書は追加後に変更されないため、リストのコピーで十分
+        return {user_id: list(messages) for user_id, messages in self.history.items() if messages}
+
+    def _rotate(self, lines):
+        """残りのレコードを書き込んでから、現在のジャーナルをコンパクション待ちのセグメントに切り替える
+
+        書き込み用のスレッドで実行し、切り替えたセグメントの番号を返す。
+        """
+        self._write(lines)
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        segments = self._segment_paths()
+        segment = max([number for number, _ in segments] + [self._compacted_segment]) + 1
+        if os.path.exists(self.journal_path):
+            os.replace(self.journal_path, f"{self.journal_path}.{segment}")
+        return segment
+
+    def _write_snapshot(self, snapshot, segment):
+        snapshot[META_KEY] = {"compacted_segment": segment}
+        temp_path = f"{self.snapshot_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        self._compacted_segment = segment
+        for number, path in self._segment_paths():
+            if number <= segment:
+                os.remove(path)
+
+    async def compact_async(self):
+        """ジャーナルの切り替えとスナップショットの書き出しをスレッドで行うコンパクション"""
+        if self._compacting:
+            return
+        self._compacting = True
+        try:
+            loop = asyncio.get_running_loop()
+            lines = self._take_pending()
+            snapshot = self._snapshot()
+            segment = await loop.run_in_executor(self._writer, self._rotate, lines)
+            await loop.run_in_executor(None, self._write_snapshot, snapshot, segment)
+        except Exception as e:
+            print(f"Error compacting conversation history: {e}")
+        finally:
+            self._compacting = False
+
+    def compact(self):
+        """同期的にコンパクションを行う（終了時などに使用）"""
+        lines = self._take_pending()
+        snapshot = self._snapshot()
+        segment = self._writer.submit(self._rotate, lines).result()
+        self._write_snapshot(snapshot, segment)
+
+    def close(self):
+        """未書き込みのレコードを書き込み、スナップショットを作成して終了する"""
+        self.compact()
+
+
+class SQLiteHistoryStore:
+    """複数のプロセスで共有する SQLite（WALモード）の会話履歴
+
+    HistoryJournal と同じメソッドを持ち、history の辞書はこのプロセスのキャッシュとして使う。
+    メッセージを追加した時はデータベースからユーザーの履歴を読み直すので、他のプロセスが
+    追加したメッセージも反映される。他のプロセスでの変更を受け取った時は reload_user() を呼ぶ。
+
+    Args:
+        history (dict): 会話履歴を保持する辞書 {user_id: [message, ...]}
+        path (str): データベースファイルのパス
+        timeout (float): 他のプロセスの書き込みを待つ時間（秒）
+    """
+
+    def __init__(self, history, path, timeout=30.0):
+        self.history = history
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    message TEXT NOT NULL
+                )"""
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS history_user ON history (user_id, id)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def load(self):
+        """全てのユーザーの履歴を読み込む（ジャーナルは無いので再生した件数は常に 0）"""
+        self.history.clear()
+        for user_id, message in self.conn.execute("SELECT user_id, message FROM history ORDER BY id"):
+            self.history.setdefault(user_id, []).append(json.loads(message))
+        return 0
+
+    def _read_user(self, user_id):
+        return [
+            json.loads(row[0])
+            for row in self.conn.execute("SELECT message FROM history WHERE user_id = ? ORDER BY id", (user_id,))
+        ]
+
+    def reload_user(self, user_id):
+        """ユーザーの履歴をデータベースから読み直し、読み直したリストを返す"""
+        messages = self._read_user(user_id)
+        if messages:
+            self.history[user_id] = messages
+        else:
+            self.history.pop(user_id, None)
+        return messages
+
+    def append_message(self, user_id, message, max_length):
+        """メッセージを追加し、上限を超えた古いメッセージを削除する
+
+        Returns:
+            int: このプロセスのキャッシュから見て削除された古いメッセージの件数
+        """
+        previous = len(self.history.get(user_id, []))
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO history (user_id, message) VALUES (?, ?)",
+                (user_id, json.dumps(message, ensure_ascii=False)),
+            )
+            self.conn.execute(
+                """DELETE FROM history WHERE user_id = ? AND id NOT IN (
+                    SELECT id FROM history WHERE user_id = ? ORDER BY id DESC LIMIT ?
+                )""",
+                (user_id, user_id, max_length),
+            )
+            messages = self._read_user(user_id)
+        self.history[user_id] = messages
+        return max(0, previous + 1 - len(messages))
+
+    def clear_user(self, user_id):
+        """ユーザーの会話履歴を削除する"""
+        self.history.pop(user_id, None)
+        with self.conn:
+            self.conn.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+
+    def flush(self):
+        # 書き込みは毎回コミットしている
+        pass
+
+    async def flush_async(self):
+        pass
+
+    def close(self):
+        self.conn.close()
+
+
+def migrate_journal_to_sqlite(snapshot_path, store):
+    """HistoryJournal のスナップショットとジャーナルの内容を SQLiteHistoryStore に移行する
+
+    移行済みの場合は何もしない。移行した件数を返す。複数のプロセスが同時に呼び出しても
+    1回だけ移行されるように、確認と書き込みを1つのトランザクションで行う。
+    """
+    if not os.path.exists(snapshot_path) and not os.path.exists(f"{snapshot_path}.journal"):
+        return 0
+    history = defaultdict(list)
+    HistoryJournal(history, snapshot_path).load()
+    conn = store.conn
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT value FROM meta WHERE key = 'migrated_from_journal'").fetchone():
+            conn.execute("ROLLBACK")
+            return 0
+        rows = [
+            (user_id, json.dumps(message, ensure_ascii=False))
+            for user_id, messages in history.items()
+            for message in messages
+        ]
+        conn.executemany("INSERT INTO history (user_id, message) VALUES (?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from_journal', ?)", (snapshot_path,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return len(rows)
+
+
+def normalize_text(text):
+    """検索用にテキストを正規化する（NFKC と大文字小文字の統一）"""
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class _UserIndex:
+    """1人のユーザーの会話履歴の索引（メッセージには追加順の通し番号を付ける）"""
+
+    def __init__(self):
+        self.first_seq = 0
+        self.next_seq = 0
+        self.messages = {}  # 通し番号 -> (メッセージ, 正規化した内容)
+        self.postings = {}  # 2文字の組 -> {通し番号}
+
+    def add(self, message):
+        seq = self.next_seq
+        self.next_seq += 1
+        text = normalize_text(message.get("content", ""))
+        self.messages[seq] = (message, text)
+        for gram in _bigrams(text):
+            self.postings.setdefault(gram, set()).add(seq)
+
+    def trim(self, count):
+        """古い方から count 件を削除する"""
+        end = min(self.first_seq + count, self.next_seq)
+        for seq in range(self.first_seq, end):
+            _, text = self.messages.pop(seq)
+            for gram in _bigrams(text):
+                posting = self.postings.get(gram)
+                if posting is not None:
+                    posting.discard(seq)
+                    if not posting:
+                        del self.postings[gram]
+        self.first_seq = end
+
+    def candidates(self, terms):
+        """全ての検索語の2文字の組を含むメッセージの通し番号を返す"""
+        grams = set()
+        for term in terms:
+            grams |= _bigrams(term)
+        if not grams:
+            # 1文字の検索語だけの場合は全てのメッセージを確認する
+            return set(self.messages)
+        postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            result &= posting
+            if not result:
+                break
+        return result
+
+
+class HistoryIndex:
+    """会話履歴をユーザーごとに検索するためのメモリ上の索引
+
+    内容を2文字ずつの組（bigram）に分けた転置インデックスで候補を絞り込み、
+    検索語が実際に含まれるかを確認する。日本語のように単語の区切りが無い
+    テキストでも部分一致で検索できる。会話履歴の辞書と同じ順番で
+    add / trim / clear_user を呼び出して同期させる。
+    """
+
+    def __init__(self):
+        self.users = {}
+
+    def rebuild(self, history):
+        """会話履歴の辞書 {user_id: [message, ...]} から索引を作り直す"""
+        self.users.clear()
+        for user_id, messages in history.items():
+            for message in messages:
+                self.add(user_id, message)
+
+    def add(self, user_id, message):
+        index = self.users.get(user_id)
+        if index is None:
+            index = self.users[user_id] = _UserIndex()
+        index.add(message)
+
+    def trim(self, user_id, count):
+        index = self.users.get(user_id)
+        if index is not None and count > 0:
+            index.trim(count)
+            if not index.messages:
+                del self.users[user_id]
+
+    def clear_user(self, user_id):
+        self.users.pop(user_id, None)
+
+    def reset_user(self, user_id, messages):
+        """ユーザーの索引を messages から作り直す（他のプロセスで履歴が変わった場合に使う）"""
+        self.users.pop(user_id, None)
+        for message in messages:
+            self.add(user_id, message)
+
+    def search(self, user_id, query="", since=None, until=None, offset=0, limit=10):
+        """ユーザーの会話履歴から全ての検索語を含むメッセージを新しい順に返す
+
+        Args:
+            query (str): スペースで区切った検索語（空の場合は日付だけで絞り込む）
+            since (str): この日付（YYYY-MM-DD）以降のメッセージに限る
+            until (str): この日付（YYYY-MM-DD）以前のメッセージに限る
+            offset (int): 先頭から飛ばす件数（ページ送り用）
+            limit (int): 返す件数
+
+        Returns:
+            tuple: (メッセージのリスト, 条件に一致した件数)
+        """
+        index = self.users.get(user_id)
+        if index is None:
+            return [], 0
+        terms = normalize_text(query).split()
+        matches = []
+        for seq in sorted(index.candidates(terms), reverse=True):
+            message, text = index.messages[seq]
+            date = message.get("timestamp", "")[:10]
+            if (since and date < since) or (until and date > until):
+                continue
+            if all(term in text for term in terms):
+                matches.append(message)
+        return matches[offset:offset + limit], len(matches)
@@ -0,0 +1,101 @@
+"""URLや画像の取得に使う共有の非同期HTTPクライアント"""
+import asyncio
+from collections import namedtuple
+
+import aiohttp
+
+DEFAULT_USER_AGENT = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/91.0.4472.124 Safari/537.36'
+)
+
+# fetch の結果（body はバイト列、headers は大文字小文字を区別しない辞書）
+HTTPResponse = namedtuple("HTTPResponse", ["status", "headers", "body", "url"])
+
+
+class ResponseTooLarge(Exception):
+    """レスポンスが上限サイズを超えた場合の例外"""
+
+
+class HTTPClient:
+    """接続プール付きの aiohttp セッションを1つだけ保持するクライアント
+
+    ボットの起動時に start()、終了時に close() を呼ぶ。
+    ホストごとの同時接続数、DNSキャッシュ、キープアライブ、接続・読み込みのタイムアウトを設定できる。
+
+    Args:
+        limit (int): 全体の同時接続数の上限
+        limit_per_host (int): ホストごとの同時接続数の上限
+        dns_cache_ttl (int): DNSキャッシュの有効期間（秒）
+        keepalive_timeout (float): 使われていない接続を保持する時間（秒）
+        connect_timeout (float): 接続のタイムアウト（秒）
+        read_timeout (float): 読み込みのタイムアウト（秒）
+        total_timeout (float): 1リクエスト全体のタイムアウト（秒）
+        max_bytes (int): 読み込むレスポンスの最大サイズ（バイト）
+    """
+
+    def __init__(self, limit=100, limit_per_host=8, dns_cache_ttl=300, keepalive_timeout=30,
+                 connect_timeout=5, read_timeout=10, total_timeout=30, max_bytes=10 * 1024 * 1024,
+                 user_agent=DEFAULT_USER_AGENT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout, sock_connect=connect_timeout, sock_read=read_timeout
+        )
+        self.max_bytes = max_bytes
+        self.user_agent = user_agent
+        self._session = None
+
+    async def start(self):
+        """セッションを作成する（イベントループ上で呼ぶこと）"""
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=self.timeout,
+            headers={"User-Agent": self.user_agent},
+        )
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            raise RuntimeError("HTTPClient is not started")
+        return self._session
+
+    async def fetch(self, url, headers=None, max_bytes=None):
+        """URLを取得してレスポンス全体を返す
+
+        Raises:
+            aiohttp.ClientError: 接続やHTTPのエラー
+            asyncio.TimeoutError: タイムアウト
+            ResponseTooLarge: レスポンスが max_bytes を超えた場合
+        """
+        if self._session is None or self._session.closed:
+            await self.start()
+        max_bytes = max_bytes or self.max_bytes
+        async with self.session.get(url, headers=headers) as response:
+            if response.content_length is not None and response.content_length > max_bytes:
+                raise ResponseTooLarge(f"レスポンスが大きすぎます（{response.content_length} バイト）")
+            body = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                body.extend(chunk)
+                if len(body) > max_bytes:
+                    raise ResponseTooLarge(f"レスポンスが大きすぎます（{max_bytes} バイト以上）")
+            return HTTPResponse(response.status, response.headers, bytes(body), str(response.url))
+
+
+# 通信エラーとして扱う例外
+FETCH_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ResponseTooLarge)
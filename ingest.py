@@ -0,0 +1,336 @@
+"""ファイルやURLの一覧を知識ベースに一括で取り込むコマンドラインツール
+
+使用方法:
+    python ingest.py docs/ manual.pdf --urls urls.txt --workers 4
+
+ディレクトリは再帰的にたどり、対応している形式（PDF、TXT、Markdown、HTML、CSV、DOCX）の
+ファイルを取り込む。抽出とチャンク分割はボットの !learn_file と同じ関数をプロセスプールで実行し、
+URLは !learn_url と同じ形式で1ページ1エントリとして保存する。
+
+知識ベースへの書き込みは大きなトランザクションでまとめて行い、転置インデックスには最後に
+この実行で追加したエントリだけをまとめて追加する（前回の取り込みが途中で終了して
+インデックスが古いままの場合は全て作り直す）。取り込んだソースと内容のハッシュはマニフェストに記録するので、
+途中で止めても再実行すれば続きから取り込み、変更されたファイルだけを取り込み直す。
+意味検索の埋め込みは、次にボットを起動した時にバックグラウンドで計算される。
+シャードを複数のワーカーで動かしている場合（INVALIDATION_DB_FILE がある場合）は、
+取り込みの完了後に追加・削除した知識を通知し、動作中のワーカーがキャッシュの無効化と
+埋め込みの計算を行う。
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+from extractors import chunk_document, get_extractor, parse_html
+from http_client import FETCH_ERRORS, HTTPClient
+from invalidation import InvalidationBus
+from knowledge_store import open_knowledge_store
+
+
+class Manifest:
+    """取り込んだソースごとの内容のハッシュと、作成した知識IDの記録
+
+    Args:
+        path (str): マニフェストのファイル（JSON）
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sources = {}  # ソース -> {"sha256": ハッシュ, "ids": [知識ID]}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.sources = json.load(f)
+
+    def unchanged(self, source, digest):
+        record = self.sources.get(source)
+        return record is not None and record["sha256"] == digest
+
+    def ids(self, source):
+        record = self.sources.get(source)
+        return record["ids"] if record else []
+
+    def record(self, source, digest, ids):
+        self.sources[source] = {"sha256": digest, "ids": ids}
+
+    def save(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.sources, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+
+class IngestStats:
+    """取り込みの件数とスループット"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.documents = 0
+        self.chunks = 0
+        self.bytes = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.duplicates = 0
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (
+            f"{self.documents} docs, {self.chunks} chunks, {self.bytes / 1e6:.1f} MB in {elapsed:.1f}s "
+            f"({self.documents / elapsed:.1f} docs/s, {self.chunks / elapsed:.1f} chunks/s, "
+            f"{self.bytes / 1e6 / elapsed:.2f} MB/s); unchanged {self.unchanged}, failed {self.failed}, "
+            f"duplicate chunks skipped {self.duplicates}"
+        )
+
+
+class Ingester:
+    """抽出したチャンクを batch_size 件ずつ知識ベースに書き込む
+
+    インデックスは更新せずに書き込み（update_index=False）、finish() で追加したエントリだけを
+    インデックスに追加する。
+    マニフェストはバッチを書き込んだ後に更新するので、記録されたソースは必ず保存済みになる。
+    既存のエントリや取り込み中の他のチャンクと重複するチャンクは書き込まない。
+    """
+
+    def __init__(self, store, manifest, stats, batch_size=5000, added_by="ingest"):
+        self.store = store
+        self.manifest = manifest
+        self.stats = stats
+        self.batch_size = batch_size
+        self.added_by = added_by
+        self.entries = []
+        self.sources = []  # (ソース, ハッシュ, 知識ID) のうち、まだ書き込んでいないもの
+        self.modified = False
+        # 動作中のボットに通知するために、追加・削除した知識IDを記録する
+        self.added_ids = []
+        self.removed_ids = []
+        # 前回の取り込みが途中で終了していた場合は、finish() でインデックスを全て作り直す
+        self.index_was_current = store.index_current()
+
+    def add_document(self, source, digest, size, chunks, title=None):
+        # 変更されたソースは以前のエントリを削除してから取り込み直す
+        for knowledge_id in self.manifest.ids(source):
+            if self.store.delete(knowledge_id):
+                self.modified = True
+                self.removed_ids.append(knowledge_id)
+
+        timestamp = datetime.datetime.now().isoformat()
+        entries = []
+        for chunk in chunks:
+            entry = {"content": chunk, "added_by": self.added_by, "timestamp": timestamp}
+            if title:
+                entry["title"] = title
+            entries.append((str(uuid.uuid4()), entry))
+        self.entries.extend(entries)
+        self.sources.append((source, digest, [knowledge_id for knowledge_id, _ in entries]))
+        self.stats.documents += 1
+        self.stats.bytes += size
+        if len(self.entries) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # 重複の除外はバッチ単位で行い、ストレージが書き込みと同じトランザクションで登録する
+        entries, skipped = self.store.filter_duplicates(self.entries)
+        self.stats.chunks += len(entries)
+        self.stats.duplicates += skipped
+        if entries:
+            self.store.add_many(entries, update_index=False)
+            self.modified = True
+            self.added_ids.extend(knowledge_id for knowledge_id, _ in entries)
+        kept = {knowledge_id for knowledge_id, _ in entries}
+        for source, digest, ids in self.sources:
+            self.manifest.record(source, digest, [knowledge_id for knowledge_id in ids if knowledge_id in kept])
+        if self.sources:
+            self.manifest.save()
+        self.entries = []
+        self.sources = []
+
+    def finish(self):
+        self.flush()
+        if not self.modified:
+            return
+        started = time.monotonic()
+        if self.index_was_current:
+            self.store.index_entries(self.added_ids)
+            print(f"Indexed {len(self.added_ids)} new entries in {time.monotonic() - started:.1f}s")
+        else:
+            self.store.rebuild_index()
+            print(f"Rebuilt search index for {len(self.store)} entries in {time.monotonic() - started:.1f}s")
+
+    def notify(self, bus, batch_size=1000):
+        """動作中のボットのワーカーに、追加・削除した知識を知らせる（インデックスの作り直し後に呼ぶ）"""
+        for knowledge_id in self.removed_ids:
+            bus.publish("knowledge_removed", knowledge_id)
+        for i in range(0, len(self.added_ids), batch_size):
+            bus.publish("knowledge_added", json.dumps(self.added_ids[i:i + batch_size]))
+        self.removed_ids = []
+        self.added_ids = []
+
+
+def iter_files(paths):
+    """パス（ファイルまたはディレクトリ）から対応している形式のファイルを順に返す"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if get_extractor(name) is not None:
+                        yield os.path.join(root, name)
+        elif get_extractor(path) is not None:
+            yield path
+        else:
+            print(f"Skipping unsupported file: {path}")
+
+
+def read_url_list(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+async def ingest_files(paths, ingester, executor, workers):
+    """ファイルを読み込んでハッシュを確認し、変更されたものをプロセスプールで抽出する"""
+    loop = asyncio.get_running_loop()
+    stats = ingester.stats
+    pending = {}
+
+    async def collect(return_when):
+        done, _ = await asyncio.wait(pending, return_when=return_when)
+        for future in done:
+            source, digest, size = pending.pop(future)
+            try:
+                chunks = future.result()
+            except Exception as e:
+                stats.failed += 1
+                print(f"Error processing {source}: {e}")
+                continue
+            ingester.add_document(source, digest, size, chunks)
+
+    for path in iter_files(paths):
+        source = os.path.abspath(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if ingester.manifest.unchanged(source, digest):
+            stats.unchanged += 1
+            continue
+        # 抽出待ちのファイルがたまりすぎないようにする
+        if len(pending) >= workers * 2:
+            await collect(asyncio.FIRST_COMPLETED)
+        future = loop.run_in_executor(executor, chunk_document, path, data)
+        pending[future] = (source, digest, len(data))
+    if pending:
+        await collect(asyncio.ALL_COMPLETED)
+
+
+async def ingest_urls(urls, ingester, executor, concurrency=8, max_length=8000):
+    """URLの一覧を取得して !learn_url と同じ形式で取り込む"""
+    loop = asyncio.get_running_loop()
+    stats = ingester.stats
+    http_client = HTTPClient()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def ingest_url(url):
+        async with semaphore:
+            try:
+                response = await http_client.fetch(url)
+            except FETCH_ERRORS as e:
+                stats.failed += 1
+                print(f"Error fetching {url}: {e}")
+                return
+        if response.status >= 400:
+            stats.failed += 1
+            print(f"Error fetching {url}: HTTP {response.status}")
+            return
+        content_type = response.headers.get("Content-Type", "").lower()
+        if "text/html" not in content_type and "application/xhtml+xml" not in content_type:
+            stats.failed += 1
+            print(f"Skipping non-HTML URL: {url}")
+            return
+        digest = hashlib.sha256(response.body).hexdigest()
+        if ingester.manifest.unchanged(url, digest):
+            stats.unchanged += 1
+            return
+        title, content = await loop.run_in_executor(executor, parse_html, response.body, max_length)
+        knowledge_content = f"タイトル: {title}\nURL: {url}\n\n内容: {content}"
+        ingester.add_document(url, digest, len(response.body), [knowledge_content], title=title)
+
+    await http_client.start()
+    try:
+        await asyncio.gather(*(ingest_url(url) for url in urls))
+    finally:
+        await http_client.close()
+
+
+async def report_progress(stats, interval=5.0):
+    while True:
+        await asyncio.sleep(interval)
+        print(stats.report())
+
+
+async def run(args):
+    store = open_knowledge_store(args.backend, args.db, near_duplicates=args.near_duplicates,
+                                 dedup_threshold=args.threshold)
+    manifest = Manifest(args.manifest or f"{args.db}.manifest.json")
+    stats = IngestStats()
+    ingester = Ingester(store, manifest, stats, batch_size=args.batch_size, added_by=args.added_by)
+    reporter = asyncio.create_task(report_progress(stats))
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            if args.paths:
+                await ingest_files(args.paths, ingester, executor, args.workers)
+            if args.urls:
+                await ingest_urls(read_url_list(args.urls), ingester, executor, concurrency=args.url_concurrency)
+        ingester.finish()
+        invalidation_db = os.getenv("INVALIDATION_DB_FILE", "invalidation.db")
+        if args.backend == "sqlite" and os.path.exists(invalidation_db):
+            bus = InvalidationBus(invalidation_db)
+            try:
+                ingester.notify(bus)
+            finally:
+                bus.close()
+    finally:
+        reporter.cancel()
+        store.close()
+    print(stats.report())
+
+
+def main(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="ファイルやURLを知識ベースに一括で取り込む")
+    parser.add_argument("paths", nargs="*", help="取り込むファイルまたはディレクトリ")
+    parser.add_argument("--urls", help="取り込むURLを1行に1つずつ書いたファイル")
+    parser.add_argument("--backend", default=os.getenv("KNOWLEDGE_BACKEND", "sqlite"), choices=["sqlite", "json"])
+    parser.add_argument("--db", help="知識ベースのファイル（デフォルトはボットと同じ設定）")
+    parser.add_argument("--manifest", help="マニフェストのファイル（デフォルトは <db>.manifest.json）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="抽出に使うプロセス数")
+    parser.add_argument("--batch-size", type=int, default=5000, help="1トランザクションで書き込むチャンク数")
+    parser.add_argument("--url-concurrency", type=int, default=8, help="同時に取得するURLの数")
+    parser.add_argument("--added-by", default="ingest", help="エントリの added_by に記録する名前")
+    parser.add_argument(
+        "--near-duplicates", action="store_true",
+        default=os.getenv("DEDUP_NEAR_DUPLICATES", "false").lower() in ("1", "true", "yes"),
+        help="ほぼ同じ内容のチャンクも重複としてスキップする",
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=float(os.getenv("DEDUP_THRESHOLD", "0.85")),
+        help="近似重複とみなす類似度（0〜1）",
+    )
+    args = parser.parse_args(argv)
+    if not args.paths and not args.urls:
+        parser.error("取り込むファイル、ディレクトリ、または --urls を指定してください")
+    if args.db is None:
+        if args.backend == "sqlite":
+            args.db = os.getenv("KNOWLEDGE_DB_FILE", "knowledge_base.db")
+        else:
+            args.db = "knowledge_base.json"
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
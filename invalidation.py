@@ -0,0 +1,108 @@
+"""複数のプロセス（シャードのワーカー）の間でキャッシュの無効化を知らせるイベントバス
+
+イベントは共有の SQLite データベースに追記し、各プロセスが定期的に新しいイベントを読み出して
+トピックごとのコールバックを呼び出す。自分が発行したイベントは受け取らない。
+Redis などのサーバーを使う実装に置き換える場合は、publish / subscribe / start / close を
+同じ形で実装すればよい。
+"""
+import asyncio
+import os
+import socket
+import sqlite3
+import time
+
+
+class InvalidationBus:
+    """SQLite のテーブルを使ったイベントバス
+
+    Args:
+        path (str): データベースファイルのパス（全てのワーカーで同じファイルを使う）
+        origin (str): このプロセスの識別子
+        poll_interval (float): 新しいイベントを確認する間隔（秒）
+        retention (float): イベントを残しておく時間（秒）
+    """
+
+    def __init__(self, path, origin=None, poll_interval=0.5, retention=3600, timeout=30.0):
+        self.path = path
+        self.origin = origin or f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    origin TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    key TEXT,
+                    created_at REAL NOT NULL
+                )"""
+            )
+        # 起動前のイベントは読み込んだ状態に反映済みなので、現在の位置から読み始める
+        self.last_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+        self._handlers = {}  # トピック -> [コールバック]
+        self._task = None
+        self.published = 0
+        self.received = 0
+
+    def subscribe(self, topic, callback):
+        """topic のイベントを受け取った時に callback(key) を呼び出す"""
+        self._handlers.setdefault(topic, []).append(callback)
+
+    def publish(self, topic, key=None):
+        """他のプロセスにイベントを知らせる"""
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO events (origin, topic, key, created_at) VALUES (?, ?, ?, ?)",
+                (self.origin, topic, key, time.time()),
+            )
+        self.published += 1
+
+    def poll(self):
+        """新しいイベントを読み出してコールバックを呼び出し、処理した件数を返す"""
+        rows = self.conn.execute(
+            "SELECT id, origin, topic, key FROM events WHERE id > ? ORDER BY id", (self.last_id,)
+        ).fetchall()
+        handled = 0
+        for event_id, origin, topic, key in rows:
+            self.last_id = event_id
+            if origin == self.origin:
+                continue
+            for callback in self._handlers.get(topic, []):
+                try:
+                    callback(key)
+                except Exception as e:
+                    print(f"Error handling invalidation {topic} ({key}): {e}")
+            handled += 1
+        self.received += handled
+        return handled
+
+    def prune(self):
+        """保存期間を過ぎたイベントを削除する"""
+        with self.conn:
+            self.conn.execute("DELETE FROM events WHERE created_at < ?", (time.time() - self.retention,))
+
+    async def _run(self):
+        last_prune = time.monotonic()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                self.poll()
+                if time.monotonic() - last_prune >= self.retention / 10:
+                    self.prune()
+                    last_prune = time.monotonic()
+            except sqlite3.Error as e:
+                print(f"Error polling invalidation events: {e}")
+
+    def start(self):
+        """イベントの確認をバックグラウンドで開始する"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.conn.close()
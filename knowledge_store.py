@@ -0,0 +1,410 @@
+"""知識ベースの保存先（ストレージバックエンド）"""
+import json
+import os
+import sqlite3
+import sys
+
+from dedup import Deduplicator, SQLiteDeduplicator
+from search_index import INDEX_VERSION, InvertedIndex, SQLiteInvertedIndex, search_index
+
+
+class KnowledgeStore:
+    """知識ベースのストレージの共通インターフェース
+
+    各エントリは {"content": str, "added_by": str, "timestamp": str} 形式の辞書で、
+    知識ID（文字列）をキーとして保存する。URLから学習したエントリなどは "title" を持つ場合がある。
+    重複検出のインデックス（self.dedup）もストレージが保存に合わせて更新する。
+    """
+
+    def add(self, knowledge_id, entry):
+        self.add_many([(knowledge_id, entry)])
+
+    def add_many(self, entries, update_index=True):
+        """(knowledge_id, entry) のリストをまとめて追加し、追加した件数を返す
+
+        update_index=False の場合は転置インデックスの更新を後回しにする
+        （一括取り込み用。最後に index_entries() または rebuild_index() を呼ぶこと）。
+        """
+        raise NotImplementedError
+
+    def rebuild_index(self):
+        """全てのエントリから転置インデックスを作り直す"""
+        raise NotImplementedError
+
+    def index_current(self):
+        """転置インデックスが最新の形式で、全てのエントリを含んでいる場合は True を返す"""
+        return True
+
+    def index_entries(self, knowledge_ids):
+        """update_index=False で追加したエントリだけを転置インデックスに追加する"""
+        raise NotImplementedError
+
+    def get(self, knowledge_id):
+        raise NotImplementedError
+
+    def get_many(self, knowledge_ids):
+        """{knowledge_id: entry} を返す（存在しないIDは含まない）"""
+        entries = {}
+        for knowledge_id in knowledge_ids:
+            entry = self.get(knowledge_id)
+            if entry is not None:
+                entries[knowledge_id] = entry
+        return entries
+
+    def delete(self, knowledge_id):
+        """エントリを削除する。削除できた場合は True を返す"""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def iter_entries(self):
+        """(knowledge_id, entry) を順に返す"""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def search(self, query, limit=5, ranker="legacy"):
+        """転置インデックスを使ってクエリに関連するエントリを検索する
+
+        Args:
+            ranker (str): "legacy"（従来のスコア）または "bm25"
+
+        Returns:
+            list: (knowledge_id, entry) のリスト（スコアの高い順）
+        """
+        return search_index(self.index, query, self.get_many, limit=limit, ranker=ranker)
+
+    def search_with_scores(self, query, limit=5, ranker="legacy"):
+        """search と同じだが (knowledge_id, entry, score) のリストを返す"""
+        return search_index(self.index, query, self.get_many, limit=limit, ranker=ranker, with_scores=True)
+
+    def find_duplicate(self, content):
+        """内容が重複するエントリのIDを返す（無ければ None）"""
+        return self.dedup.find_duplicate(content)
+
+    def filter_duplicates(self, entries):
+        """(knowledge_id, entry) のリストから既存のエントリやリスト内で重複するものを取り除く
+
+        Returns:
+            tuple: (残したエントリのリスト, スキップした件数)
+        """
+        return self.dedup.filter(entries)
+
+    def __contains__(self, knowledge_id):
+        return self.get(knowledge_id) is not None
+
+    def close(self):
+        pass
+
+
+class JSONKnowledgeStore(KnowledgeStore):
+    """従来の knowledge_base.json 形式のストレージ（変更のたびにファイル全体を書き直す）"""
+
+    def __init__(self, path, near_duplicates=False, dedup_threshold=0.85):
+        self.path = path
+        self.entries = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            self.entries = json.loads(content) if content.strip() else {}
+        except FileNotFoundError:
+            self.entries = {}
+        except json.JSONDecodeError:
+            print("Error decoding knowledge base file. Starting with empty knowledge base.")
+            self.entries = {}
+        # JSONストレージではインデックスをメモリ上に作成する
+        self.index = InvertedIndex()
+        self.dedup = Deduplicator(near_duplicates=near_duplicates, threshold=dedup_threshold)
+        for knowledge_id, entry in self.entries.items():
+            self.index.add(knowledge_id, entry["content"], entry.get("title"))
+            self.dedup.add(knowledge_id, entry["content"])
+
+    def _save(self):
+        """ファイルに書き込み、成功した場合は True を返す"""
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False, indent=4)
+            return True
+        except Exception as e:
+            print(f"Error saving knowledge base: {e}")
+            return False
+
+    def add_many(self, entries, update_index=True):
+        # メモリ上のインデックスは安価なので常に更新する
+        entries = list(entries)
+        for knowledge_id, entry in entries:
+            self.entries[knowledge_id] = entry
+            self.index.add(knowledge_id, entry["content"], entry.get("title"))
+        # 重複検出には保存できたエントリだけを登録する
+        if entries and self._save():
+            self.dedup.add_many((knowledge_id, entry["content"]) for knowledge_id, entry in entries)
+        return len(entries)
+
+    def get(self, knowledge_id):
+        return self.entries.get(knowledge_id)
+
+    def delete(self, knowledge_id):
+        if knowledge_id not in self.entries:
+            return False
+        del self.entries[knowledge_id]
+        self.index.remove(knowledge_id)
+        self.dedup.remove(knowledge_id)
+        self._save()
+        return True
+
+    def clear(self):
+        self.entries = {}
+        self.index.clear()
+        self.dedup.clear()
+        self._save()
+
+    def rebuild_index(self):
+        self.index.clear()
+        for knowledge_id, entry in self.entries.items():
+            self.index.add(knowledge_id, entry["content"], entry.get("title"))
+
+    def index_entries(self, knowledge_ids):
+        # メモリ上のインデックスは add_many で更新済み
+        pass
+
+    def iter_entries(self):
+        # 反復中の変更に備えてコピーを返す
+        return iter(list(self.entries.items()))
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SQLiteKnowledgeStore(KnowledgeStore):
+    """SQLite（WALモード）を使ったストレージ
+
+    追加はトランザクション単位でまとめて行い、削除は主キーで行う。
+    転置インデックスと重複検出のインデックスも同じデータベースに保存し、本体と同じトランザクションで更新する。
+    """
+
+    def __init__(self, path, batch_size=1000, timeout=30.0, near_duplicates=False, dedup_threshold=0.85):
+        self.path = path
+        self.batch_size = batch_size
+        # 複数のワーカープロセスで共有する場合は、他のプロセスの書き込みが終わるまで timeout 秒待つ
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+        self.index = SQLiteInvertedIndex(self.conn)
+        if self.get_meta("index_version") != INDEX_VERSION:
+            self.index.reset()
+            self.rebuild_index()
+        self.dedup = SQLiteDeduplicator(self.conn, near_duplicates=near_duplicates, threshold=dedup_threshold)
+        if self.get_meta("dedup_config") != self.dedup.config:
+            # 初めて開いた場合や近似重複の検出の設定を変えた場合は、全てのエントリから作り直す
+            self.rebuild_dedup()
+
+    def _create_schema(self):
+        with self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS knowledge (
+                    id TEXT PRIMARY KEY,
+                    content TEXT NOT NULL,
+                    added_by TEXT,
+                    timestamp TEXT
+                )"""
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(knowledge)")]
+            if "title" not in columns:
+                self.conn.execute("ALTER TABLE knowledge ADD COLUMN title TEXT")
+
+    @staticmethod
+    def _row_to_entry(row):
+        entry = {"content": row[0], "added_by": row[1], "timestamp": row[2]}
+        if row[3] is not None:
+            entry["title"] = row[3]
+        return entry
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def add_many(self, entries, update_index=True):
+        rows = [
+            (knowledge_id, entry["content"], entry.get("added_by"), entry.get("timestamp"), entry.get("title"))
+            for knowledge_id, entry in entries
+        ]
+        if not update_index:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO knowledge (id, content, added_by, timestamp, title) VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self.dedup.add_many((row[0], row[1]) for row in rows)
+                # 途中で終了しても次に開いた時にインデックスが作り直されるようにする
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('index_version', '')")
+            return len(rows)
+        existing = self.get_many(row[0] for row in rows)
+        with self.conn:
+            for knowledge_id, entry in existing.items():
+                # 置き換えの場合は古いインデックスを削除する
+                self.index.remove(knowledge_id, entry["content"], entry.get("title"))
+                self.dedup.remove(knowledge_id)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO knowledge (id, content, added_by, timestamp, title) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.index.add_many((row[0], row[1], row[4]) for row in rows)
+            self.dedup.add_many((row[0], row[1]) for row in rows)
+        return len(rows)
+
+    def get(self, knowledge_id):
+        row = self.conn.execute(
+            "SELECT content, added_by, timestamp, title FROM knowledge WHERE id = ?", (knowledge_id,)
+        ).fetchone()
+        return self._row_to_entry(row) if row else None
+
+    def get_many(self, knowledge_ids):
+        knowledge_ids = list(knowledge_ids)
+        entries = {}
+        # SQLiteのパラメータ数の上限を超えないように分けて取得する
+        for i in range(0, len(knowledge_ids), 500):
+            batch = knowledge_ids[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            for row in self.conn.execute(
+                f"SELECT id, content, added_by, timestamp, title FROM knowledge WHERE id IN ({placeholders})", batch
+            ):
+                entries[row[0]] = self._row_to_entry(row[1:])
+        return entries
+
+    def delete(self, knowledge_id):
+        entry = self.get(knowledge_id)
+        if entry is None:
+            return False
+        with self.conn:
+            self.conn.execute("DELETE FROM knowledge WHERE id = ?", (knowledge_id,))
+            self.index.remove(knowledge_id, entry["content"], entry.get("title"))
+            self.dedup.remove(knowledge_id)
+        return True
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM knowledge")
+            self.index.clear()
+            self.dedup.clear()
+
+    def rebuild_index(self):
+        with self.conn:
+            self.index.clear()
+            batch = []
+            for knowledge_id, entry in self.iter_entries():
+                batch.append((knowledge_id, entry["content"], entry.get("title")))
+                if len(batch) >= self.batch_size:
+                    self.index.add_many(batch)
+                    batch = []
+            if batch:
+                self.index.add_many(batch)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('index_version', ?)", (INDEX_VERSION,)
+            )
+
+    def index_current(self):
+        return self.get_meta("index_version") == INDEX_VERSION
+
+    def index_entries(self, knowledge_ids):
+        """batch_size 件ずつ別のトランザクションでインデックスに追加し、他のプロセスの書き込みを長く待たせない
+
+        全て追加したらインデックスの形式を記録し直す（途中で終了した場合は次に開いた時に作り直される）。
+        """
+        knowledge_ids = list(knowledge_ids)
+        for i in range(0, len(knowledge_ids), self.batch_size):
+            entries = self.get_many(knowledge_ids[i:i + self.batch_size])
+            with self.conn:
+                self.index.add_many(
+                    (knowledge_id, entry["content"], entry.get("title")) for knowledge_id, entry in entries.items()
+                )
+        self.set_meta("index_version", INDEX_VERSION)
+
+    def rebuild_dedup(self):
+        """全てのエントリから重複検出のインデックスを作り直す"""
+        self.dedup.reset()
+        with self.conn:
+            batch = []
+            for knowledge_id, entry in self.iter_entries():
+                batch.append((knowledge_id, entry["content"]))
+                if len(batch) >= self.batch_size:
+                    self.dedup.add_many(batch)
+                    batch = []
+            if batch:
+                self.dedup.add_many(batch)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('dedup_config', ?)", (self.dedup.config,)
+            )
+
+    def iter_entries(self):
+        cursor = self.conn.execute("SELECT id, content, added_by, timestamp, title FROM knowledge")
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row[0], self._row_to_entry(row[1:])
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM knowledge").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def migrate_json_to_sqlite(json_path, store, batch_size=1000):
+    """knowledge_base.json の内容を SQLite ストレージに移行する
+
+    移行済みの場合は何もしない。移行した件数を返す。
+    """
+    if store.get_meta("migrated_from_json"):
+        return 0
+    if not os.path.exists(json_path):
+        return 0
+
+    source = JSONKnowledgeStore(json_path)
+    batch = []
+    migrated = 0
+    for knowledge_id, entry in source.iter_entries():
+        batch.append((knowledge_id, entry))
+        if len(batch) >= batch_size:
+            migrated += store.add_many(batch)
+            batch = []
+    if batch:
+        migrated += store.add_many(batch)
+    store.set_meta("migrated_from_json", json_path)
+    return migrated
+
+
+def open_knowledge_store(backend, path, near_duplicates=False, dedup_threshold=0.85):
+    """設定に応じたストレージを開く
+
+    Args:
+        backend (str): "sqlite" または "json"
+        path (str): ストレージファイルのパス
+        near_duplicates (bool): 重複検出で近似重複も検出するかどうか
+        dedup_threshold (float): 近似重複とみなす類似度（0〜1）
+    """
+    if backend == "json":
+        return JSONKnowledgeStore(path, near_duplicates=near_duplicates, dedup_threshold=dedup_threshold)
+    if backend == "sqlite":
+        return SQLiteKnowledgeStore(path, near_duplicates=near_duplicates, dedup_threshold=dedup_threshold)
+    raise ValueError(f"Unknown knowledge store backend: {backend}")
+
+
+if __name__ == "__main__":
+    # 使用方法: python knowledge_store.py <knowledge_base.json> <knowledge_base.db>
+    if len(sys.argv) != 3:
+        print("Usage: python knowledge_store.py <knowledge_base.json> <knowledge_base.db>")
+        sys.exit(1)
+    target = SQLiteKnowledgeStore(sys.argv[2])
+    count = migrate_json_to_sqlite(sys.argv[1], target)
+    print(f"Migrated {count} knowledge entries to {sys.argv[2]}")
+    target.close()
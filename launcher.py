@@ -0,0 +1,183 @@
+"""シャードを複数のワーカープロセスに分けてボットを起動するランチャー
+
+使用方法:
+    python launcher.py --workers 4                      # 推奨シャード数を全てこのマシンで動かす
+    python launcher.py --shard-count 16 --shard-ids 0-7 --workers 2   # 複数のマシンで分担する場合
+
+各ワーカーは bot.py を SHARD_COUNT、SHARD_IDS、WORKER_ID を設定して起動したプロセスで、
+担当するシャードを AutoShardedBot で接続する。知識ベースと会話履歴は SQLite の共有の
+データベースに保存し、キャッシュの無効化はイベントバス（invalidation.py）で他のワーカーに知らせる。
+ワーカーは Discord の IDENTIFY の制限に合わせて間隔を空けて起動し、異常終了した場合は
+間隔を延ばしながら再起動する。
+
+共有のデータベースは SQLite のファイルなので、複数のマシンで分担する場合は
+同じファイルを安全に共有できる仕組み（または同じ形のサーバーを使う実装）が必要になる。
+"""
+import argparse
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from history_store import SQLiteHistoryStore, migrate_journal_to_sqlite
+from invalidation import InvalidationBus
+from knowledge_store import migrate_json_to_sqlite, open_knowledge_store
+from sharding import assign_shards, fetch_gateway_info, format_shard_ids, parse_shard_ids
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_SCRIPT = os.path.join(REPO_DIR, "bot.py")
+
+
+def prepare_shared_state():
+    """ワーカーを起動する前に共有のデータベースを作成し、移行とインデックスの作成を1回だけ行う"""
+    if os.getenv("KNOWLEDGE_BACKEND", "sqlite") != "sqlite":
+        raise SystemExit("Sharded mode requires KNOWLEDGE_BACKEND=sqlite")
+    # 重複検出のインデックスもボットと同じ設定でここで作成しておく
+    store = open_knowledge_store(
+        "sqlite", os.getenv("KNOWLEDGE_DB_FILE", "knowledge_base.db"),
+        near_duplicates=os.getenv("DEDUP_NEAR_DUPLICATES", "false").lower() in ("1", "true", "yes"),
+        dedup_threshold=float(os.getenv("DEDUP_THRESHOLD", "0.85")),
+    )
+    try:
+        migrated = migrate_json_to_sqlite("knowledge_base.json", store)
+        if migrated:
+            print(f"Migrated {migrated} knowledge entries from knowledge_base.json")
+        print(f"Knowledge base: {len(store)} entries")
+    finally:
+        store.close()
+
+    history = SQLiteHistoryStore({}, os.getenv("HISTORY_DB_FILE", "conversation_history.db"))
+    try:
+        migrated = migrate_journal_to_sqlite("conversation_history.json", history)
+        if migrated:
+            print(f"Migrated {migrated} history messages from conversation_history.json")
+    finally:
+        history.close()
+
+    InvalidationBus(os.getenv("INVALIDATION_DB_FILE", "invalidation.db")).close()
+
+
+class Worker:
+    """1つのワーカープロセスと、その担当シャード"""
+
+    def __init__(self, worker_id, shard_ids, shard_count):
+        self.worker_id = worker_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.started = 0.0
+        self.restarts = 0
+        self.restart_at = None
+
+    def start(self):
+        env = dict(os.environ)
+        env.update({
+            "SHARD_COUNT": str(self.shard_count),
+            "SHARD_IDS": format_shard_ids(self.shard_ids),
+            "WORKER_ID": str(self.worker_id),
+        })
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env)
+        self.started = time.monotonic()
+        self.restart_at = None
+        print(f"Worker {self.worker_id} (pid {self.process.pid}) owns shards "
+              f"{format_shard_ids(self.shard_ids)} of {self.shard_count}")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            # SIGINT で bot.run の終了処理（履歴の保存など）を実行させる
+            self.process.send_signal(signal.SIGINT)
+
+
+def run(workers, identify_interval, max_concurrency, restart_delay, max_restart_delay):
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    # 前のワーカーのシャードが IDENTIFY し終わるまで待ってから次のワーカーを起動する
+    for i, worker in enumerate(workers):
+        if stopping:
+            break
+        worker.start()
+        if i + 1 < len(workers):
+            time.sleep(math.ceil(len(worker.shard_ids) / max_concurrency) * identify_interval)
+
+    while not stopping:
+        time.sleep(1.0)
+        now = time.monotonic()
+        for worker in workers:
+            if worker.process is None or worker.process.poll() is None:
+                continue
+            if worker.restart_at is None:
+                # 長く動いていたワーカーの再起動は間隔をリセットする
+                if now - worker.started > max_restart_delay * 5:
+                    worker.restarts = 0
+                delay = min(max_restart_delay, restart_delay * 2 ** worker.restarts)
+                worker.restarts += 1
+                worker.restart_at = now + delay
+                print(f"Worker {worker.worker_id} exited with code {worker.process.returncode}; "
+                      f"restarting in {delay:.0f}s")
+            elif now >= worker.restart_at:
+                worker.start()
+
+    print("Stopping workers...")
+    for worker in workers:
+        worker.stop()
+    deadline = time.monotonic() + 30
+    for worker in workers:
+        if worker.process is None:
+            continue
+        try:
+            worker.process.wait(timeout=max(0.1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            worker.process.kill()
+
+
+def main(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="シャードを複数のワーカープロセスに分けてボットを起動する")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SHARD_WORKERS", str(os.cpu_count() or 1))),
+                        help="起動するワーカープロセスの数")
+    parser.add_argument("--shard-count", default=os.getenv("SHARD_COUNT", "auto"),
+                        help="全体のシャード数（auto の場合は Discord の推奨値）")
+    parser.add_argument("--shard-ids", default=os.getenv("SHARD_IDS", ""),
+                        help="このマシンで動かすシャード（\"0-7\" など、省略時は全て）")
+    parser.add_argument("--identify-interval", type=float, default=5.0,
+                        help="同じ枠のシャードが IDENTIFY する間隔（秒）")
+    parser.add_argument("--restart-delay", type=float, default=5.0, help="異常終了したワーカーを再起動するまでの時間（秒）")
+    parser.add_argument("--max-restart-delay", type=float, default=300.0, help="再起動までの時間の上限（秒）")
+    args = parser.parse_args(argv)
+
+    token = os.getenv("DISCORD_TOKEN")
+    if not token:
+        raise SystemExit("DISCORD_TOKEN not found in environment variables")
+
+    max_concurrency = 1
+    # SHARD_COUNT=0（シャーディングしない設定）で起動した場合も推奨値を使う
+    if args.shard_count in ("auto", "", "0"):
+        shard_count, max_concurrency = fetch_gateway_info(token)
+        print(f"Discord recommends {shard_count} shards (max_concurrency {max_concurrency})")
+    else:
+        shard_count = int(args.shard_count)
+    shard_ids = parse_shard_ids(args.shard_ids) or list(range(shard_count))
+    if any(shard_id >= shard_count for shard_id in shard_ids):
+        raise SystemExit(f"Shard IDs must be less than the shard count ({shard_count})")
+
+    prepare_shared_state()
+    workers = [
+        Worker(worker_id, assigned, shard_count)
+        for worker_id, assigned in enumerate(assign_shards(shard_ids, args.workers))
+    ]
+    run(workers, args.identify_interval, max_concurrency, args.restart_delay, args.max_restart_delay)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,588 @@
+"""Discord と Gemini を使わずに bot.py のコマンドに負荷をかけるツール
+
+使用方法:
+    python loadtest.py --users 2000 --requests 20000 --rate 500
+    python loadtest.py --record trace.jsonl --requests 5000   # 合成したトレースを保存する
+    python loadtest.py --trace trace.jsonl --json report.json  # 保存したトレースを再生する
+
+ボットは一時ディレクトリをカレントディレクトリにして読み込むので、知識ベースや会話履歴などの
+ファイルは一時ディレクトリに作られる。Gemini のモデルは指定した分布の遅延で定型の応答を返す
+スタブに置き換え、URLと画像の取得はローカルのHTTPサーバーに向ける。コマンドは
+Discord を経由せずに本物のコマンド関数を偽の Context で直接呼び出す。
+
+トレースは1行1件のJSONで、at（開始からの秒数）、user、guild、command、args を持つ。
+結果としてコマンドごとのスループット、レイテンシー（完了までと最初の返信まで）の p50/p99、
+イベントループの停止時間、メモリ使用量の増加を表示する。
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import gc
+import json
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from aiohttp import web
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 合成トレースのコマンドの割合
+DEFAULT_MIX = {
+    "ask": 0.5,
+    "search": 0.1,
+    "learn": 0.05,
+    "search_history": 0.1,
+    "search_messages": 0.1,
+    "search_web": 0.05,
+    "ask_url": 0.05,
+    "analyze_image": 0.05,
+}
+
+WORDS = [
+    "東京", "大阪", "天気", "電車", "料理", "歴史", "音楽", "映画", "旅行", "健康",
+    "python", "discord", "database", "network", "cache", "latency", "memory", "server", "search", "index",
+]
+
+# 1x1 の PNG 画像
+PNG_IMAGE = bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+    "0000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)
+
+
+# ---- Gemini のスタブ ----
+
+class LatencyModel:
+    """対数正規分布の遅延（中央値 median 秒、ばらつき sigma）"""
+
+    def __init__(self, median=0.5, sigma=0.5, rng=None):
+        self.median = median
+        self.sigma = sigma
+        self.rng = rng or random.Random(0)
+
+    def sample(self):
+        if self.median <= 0:
+            return 0.0
+        return self.rng.lognormvariate(math.log(self.median), self.sigma)
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeStream:
+    """send_message_async / generate_content_async(stream=True) の応答（テキストのチャンクを遅延付きで返す）"""
+
+    def __init__(self, chunks, delay):
+        self.chunks = chunks
+        self.delay = delay
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.delay)
+            yield FakeResponse(chunk)
+
+
+class FakeChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    async def send_message_async(self, prompt, stream=False):
+        text = self.model.reply_text(prompt)
+        self.history.append({"role": "user", "parts": [prompt]})
+        self.history.append({"role": "model", "parts": [text]})
+        latency = self.model.latency.sample()
+        if stream:
+            size = max(1, len(text) // self.model.stream_chunks)
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            return FakeStream(chunks, latency / len(chunks))
+        await asyncio.sleep(latency)
+        return FakeResponse(text)
+
+    def send_message(self, prompt):
+        # 非同期APIがある場合は使われない
+        raise NotImplementedError
+
+
+class FakeModel:
+    """genai.GenerativeModel の代わりに定型の応答を返すモデル"""
+
+    def __init__(self, latency, response_chars=600, stream_chunks=5):
+        self.latency = latency
+        self.response_chars = response_chars
+        self.stream_chunks = max(1, stream_chunks)
+        self.calls = 0
+
+    def reply_text(self, prompt):
+        self.calls += 1
+        base = f"これは負荷試験用の応答です（プロンプト {len(prompt)} 文字）。"
+        return (base * (self.response_chars // len(base) + 1))[:self.response_chars]
+
+    def start_chat(self, history=None):
+        return FakeChat(self, history)
+
+    async def generate_content_async(self, contents, stream=False):
+        text = self.reply_text(str(contents)[:200])
+        latency = self.latency.sample()
+        if stream:
+            size = max(1, len(text) // self.stream_chunks)
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            return FakeStream(chunks, latency / len(chunks))
+        await asyncio.sleep(latency)
+        return FakeResponse(text)
+
+    async def count_tokens_async(self, contents):
+        class Tokens:
+            total_tokens = len(str(contents)) // 2
+        return Tokens()
+
+    def generate_content(self, contents):
+        raise NotImplementedError
+
+    def count_tokens(self, contents):
+        raise NotImplementedError
+
+
+# ---- Discord の偽オブジェクト ----
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.nick = None
+        self.mention = f"<@{user_id}>"
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.name = f"channel{channel_id}"
+
+    def history(self, limit=100, **kwargs):
+        # インデックスが無効の場合の検索用（メッセージは無いものとする）
+        async def empty():
+            return
+            yield
+        return empty()
+
+
+class FakeMessage:
+    _next_id = 1 << 40
+
+    def __init__(self, ctx, content=None, embed=None, author=None, channel=None):
+        FakeMessage._next_id += 1
+        self.id = FakeMessage._next_id
+        self.ctx = ctx
+        self.content = content or ""
+        self.embed = embed
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild if channel is not None else None
+        self.attachments = []
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+
+    async def edit(self, content=None, embed=None, **kwargs):
+        await self.ctx.record_output()
+        self.content = content or ""
+        self.embed = embed
+        return self
+
+
+class FakeContext:
+    """commands.Context の代わりに、送信したメッセージと最初の返信の時刻を記録する"""
+
+    def __init__(self, user, guild, channel, content, send_latency):
+        self.author = user
+        self.guild = guild
+        self.channel = channel
+        self.send_latency = send_latency
+        self.message = FakeMessage(self, content, author=user, channel=channel)
+        self.started = time.perf_counter()
+        self.first_output = None
+        self.outputs = []
+
+    async def record_output(self):
+        if self.first_output is None:
+            self.first_output = time.perf_counter()
+        delay = self.send_latency.sample()
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def send(self, content=None, embed=None, **kwargs):
+        await self.record_output()
+        message = FakeMessage(self, content, embed, channel=self.channel)
+        self.outputs.append(message)
+        return message
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        yield
+
+
+# ---- ローカルのHTTPサーバー ----
+
+async def start_http_server(page_latency):
+    """URL学習と画像分析のためのHTMLページと画像を返すサーバーを起動し、(runner, ベースURL) を返す"""
+
+    async def page(request):
+        await asyncio.sleep(page_latency.sample())
+        number = request.match_info["number"]
+        words = " ".join(WORDS[(int(number) + i) % len(WORDS)] for i in range(200))
+        body = f"<html><head><title>テストページ {number}</title></head><body><p>{words}</p></body></html>"
+        return web.Response(text=body, content_type="text/html")
+
+    async def image(request):
+        await asyncio.sleep(page_latency.sample())
+        return web.Response(body=PNG_IMAGE, content_type="image/png")
+
+    app = web.Application()
+    app.router.add_get("/page/{number}", page)
+    app.router.add_get("/image/{number}", image)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+# ---- トレース ----
+
+def synthetic_trace(requests, users, guilds, rate, mix=None, seed=0):
+    """ポアソン到着の合成トレースを作る（ユーザーはサーバーに固定で割り当てる）"""
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    commands, weights = zip(*mix.items())
+    at = 0.0
+    trace = []
+    for _ in range(requests):
+        at += rng.expovariate(rate) if rate > 0 else 0.0
+        user = rng.randrange(users) + 1
+        command = rng.choices(commands, weights)[0]
+        words = " ".join(rng.sample(WORDS, 2))
+        number = rng.randrange(50)
+        if command == "learn":
+            args = {"information": f"{words} に関するメモ {rng.randrange(1000000)}"}
+        elif command == "ask_url":
+            args = {"url": f"/page/{number}", "question": f"{words}について教えて"}
+        elif command == "analyze_image":
+            args = {"url": f"/image/{number}"}
+        elif command == "ask":
+            args = {"question": f"{words}について教えて"}
+        else:
+            args = {"query": words}
+        trace.append({"at": round(at, 6), "user": user, "guild": user % guilds + 1, "command": command, "args": args})
+    return trace
+
+
+def load_trace(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_trace(trace, path):
+    with open(path, "w", encoding="utf-8") as f:
+        for item in trace:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+
+# ---- 計測 ----
+
+class LoopMonitor:
+    """イベントループが interval 秒の sleep から戻るまでの遅れを記録する"""
+
+    def __init__(self, interval=0.01, stall_threshold=0.05):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def report(self):
+        stalls = [lag for lag in self.lags if lag >= self.stall_threshold]
+        return {
+            "max_lag": max(self.lags, default=0.0),
+            "p99_lag": percentile(self.lags, 0.99),
+            "stalls": len(stalls),
+            "stall_seconds": sum(stalls),
+        }
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def rss_bytes():
+    """現在の常駐メモリ（Linux 以外では最大値で代用する）"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Results:
+    def __init__(self):
+        self.latencies = {}  # コマンド -> [完了までの秒数]
+        self.first_outputs = {}  # コマンド -> [最初の返信までの秒数]
+        self.errors = {}
+        self.rejected = {}
+
+    def record(self, command, ctx, failed):
+        self.latencies.setdefault(command, []).append(time.perf_counter() - ctx.started)
+        if ctx.first_output is not None:
+            self.first_outputs.setdefault(command, []).append(ctx.first_output - ctx.started)
+        texts = [message.content for message in ctx.outputs]
+        if failed or any(text.startswith("エラー") for text in texts):
+            self.errors[command] = self.errors.get(command, 0) + 1
+        if any(text.startswith(("リクエストが多すぎます", "現在混み合っている")) for text in texts):
+            self.rejected[command] = self.rejected.get(command, 0) + 1
+
+
+# ---- 実行 ----
+
+def import_bot(workdir):
+    """ダミーの認証情報と一時ディレクトリでボットを読み込む"""
+    os.environ.setdefault("DISCORD_TOKEN", "loadtest")
+    os.environ.setdefault("GEMINI_API_KEY", "loadtest")
+    # 負荷試験では流量の制限をかけない（環境変数で指定した場合はそれに従う）
+    os.environ.setdefault("USER_REQUESTS_PER_MINUTE", "0")
+    os.environ.setdefault("GUILD_REQUESTS_PER_MINUTE", "0")
+    os.environ.setdefault("SCHEDULER_MAX_QUEUE", "100000")
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import bot
+    return bot
+
+
+def install_fakes(bot, model, search_latency):
+    """モデルとウェブ検索をスタブに置き換える"""
+    bot.model = model
+    bot.gemini.model = model
+
+    def fake_search(query, num_results):
+        time.sleep(search_latency.sample())
+        return [
+            {"title": f"{query} {i}", "link": f"https://example.com/{i}", "snippet": f"{query} の検索結果 {i}"}
+            for i in range(num_results)
+        ]
+
+    bot._google_search_sync = fake_search
+    bot.ENABLE_WEB_SEARCH = True
+
+
+async def run_command(bot, item, base_url, send_latency, results, semaphore):
+    user = FakeUser(item["user"])
+    guild = FakeGuild(item["guild"])
+    channel = FakeChannel(item["guild"] * 1000, guild)
+    command = item["command"]
+    args = dict(item.get("args", {}))
+    if args.get("url", "").startswith("/"):
+        args["url"] = base_url + args["url"]
+    content = f"!{command} " + " ".join(str(value) for value in args.values())
+    ctx = FakeContext(user, guild, channel, content, send_latency)
+    handler = getattr(bot, command)
+    failed = False
+    async with semaphore:
+        # on_message と同じくチャンネルのメッセージをインデックスに追加する
+        bot.index_message(ctx.message)
+        try:
+            await handler(ctx, **args)
+        except Exception as e:
+            failed = True
+            print(f"{command} failed: {e!r}")
+    results.record(command, ctx, failed)
+
+
+async def replay(bot, trace, base_url, send_latency, max_in_flight, speed):
+    results = Results()
+    semaphore = asyncio.Semaphore(max_in_flight)
+    started = time.perf_counter()
+    tasks = []
+    for item in sorted(trace, key=lambda item: item["at"]):
+        delay = item["at"] / speed - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(run_command(bot, item, base_url, send_latency, results, semaphore)))
+    await asyncio.gather(*tasks)
+    return results, time.perf_counter() - started
+
+
+def seed_knowledge(bot, count, rng):
+    for i in range(count):
+        words = " ".join(rng.sample(WORDS, 4))
+        bot.add_knowledge(f"{words} についての知識 {i}", "loadtest")
+
+
+def build_report(results, elapsed, monitor, memory, model):
+    commands = {}
+    total = 0
+    for command in sorted(results.latencies):
+        latencies = results.latencies[command]
+        first = results.first_outputs.get(command, [])
+        total += len(latencies)
+        commands[command] = {
+            "count": len(latencies),
+            "errors": results.errors.get(command, 0),
+            "rejected": results.rejected.get(command, 0),
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies),
+            "first_reply_p50": percentile(first, 0.5),
+            "first_reply_p99": percentile(first, 0.99),
+        }
+    all_latencies = [value for values in results.latencies.values() for value in values]
+    return {
+        "requests": total,
+        "elapsed": elapsed,
+        "throughput": total / elapsed if elapsed else 0.0,
+        "p50": percentile(all_latencies, 0.5),
+        "p99": percentile(all_latencies, 0.99),
+        "model_calls": model.calls,
+        "loop": monitor.report(),
+        "memory": memory,
+        "commands": commands,
+    }
+
+
+def print_report(report):
+    print(f"\n{report['requests']} requests in {report['elapsed']:.1f}s "
+          f"({report['throughput']:.1f} req/s), p50 {report['p50'] * 1000:.0f} ms, p99 {report['p99'] * 1000:.0f} ms, "
+          f"{report['model_calls']} model calls")
+    print(f"{'command':<16}{'count':>7}{'errors':>8}{'rejected':>9}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'max ms':>9}{'1st p50':>9}{'1st p99':>9}")
+    for command, stats in report["commands"].items():
+        print(f"{command:<16}{stats['count']:>7}{stats['errors']:>8}{stats['rejected']:>9}"
+              f"{stats['p50'] * 1000:>9.0f}{stats['p99'] * 1000:>9.0f}{stats['max'] * 1000:>9.0f}"
+              f"{stats['first_reply_p50'] * 1000:>9.0f}{stats['first_reply_p99'] * 1000:>9.0f}")
+    loop = report["loop"]
+    print(f"Event loop: max lag {loop['max_lag'] * 1000:.1f} ms, p99 lag {loop['p99_lag'] * 1000:.1f} ms, "
+          f"{loop['stalls']} stalls totalling {loop['stall_seconds']:.2f}s")
+    memory = report["memory"]
+    print(f"Memory: RSS {memory['rss_start'] / 1e6:.1f} MB -> {memory['rss_end'] / 1e6:.1f} MB "
+          f"(+{(memory['rss_end'] - memory['rss_start']) / 1e6:.1f} MB)")
+    for line in memory.get("top_growth", []):
+        print(f"  {line}")
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = synthetic_trace(args.requests, args.users, args.guilds, args.rate, seed=args.seed)
+        if args.record:
+            save_trace(trace, args.record)
+            print(f"Saved {len(trace)} requests to {args.record}")
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    bot = import_bot(workdir)
+    model = FakeModel(
+        LatencyModel(args.model_latency, args.model_sigma, rng),
+        response_chars=args.response_chars,
+        stream_chunks=args.stream_chunks,
+    )
+    install_fakes(bot, model, LatencyModel(args.search_latency, 0.3, rng))
+    send_latency = LatencyModel(args.send_latency, 0.3, rng)
+    bot.load_knowledge_base()
+    seed_knowledge(bot, args.knowledge, rng)
+    await bot.http_client.start()
+    runner, base_url = await start_http_server(LatencyModel(args.page_latency, 0.3, rng))
+    print(f"Replaying {len(trace)} requests from {len({item['user'] for item in trace})} users "
+          f"(working directory: {workdir})")
+
+    gc.collect()
+    if args.tracemalloc:
+        tracemalloc.start()
+        snapshot = tracemalloc.take_snapshot()
+    rss_start = rss_bytes()
+    monitor = LoopMonitor()
+    monitor.start()
+    try:
+        results, elapsed = await replay(bot, trace, base_url, send_latency, args.max_in_flight, args.speed)
+    finally:
+        monitor.stop()
+        await runner.cleanup()
+        await bot.http_client.close()
+    gc.collect()
+    memory = {"rss_start": rss_start, "rss_end": rss_bytes()}
+    if args.tracemalloc:
+        growth = tracemalloc.take_snapshot().compare_to(snapshot, "lineno")
+        memory["top_growth"] = [str(stat) for stat in growth[:10]]
+        tracemalloc.stop()
+
+    report = build_report(results, elapsed, monitor, memory, model)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    bot.save_conversation_history()
+    bot.knowledge_store.close()
+    bot.search_executor.shutdown(wait=False)
+    bot.gemini.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="偽の Discord と Gemini でボットのコマンドに負荷をかける")
+    parser.add_argument("--trace", help="再生するトレース（JSON Lines）")
+    parser.add_argument("--record", help="合成したトレースを保存するファイル")
+    parser.add_argument("--requests", type=int, default=5000, help="合成するリクエスト数")
+    parser.add_argument("--users", type=int, default=1000, help="合成するユーザー数")
+    parser.add_argument("--guilds", type=int, default=20, help="合成するサーバー数")
+    parser.add_argument("--rate", type=float, default=200.0, help="1秒あたりのリクエスト数（0 で一斉に送る）")
+    parser.add_argument("--speed", type=float, default=1.0, help="トレースの再生速度の倍率")
+    parser.add_argument("--max-in-flight", type=int, default=10000, help="同時に処理するコマンドの上限")
+    parser.add_argument("--knowledge", type=int, default=1000, help="事前に登録する知識の数")
+    parser.add_argument("--model-latency", type=float, default=0.5, help="モデルの応答時間の中央値（秒）")
+    parser.add_argument("--model-sigma", type=float, default=0.5, help="モデルの応答時間のばらつき（対数正規分布）")
+    parser.add_argument("--response-chars", type=int, default=600, help="モデルの応答の文字数")
+    parser.add_argument("--stream-chunks", type=int, default=5, help="ストリーミング応答のチャンク数")
+    parser.add_argument("--search-latency", type=float, default=0.2, help="ウェブ検索の応答時間の中央値（秒）")
+    parser.add_argument("--page-latency", type=float, default=0.05, help="URL・画像の応答時間の中央値（秒）")
+    parser.add_argument("--send-latency", type=float, default=0.05, help="Discord への送信・編集の時間の中央値（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tracemalloc", action="store_true", help="メモリが増えた箇所を表示する（遅くなる）")
+    parser.add_argument("--json", help="結果をJSONで保存するファイル")
+    args = parser.parse_args(argv)
+    if args.trace:
+        args.trace = os.path.abspath(args.trace)
+    if args.record:
+        args.record = os.path.abspath(args.record)
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""Discordのチャンネルのメッセージを検索するためのローカルの全文検索インデックス
+
+メッセージは SQLite に保存し、FTS5 の trigram トークナイザーで全文検索する
+（日本語のように単語の区切りが無いテキストでも部分一致で検索できる）。
+3文字未満の検索語は trigram では検索できないため、チャンネル内の文字列検索で絞り込む。
+"""
+import datetime
+import sqlite3
+import time
+from collections import namedtuple
+
+# 検索結果の1件（created_at は UTC の datetime）
+IndexedMessage = namedtuple(
+    "IndexedMessage", ["message_id", "channel_id", "author_name", "content", "created_at"]
+)
+
+# Discord のスノーフレークIDの基準時刻（2015-01-01T00:00:00Z のミリ秒）
+DISCORD_EPOCH_MS = 1420070400000
+
+
+def snowflake_from_time(timestamp):
+    """UNIX時刻（秒）をその時刻のスノーフレークIDの下限に変換する"""
+    return max(0, int(timestamp * 1000) - DISCORD_EPOCH_MS) << 22
+
+
+class MessageIndex:
+    """チャンネルのメッセージの全文検索インデックス
+
+    Args:
+        path (str): データベースファイルのパス
+    """
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        # シャードのワーカーが同じファイルに書き込む場合は、他のプロセスの書き込みを timeout 秒待つ
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.fts_enabled = True
+        self._create_schema()
+
+    def _create_schema(self):
+        with self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS messages (
+                    message_id INTEGER PRIMARY KEY,
+                    guild_id INTEGER,
+                    channel_id INTEGER NOT NULL,
+                    author_name TEXT,
+                    content TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )"""
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel_id, message_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS messages_guild ON messages (guild_id, created_at)")
+            # 過去のメッセージの取り込み状況（cursor まで取り込み済み）
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS backfill (channel_id INTEGER PRIMARY KEY, cursor INTEGER NOT NULL)"
+            )
+        try:
+            with self.conn:
+                self.conn.execute(
+                    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                        content, content='messages', content_rowid='message_id', tokenize='trigram'
+                    )"""
+                )
+                # 本体の変更に合わせて全文検索のインデックスを更新するトリガー
+                self.conn.execute(
+                    """CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+                        INSERT INTO messages_fts (rowid, content) VALUES (new.message_id, new.content);
+                    END"""
+                )
+                self.conn.execute(
+                    """CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+                        INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.message_id, old.content);
+                    END"""
+                )
+                self.conn.execute(
+                    """CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE OF content ON messages BEGIN
+                        INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.message_id, old.content);
+                        INSERT INTO messages_fts (rowid, content) VALUES (new.message_id, new.content);
+                    END"""
+                )
+        except sqlite3.OperationalError as e:
+            # FTS5 や trigram トークナイザーが使えない SQLite では文字列検索だけを行う
+            print(f"Full-text search is not available for the message index: {e}")
+            self.fts_enabled = False
+
+    # ---- 更新 ----
+
+    @staticmethod
+    def _row(message):
+        guild = getattr(message, "guild", None)
+        return (
+            message.id,
+            guild.id if guild else None,
+            message.channel.id,
+            getattr(message.author, "display_name", None) or message.author.name,
+            message.content,
+            message.created_at.timestamp(),
+        )
+
+    def add_messages(self, messages):
+        """discord.Message のリストを追加する（既にあるメッセージは内容を更新する）
+
+        Returns:
+            int: 追加・更新した件数
+        """
+        rows = [self._row(message) for message in messages if message.content]
+        if not rows:
+            return 0
+        with self.conn:
+            self.conn.executemany(
+                """INSERT INTO messages (message_id, guild_id, channel_id, author_name, content, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (message_id) DO UPDATE SET content = excluded.content, author_name = excluded.author_name""",
+                rows,
+            )
+        return len(rows)
+
+    def add_message(self, message):
+        return self.add_messages([message])
+
+    def update_content(self, message_id, content):
+        """編集されたメッセージの内容を更新する（インデックスに無いメッセージは無視する）"""
+        with self.conn:
+            if content:
+                self.conn.execute("UPDATE messages SET content = ? WHERE message_id = ?", (content, message_id))
+            else:
+                self.conn.execute("DELETE FROM messages WHERE message_id = ?", (message_id,))
+
+    def delete_messages(self, message_ids):
+        with self.conn:
+            self.conn.executemany("DELETE FROM messages WHERE message_id = ?", [(i,) for i in message_ids])
+
+    def prune(self, guild_id, before_timestamp):
+        """サーバーの before_timestamp より古いメッセージを削除し、削除した件数を返す"""
+        with self.conn:
+            cursor = self.conn.execute(
+                "DELETE FROM messages WHERE guild_id IS ? AND created_at < ?", (guild_id, before_timestamp)
+            )
+        return cursor.rowcount
+
+    def guild_ids(self):
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT guild_id FROM messages")]
+
+    # ---- 過去のメッセージの取り込み ----
+
+    def backfill_cursor(self, channel_id):
+        """取り込み済みの最新のメッセージID（まだ取り込んでいない場合は None）"""
+        row = self.conn.execute("SELECT cursor FROM backfill WHERE channel_id = ?", (channel_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_backfill_cursor(self, channel_id, cursor):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO backfill (channel_id, cursor) VALUES (?, ?)", (channel_id, cursor)
+            )
+
+    def advance_backfill_cursor(self, channel_id, message_id):
+        """取り込み位置を message_id まで進める（既に新しい位置まで取り込み済みの場合は変えない）"""
+        with self.conn:
+            self.conn.execute(
+                """INSERT INTO backfill (channel_id, cursor) VALUES (?, ?)
+                ON CONFLICT (channel_id) DO UPDATE SET cursor = MAX(cursor, excluded.cursor)""",
+                (channel_id, message_id),
+            )
+
+    # ---- 検索 ----
+
+    def search(self, channel_id, query, limit=10, max_results=1000):
+        """チャンネル内で全ての検索語を含むメッセージを新しい順に返す
+
+        Returns:
+            tuple: (IndexedMessage のリスト（最大 limit 件）, 見つかった件数（最大 max_results）)
+        """
+        terms = query.split()
+        if not terms:
+            return [], 0
+        long_terms = [term for term in terms if len(term) >= 3] if self.fts_enabled else []
+        short_terms = [term for term in terms if term not in long_terms]
+
+        conditions = ["m.channel_id = ?"]
+        params = [channel_id]
+        if long_terms:
+            # 各検索語をフレーズとして AND で結合する
+            match = " AND ".join('"' + term.replace('"', '""') + '"' for term in long_terms)
+            conditions.append("m.message_id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)")
+            params.append(match)
+        for term in short_terms:
+            conditions.append("instr(lower(m.content), ?) > 0")
+            params.append(term.lower())
+
+        rows = self.conn.execute(
+            f"""SELECT m.message_id, m.channel_id, m.author_name, m.content, m.created_at
+            FROM messages AS m WHERE {' AND '.join(conditions)}
+            ORDER BY m.message_id DESC LIMIT ?""",
+            params + [max_results],
+        ).fetchall()
+        results = [
+            IndexedMessage(
+                row[0], row[1], row[2], row[3],
+                datetime.datetime.fromtimestamp(row[4], tz=datetime.timezone.utc),
+            )
+            for row in rows[:limit]
+        ]
+        return results, len(rows)
+
+    def count(self, channel_id=None):
+        if channel_id is None:
+            return self.conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        return self.conn.execute("SELECT COUNT(*) FROM messages WHERE channel_id = ?", (channel_id,)).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def retention_cutoff(days):
+    """保存期間（日）から、それより古いメッセージを削除する基準時刻を返す"""
+    return time.time() - days * 86400
@@ -0,0 +1,261 @@
+"""ボットの計測値（レイテンシー、エラー数、データ量、イベントループの遅延）の収集と公開
+
+計測値は Prometheus のテキスト形式でローカルのHTTPエンドポイントから公開する。
+無効にした場合、timed() は関数をそのまま返し、stage() は何もしないコンテキストマネージャーを
+返すので、処理の途中に余分なコストはかからない。
+"""
+import asyncio
+import contextlib
+import functools
+import inspect
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """ラベルごとの値の分布（累積バケット、合計、件数）"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_name, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_name = label_name
+        self.buckets = tuple(buckets)
+        self._series = {}  # ラベルの値 -> [バケットごとの件数, 合計, 件数]
+        # 知識ベースの検索などはスレッドから記録される
+        self._lock = threading.Lock()
+
+    def observe(self, label, value):
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            items = sorted((label, [list(s[0]), s[1], s[2]]) for label, s in self._series.items())
+        for label, (counts, total, count) in items:
+            base = [(self.label_name, label)] if self.label_name else []
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(base + [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(base + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(base)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(base)} {count}")
+        return lines
+
+
+class Counter:
+    """ラベルごとの累積回数"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_name):
+        self.name = name
+        self.help = help_text
+        self.label_name = label_name
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label, amount=1):
+        with self._lock:
+            self._values[label] = self._values.get(label, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels([(self.label_name, label)] if self.label_name else [])} {_format_value(value)}"
+            for label, value in items
+        ]
+
+
+class Callback:
+    """公開する時に関数を呼び出して値を取得する計測値
+
+    関数は数値、または {ラベルの値: 数値} の辞書を返す。
+    """
+
+    def __init__(self, name, help_text, func, kind="gauge", label_name=None):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.kind = kind
+        self.label_name = label_name
+
+    def render(self):
+        value = self.func()
+        if value is None:
+            return []
+        if isinstance(value, dict) and self.label_name:
+            return [
+                f"{self.name}{_format_labels([(self.label_name, label)])} {_format_value(v)}"
+                for label, v in sorted(value.items())
+            ]
+        return [f"{self.name} {_format_value(value)}"]
+
+
+class Metrics:
+    """計測値の登録と記録、HTTPエンドポイントでの公開
+
+    Args:
+        enabled (bool): 計測するかどうか（False の場合は全ての記録が何もしない）
+        prefix (str): 計測値の名前の接頭辞
+    """
+
+    def __init__(self, enabled=True, prefix="discord_bot"):
+        self.enabled = enabled
+        self.prefix = prefix
+        self._metrics = []
+        self._runner = None
+        self._lag_task = None
+        self.command_seconds = self._add(Histogram(
+            f"{prefix}_command_duration_seconds", "コマンドの処理時間", "command"))
+        self.command_errors = self._add(Counter(
+            f"{prefix}_command_errors_total", "失敗したコマンドの数", "command"))
+        self.stage_seconds = self._add(Histogram(
+            f"{prefix}_stage_duration_seconds", "内部処理ごとの処理時間", "stage"))
+        self.stage_errors = self._add(Counter(
+            f"{prefix}_stage_errors_total", "内部処理ごとの例外の数", "stage"))
+        self.loop_lag_seconds = self._add(Histogram(
+            f"{prefix}_event_loop_lag_seconds", "イベントループの遅延", None,
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def callback(self, name, help_text, func, kind="gauge", label_name=None):
+        """公開する時に func() を呼び出して値を取得する計測値を登録する"""
+        if self.enabled:
+            self._add(Callback(f"{self.prefix}_{name}", help_text, func, kind, label_name))
+
+    # ---- 記録 ----
+
+    def observe_stage(self, stage, elapsed, failed=False):
+        self.stage_seconds.observe(stage, elapsed)
+        if failed:
+            self.stage_errors.inc(stage)
+
+    def observe_command(self, command, elapsed, failed=False):
+        self.command_seconds.observe(command, elapsed)
+        if failed:
+            self.command_errors.inc(command)
+
+    @contextlib.contextmanager
+    def _stage(self, stage):
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.observe_stage(stage, time.perf_counter() - started, failed)
+
+    def stage(self, stage):
+        """ブロックの処理時間を内部処理 stage として記録するコンテキストマネージャー"""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._stage(stage)
+
+    def timed(self, stage):
+        """関数（同期・非同期）の処理時間を内部処理 stage として記録するデコレーター
+
+        無効の場合は関数をそのまま返す。
+        """
+        def decorator(func):
+            if not self.enabled:
+                return func
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self._stage(stage):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self._stage(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # ---- 公開 ----
+
+    def render(self):
+        """全ての計測値を Prometheus のテキスト形式で返す"""
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.render()
+            except Exception as e:
+                print(f"Error collecting metric {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    async def _monitor_loop_lag(self, interval):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag_seconds.observe(None, max(0.0, loop.time() - started - interval))
+
+    async def start(self, host="127.0.0.1", port=9108, lag_interval=0.5):
+        """HTTPエンドポイント（/metrics）とイベントループの遅延の計測を開始する"""
+        if not self.enabled or self._runner is not None:
+            return
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(body=self.render().encode("utf-8"),
+                                headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self._lag_task = asyncio.create_task(self._monitor_loop_lag(lag_interval))
+        print(f"Metrics are served at http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,184 @@
+"""トークン数の上限に収まるようにプロンプトを組み立てる"""
+from collections import namedtuple
+
+# build() の結果（text: プロンプト、tokens: 推定トークン数、dropped / truncated: 削除・切り詰めた項目数）
+BuiltPrompt = namedtuple("BuiltPrompt", ["text", "tokens", "dropped", "truncated"])
+
+TRUNCATION_MARK = "…"
+
+
+class TokenEstimator:
+    """文字数からトークン数を推定する
+
+    ASCII文字は約4文字で1トークン、日本語などそれ以外の文字は1文字あたり
+    non_ascii_weight トークンとして数える。モデルのトークンカウンターで数えた値を
+    calibrate() に渡すと、推定値との比率で補正する。
+
+    Args:
+        non_ascii_weight (float): ASCII以外の1文字あたりのトークン数
+        max_samples (int): 補正に使うサンプル数（これを超えたら補正をやめる）
+    """
+
+    def __init__(self, non_ascii_weight=0.7, max_samples=20):
+        self.non_ascii_weight = non_ascii_weight
+        self.max_samples = max_samples
+        self.scale = 1.0
+        self.samples = 0
+
+    def _raw(self, text):
+        ascii_chars = sum(1 for c in text if ord(c) < 128)
+        return ascii_chars / 4 + (len(text) - ascii_chars) * self.non_ascii_weight
+
+    def estimate(self, text):
+        if not text:
+            return 0
+        return int(self._raw(text) * self.scale) + 1
+
+    def needs_calibration(self):
+        return self.samples < self.max_samples
+
+    def calibrate(self, text, actual_tokens):
+        """実際のトークン数を使って補正係数を更新する（サンプルの平均）"""
+        raw = self._raw(text)
+        if raw <= 0 or actual_tokens <= 0:
+            return
+        self.samples += 1
+        self.scale += (actual_tokens / raw - self.scale) / self.samples
+
+
+class _Item:
+    def __init__(self, text, priority, required, truncatable, min_tokens):
+        self.text = text
+        self.priority = priority
+        self.required = required
+        self.truncatable = truncatable
+        self.min_tokens = min_tokens
+        self.included = None  # 採用したテキスト（採用しなかった場合は None）
+
+
+class PromptSection:
+    """見出し付きのまとまり（知識・会話履歴など）
+
+    1つでも項目が採用された場合だけ header と footer を出力し、
+    どの項目も採用されなかった場合は empty_text を出力する。
+    """
+
+    def __init__(self, header=None, footer=None, empty_text=None, separator="\n\n"):
+        self.header = header
+        self.footer = footer
+        self.empty_text = empty_text
+        self.separator = separator
+        self.items = []
+
+    def add(self, text, priority=0, truncatable=False, min_tokens=64):
+        """項目を追加する（priority が大きいものから優先して採用する）"""
+        if text:
+            self.items.append(_Item(text, priority, False, truncatable, min_tokens))
+        return self
+
+    def _frame(self):
+        return [part for part in (self.header, self.footer) if part]
+
+    def render(self):
+        included = [item.included for item in self.items if item.included is not None]
+        if not included:
+            return self.empty_text or ""
+        body = self.separator.join(included)
+        return "\n\n".join([part for part in (self.header, body, self.footer) if part])
+
+
+class PromptBuilder:
+    """優先度に従ってトークン数の上限内でプロンプトを組み立てる
+
+    必須の項目は常に含め、残りの予算を優先度の高い項目から割り当てる。
+    入りきらない項目は、切り詰め可能なら残りの予算に合わせて切り詰め、
+    そうでなければ削除する。出力の順序は追加した順序のまま。
+
+    Args:
+        budget (int): プロンプト全体のトークン数の上限
+        estimator (TokenEstimator): トークン数の推定に使うもの
+    """
+
+    def __init__(self, budget, estimator=None, separator="\n\n"):
+        self.budget = budget
+        self.estimator = estimator or TokenEstimator()
+        self.separator = separator
+        self.parts = []  # _Item または PromptSection
+
+    def add(self, text, priority=0, required=True, truncatable=False, min_tokens=64):
+        """項目を追加する（デフォルトは必須）"""
+        if text:
+            self.parts.append(_Item(text, priority, required, truncatable, min_tokens))
+        return self
+
+    def section(self, header=None, footer=None, empty_text=None, separator="\n\n"):
+        """見出し付きのまとまりを追加して返す"""
+        section = PromptSection(header, footer, empty_text, separator)
+        self.parts.append(section)
+        return section
+
+    def _truncate(self, text, max_tokens):
+        """推定トークン数が max_tokens 以内になるよう末尾を切り詰める"""
+        estimate = self.estimator.estimate
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if estimate(text[:middle] + TRUNCATION_MARK) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return text[:low].rstrip() + TRUNCATION_MARK if low else None
+
+    def build(self):
+        estimate = self.estimator.estimate
+        separator_cost = estimate(self.separator)
+        used = 0
+        candidates = []
+        for part in self.parts:
+            if isinstance(part, PromptSection):
+                for item in part.items:
+                    item.included = None
+                    candidates.append((item, part))
+                used += estimate(part.empty_text) + separator_cost if part.empty_text else 0
+            else:
+                part.included = part.text if part.required else None
+                if part.required:
+                    used += estimate(part.text) + separator_cost
+                else:
+                    candidates.append((part, None))
+
+        dropped = truncated = 0
+        opened = set()
+        # 優先度の高い順に残りの予算を割り当てる（同じ優先度なら追加した順）
+        candidates.sort(key=lambda candidate: -candidate[0].priority)
+        for item, section in candidates:
+            overhead = separator_cost
+            if section is not None and id(section) not in opened:
+                # 最初の項目を採用する時に見出しの分も必要になる
+                overhead += sum(estimate(part) + separator_cost for part in section._frame())
+                overhead -= estimate(section.empty_text) if section.empty_text else 0
+            remaining = self.budget - used - overhead
+            cost = estimate(item.text)
+            if cost <= remaining:
+                item.included = item.text
+            elif item.truncatable and remaining >= item.min_tokens:
+                item.included = self._truncate(item.text, remaining)
+                if item.included is None:
+                    dropped += 1
+                    continue
+                truncated += 1
+                cost = estimate(item.included)
+            else:
+                dropped += 1
+                continue
+            used += cost + overhead
+            if section is not None:
+                opened.add(id(section))
+
+        rendered = []
+        for part in self.parts:
+            text = part.render() if isinstance(part, PromptSection) else part.included
+            if text:
+                rendered.append(text)
+        text = self.separator.join(rendered)
+        return BuiltPrompt(text, estimate(text), dropped, truncated)
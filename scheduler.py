@@ -0,0 +1,422 @@
+"""モデル呼び出しの受付を制御するスケジューラー
+
+サーバー（guild）とユーザーの間で公平に順番を割り当て、1人が連続でリクエストしても
+他のユーザーの待ち時間が延びないようにする。
+"""
+import asyncio
+import collections
+import contextlib
+import heapq
+import itertools
+import time
+
+
+class Rejected(Exception):
+    """リクエストを受け付けなかったことを表す例外の基底クラス"""
+
+
+class RateLimited(Rejected):
+    """ユーザーまたはサーバーのリクエスト数が上限を超えた
+
+    Attributes:
+        retry_after (float): 次のリクエストを受け付けられるまでの秒数
+        scope (str): 上限を超えた単位（"user" または "guild"）
+    """
+
+    def __init__(self, retry_after, scope):
+        super().__init__(f"rate limited ({scope}), retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+        self.scope = scope
+
+
+class Overloaded(Rejected):
+    """キューが満杯、または待ち時間が上限を超えた（超える見込み）"""
+
+
+class TokenBucket:
+    """トークンバケット（rate 個/秒で補充され、最大 burst 個までためられる）"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now=None):
+        """トークンを1つ使えるまでの秒数（今すぐ使える場合は 0）"""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Request:
+    __slots__ = ("seq", "user", "guild", "future", "enqueued")
+
+    def __init__(self, seq, user, guild):
+        self.seq = seq
+        self.user = user
+        self.guild = guild
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued = time.monotonic()
+
+
+class _User:
+    def __init__(self, user_id, vtime):
+        self.user_id = user_id
+        self.vtime = vtime
+        self.queue = collections.deque()
+        self.running = False
+
+
+class _Guild:
+    def __init__(self, guild_id, weight, vtime):
+        self.guild_id = guild_id
+        self.weight = weight
+        self.vtime = vtime
+        self.clock = 0.0  # サーバー内のユーザーの仮想時刻
+        self.users = {}
+
+
+class RequestScheduler:
+    """サーバーとユーザーの間で公平に順番を割り当てる受付スケジューラー
+
+    サーバー単位、サーバー内ではユーザー単位に仮想時刻を持ち、仮想時刻が最も小さい
+    サーバーの、仮想時刻が最も小さいユーザーのリクエストから実行する（重み付き公平キューイング）。
+    実行するたびに仮想時刻は 1 / 重み だけ進むので、重みの大きいサーバーほど多く実行される。
+    同じユーザーのリクエストは同時に1つだけ実行し、残りは順番に待たせる。
+
+    受付時にユーザーとサーバーのトークンバケットを確認し、キューが満杯の場合や
+    推定の待ち時間が max_wait を超える場合はすぐに断る。キューで max_wait 秒以上
+    待ったリクエストも取り消す。
+
+    Args:
+        max_concurrency (int): 同時に実行するリクエスト数
+        max_queue (int): 待たせておけるリクエスト数の上限
+        max_wait (float): 待ち時間の上限（秒）
+        user_rate (float): ユーザーごとのリクエスト数の上限（1秒あたり、0 で無制限）
+        user_burst (int): ユーザーが続けて送れるリクエスト数
+        guild_rate (float): サーバーごとのリクエスト数の上限（1秒あたり、0 で無制限）
+        guild_burst (int): サーバーが続けて送れるリクエスト数
+        guild_weights (dict): サーバーIDごとの重み（指定が無いサーバーは 1）
+        update_interval (float): 順番待ちの位置を通知する間隔（秒）
+    """
+
+    def __init__(self, max_concurrency=4, max_queue=100, max_wait=60.0, user_rate=0.1, user_burst=3,
+                 guild_rate=1.0, guild_burst=20, guild_weights=None, update_interval=3.0):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self.guild_weights = guild_weights or {}
+        self.update_interval = update_interval
+        self._guilds = {}
+        self._clock = 0.0  # サーバーの仮想時刻
+        self._queued = 0
+        self._running = 0
+        self._seq = itertools.count()
+        self._user_buckets = {}
+        self._guild_buckets = {}
+        # 順番待ちの位置はまとめて計算し、キューが変わってから一定時間は使い回す
+        self._positions = {}
+        self._positions_version = -1
+        self._positions_updated = 0.0
+        self._version = 0
+        # 統計
+        self.admitted = 0
+        self.completed = 0
+        self.rate_limited = 0
+        self.shed = 0
+        self.max_depth = 0
+        self._waits = collections.deque(maxlen=1000)
+        self._service_time = None  # 実行時間の指数移動平均（秒）
+
+    # ---- 受付 ----
+
+    def _check_rate(self, user_id, guild_id):
+        """トークンバケットを確認し、両方に余裕があればトークンを使う"""
+        now = time.monotonic()
+        buckets = []
+        if self.user_rate > 0:
+            bucket = self._user_buckets.get(user_id)
+            if bucket is None:
+                bucket = self._user_buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+            buckets.append(("user", bucket))
+        if self.guild_rate > 0 and guild_id is not None:
+            bucket = self._guild_buckets.get(guild_id)
+            if bucket is None:
+                bucket = self._guild_buckets[guild_id] = TokenBucket(self.guild_rate, self.guild_burst)
+            buckets.append(("guild", bucket))
+        for scope, bucket in buckets:
+            wait = bucket.wait_time(now)
+            if wait > 0:
+                self.rate_limited += 1
+                raise RateLimited(wait, scope)
+        for _, bucket in buckets:
+            bucket.take()
+        if len(self._user_buckets) > 10000:
+            self._prune_buckets(now)
+
+    def _prune_buckets(self, now):
+        """満タンに戻ったバケットを削除する（削除しても新しく作るバケットと同じ状態）"""
+        for buckets in (self._user_buckets, self._guild_buckets):
+            for key in [key for key, bucket in buckets.items() if bucket.full(now)]:
+                del buckets[key]
+
+    def estimated_wait(self, extra=0):
+        """今受け付けたリクエストが実行されるまでの推定の待ち時間（秒）"""
+        if self._service_time is None:
+            return 0.0
+        ahead = self._queued + extra + self._running - self.max_concurrency + 1
+        if ahead <= 0:
+            return 0.0
+        return ahead / self.max_concurrency * self._service_time
+
+    def _check_capacity(self):
+        if self._queued >= self.max_queue:
+            self.shed += 1
+            raise Overloaded("queue is full")
+        if self.estimated_wait() > self.max_wait:
+            self.shed += 1
+            raise Overloaded("estimated wait exceeds the deadline")
+
+    def _enqueue(self, user_id, guild_id):
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            weight = self.guild_weights.get(guild_id, 1.0)
+            guild = self._guilds[guild_id] = _Guild(guild_id, weight, self._clock)
+        user = guild.users.get(user_id)
+        if user is None:
+            user = guild.users[user_id] = _User(user_id, guild.clock)
+        if not any(u.queue or u.running for u in guild.users.values()):
+            # 待っていなかったサーバーは、待っていた間の分の順番を先取りしない
+            guild.vtime = max(guild.vtime, self._clock)
+        if not user.queue and not user.running:
+            user.vtime = max(user.vtime, guild.clock)
+
+        request = _Request(next(self._seq), user, guild)
+        user.queue.append(request)
+        self._queued += 1
+        self._version += 1
+        self.max_depth = max(self.max_depth, self._queued)
+        return request
+
+    # ---- 実行順の決定 ----
+
+    @staticmethod
+    def _eligible(guild):
+        return [user for user in guild.users.values() if user.queue and not user.running]
+
+    def _pick(self):
+        """次に実行するリクエストを取り出す（実行できるものが無ければ None）"""
+        best = None
+        for guild in self._guilds.values():
+            users = self._eligible(guild)
+            if not users:
+                continue
+            user = min(users, key=lambda u: (u.vtime, u.queue[0].seq))
+            key = (guild.vtime, user.vtime, user.queue[0].seq)
+            if best is None or key < best[0]:
+                best = (key, guild, user)
+        if best is None:
+            return None
+        _, guild, user = best
+        request = user.queue.popleft()
+        self._queued -= 1
+        self._version += 1
+        self._clock = max(self._clock, guild.vtime)
+        guild.clock = max(guild.clock, user.vtime)
+        guild.vtime += 1.0 / guild.weight
+        user.vtime += 1.0
+        user.running = True
+        return request
+
+    def _dispatch(self):
+        while self._running < self.max_concurrency:
+            request = self._pick()
+            if request is None:
+                return
+            self._running += 1
+            request.future.set_result(None)
+
+    def _release(self, request, service_time):
+        user, guild = request.user, request.guild
+        user.running = False
+        self._running -= 1
+        self.completed += 1
+        if service_time is not None:
+            if self._service_time is None:
+                self._service_time = service_time
+            else:
+                self._service_time = 0.8 * self._service_time + 0.2 * service_time
+        self._forget_idle(user, guild)
+        self._dispatch()
+
+    def _forget_idle(self, user, guild):
+        if not user.queue and not user.running:
+            guild.users.pop(user.user_id, None)
+        if not guild.users:
+            self._guilds.pop(guild.guild_id, None)
+
+    def _cancel(self, request):
+        """実行される前のリクエストをキューから取り除く"""
+        user, guild = request.user, request.guild
+        try:
+            user.queue.remove(request)
+        except ValueError:
+            return False
+        self._queued -= 1
+        self._version += 1
+        self._forget_idle(user, guild)
+        return True
+
+    def _compute_positions(self):
+        """現在の仮想時刻から実行順をシミュレーションし、{リクエスト: 位置（1から）} を返す
+
+        _pick と同じ順番（サーバーの仮想時刻、ユーザーの仮想時刻、受付順）をヒープでたどる。
+        """
+        positions = {}
+        guild_heap = []
+        for guild_index, guild in enumerate(self._guilds.values()):
+            user_heap = [
+                [user.vtime, user.queue[0].seq, user_index, list(user.queue), 0]
+                for user_index, user in enumerate(guild.users.values()) if user.queue
+            ]
+            if user_heap:
+                heapq.heapify(user_heap)
+                guild_heap.append([guild.vtime, user_heap[0][0], user_heap[0][1], guild_index, guild.weight, user_heap])
+        heapq.heapify(guild_heap)
+        position = 0
+        while guild_heap:
+            guild_entry = heapq.heappop(guild_heap)
+            user_heap = guild_entry[5]
+            user_entry = heapq.heappop(user_heap)
+            requests = user_entry[3]
+            position += 1
+            positions[requests[user_entry[4]]] = position
+            user_entry[4] += 1
+            if user_entry[4] < len(requests):
+                user_entry[0] += 1.0
+                user_entry[1] = requests[user_entry[4]].seq
+                heapq.heappush(user_heap, user_entry)
+            if user_heap:
+                guild_entry[0] += 1.0 / guild_entry[4]
+                guild_entry[1], guild_entry[2] = user_heap[0][0], user_heap[0][1]
+                heapq.heappush(guild_heap, guild_entry)
+        return positions
+
+    def position(self, request):
+        """キューの中で何番目に実行される見込みか（1から）を返す
+
+        全ての待っているリクエストの位置をまとめて計算し、キューが変わっても
+        update_interval の半分の間は前回の結果を使う（多数のリクエストが待っている時に
+        リクエストごとにシミュレーションしないため）。まだ計算していないリクエストは最後尾とみなす。
+        """
+        now = time.monotonic()
+        if self._positions_version != self._version and now - self._positions_updated >= self.update_interval / 2:
+            self._positions = self._compute_positions()
+            self._positions_version = self._version
+            self._positions_updated = now
+        return self._positions.get(request, self._queued)
+
+    # ---- 公開API ----
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, guild_id=None, on_queued=None):
+        """実行の順番が来るまで待ち、ブロックを抜けるまで実行枠を使う
+
+        Args:
+            user_id: ユーザーID
+            guild_id: サーバーID（DMの場合は None）
+            on_queued (callable): 待たされる場合に順番待ちの位置（1から）を受け取るコルーチン関数
+
+        Raises:
+            RateLimited: トークンバケットに余裕が無い場合
+            Overloaded: キューが満杯、または待ち時間が max_wait を超える（見込みの）場合
+        """
+        # 断る場合にトークンを使わないよう、キューの空きを先に確認する
+        self._check_capacity()
+        self._check_rate(user_id, guild_id)
+        request = self._enqueue(user_id, guild_id)
+        self._dispatch()
+        if not request.future.done():
+            await self._wait(request, on_queued)
+        self.admitted += 1
+        self._waits.append(time.monotonic() - request.enqueued)
+        started = time.monotonic()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            # 失敗したリクエストの時間は実行時間の平均に入れない
+            self._release(request, None if failed else time.monotonic() - started)
+
+    async def _wait(self, request, on_queued):
+        deadline = request.enqueued + self.max_wait
+        last_position = None
+        try:
+            while True:
+                if on_queued is not None:
+                    position = self.position(request)
+                    if position != last_position:
+                        last_position = position
+                        try:
+                            await on_queued(position)
+                        except Exception as e:
+                            print(f"Error sending queue position: {e}")
+                    if request.future.done():
+                        return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(asyncio.shield(request.future), min(self.update_interval, remaining))
+                    return
+                except asyncio.TimeoutError:
+                    continue
+        except asyncio.CancelledError:
+            if not self._cancel(request):
+                # 順番が来た直後にキャンセルされた場合は実行枠を返す
+                self._release(request, None)
+            raise
+        if self._cancel(request):
+            self.shed += 1
+            raise Overloaded("waited longer than the deadline")
+        # 期限と同時に順番が来た場合はそのまま実行する
+
+    def stats(self):
+        waits = sorted(self._waits)
+
+        def percentile(p):
+            return waits[min(len(waits) - 1, int(len(waits) * p))] if waits else 0.0
+
+        return {
+            "queued": self._queued,
+            "running": self._running,
+            "max_depth": self.max_depth,
+            "admitted": self.admitted,
+            "completed": self.completed,
+            "rate_limited": self.rate_limited,
+            "shed": self.shed,
+            "wait_p50": percentile(0.5),
+            "wait_p95": percentile(0.95),
+            "wait_max": waits[-1] if waits else 0.0,
+            "service_time": self._service_time or 0.0,
+        }
@@ -0,0 +1,435 @@
+"""知識ベース検索用の転置インデックス
+
+日本語などの非ASCII文字の並びは文字の2-gramに、英語などのASCII文字は単語に分割して
+インデックスを作成する。検索時はクエリの語を含むエントリ（候補）だけを対象にスコアを計算する。
+（3-gram以上の一致は候補を採点し直す際に従来のスコアで評価するため、インデックスには含めない）
+
+従来のスコアは部分文字列の一致で計算するため、1文字のクエリ（"猫"）や単語の一部だけの
+クエリ（"cat" で "category"）も一致する。これらの候補を集めるために、非ASCII文字の1-gramと
+ASCIIの単語の中の文字の2-gram・3-gram（"#ca"、"#cat"）も候補集め専用の語としてインデックスに含める。
+検索はどのランカーでもインデックスの該当する語の postings だけを読み、エントリを走査することはない
+（1文字だけのASCIIのクエリ（"a"）はインデックスの語にならないため一致しない）。
+"""
+import heapq
+import math
+import re
+from collections import Counter, defaultdict
+from operator import itemgetter
+
+# インデックスの形式を変更した場合は値を上げる（起動時に再構築される）
+INDEX_VERSION = "4"
+
+# BM25 / BM25F のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+BM25_TITLE_B = 0.5
+# タイトル（learn_url で学習したページのタイトルなど）に一致した語の重み
+BM25_TITLE_WEIGHT = 2.0
+
+RANKERS = ("legacy", "bm25")
+
+_ASCII_WORD = re.compile(r"[0-9a-z_]+")
+_NON_ASCII_RUN = re.compile(r"[^\x00-\x7f\s]+")
+
+
+def extract_terms(text):
+    """テキストをインデックス用の語に分割し、出現回数を返す
+
+    1文字だけの非ASCII文字の並びはその文字（1-gram）を語とする。
+    """
+    text = text.lower()
+    terms = Counter(word for word in _ASCII_WORD.findall(text) if len(word) > 1)
+    for run in _NON_ASCII_RUN.findall(text):
+        if len(run) == 1:
+            terms[run] += 1
+        else:
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def _ascii_gram(word):
+    """ASCIIの単語の中の部分文字列を探すための語（"#" + 先頭の2〜3文字）"""
+    return "#" + word[:3]
+
+
+def extract_lookup_terms(text):
+    """候補集め専用の語と出現回数を返す（BM25の語数には含めない）
+
+    非ASCII文字の1-gramと、ASCIIの単語の中の文字の2-gram・3-gram（"#ca"、"#cat" の形式）。
+    """
+    text = text.lower()
+    terms = Counter()
+    for word in _ASCII_WORD.findall(text):
+        for n in (2, 3):
+            terms.update("#" + word[i:i + n] for i in range(len(word) - n + 1))
+    for run in _NON_ASCII_RUN.findall(text):
+        terms.update(run)
+    return terms
+
+
+def _is_word_char(c):
+    return c.isascii() and (c.isalnum() or c == "_")
+
+
+def query_lookup_terms(query):
+    """従来のスコア（legacy_score）で一致する可能性のあるエントリを集めるための語を返す
+
+    従来のスコアが部分文字列として探す語（日本語のクエリは2文字以上の部分文字列、
+    英語のクエリは空白で区切った語）のそれぞれについて、その語を含むエントリが必ず持つ語を選ぶ。
+    ASCIIの記号や空白だけでつながった部分（"a " など）は候補集めには使わない。
+    """
+    query_lower = query.lower()
+    terms = set(extract_terms(query_lower))
+    if any(ord(c) > 127 for c in query):
+        # 2文字以上の部分文字列は必ず先頭の2文字を含むので、クエリの2文字ずつを調べる
+        if len(query_lower) == 1 and not query_lower.isspace():
+            terms.add(query_lower)
+        for i in range(len(query_lower) - 1):
+            pair = query_lower[i:i + 2]
+            non_ascii = [c for c in pair if not c.isascii() and not c.isspace()]
+            if len(non_ascii) == 2:
+                terms.add(pair)
+            elif non_ascii:
+                terms.add(non_ascii[0])
+            elif all(_is_word_char(c) for c in pair):
+                terms.add(_ascii_gram(pair))
+    else:
+        for word in query_lower.split():
+            parts = [part for part in _ASCII_WORD.findall(word) if len(part) > 1]
+            if len(word) > 1 and parts:
+                terms.add(_ascii_gram(max(parts, key=len)))
+    return list(terms)
+
+
+def analyze_document(text, title=None):
+    """エントリをインデックス用に解析する
+
+    Returns:
+        tuple: ({term: (tf, title_tf)}, 本文の語数, タイトルの語数)
+    """
+    content_terms = extract_terms(text)
+    title_terms = extract_terms(title) if title else Counter()
+    length, title_length = sum(content_terms.values()), sum(title_terms.values())
+    # 候補集め専用の語（1-gramは1文字の並びの語と同じなので多い方の回数を使う）
+    content_terms |= extract_lookup_terms(text)
+    if title:
+        title_terms |= extract_lookup_terms(title)
+    fields = {term: (content_terms.get(term, 0), title_terms.get(term, 0))
+              for term in content_terms.keys() | title_terms.keys()}
+    return fields, length, title_length
+
+
+def legacy_score(query, content):
+    """従来の search_knowledge と同じ方法でスコアを計算する"""
+    query_lower = query.lower()
+    content_lower = content.lower()
+
+    # 日本語の場合は文字単位で分割、英語の場合は単語単位で分割
+    has_japanese = any(ord(c) > 127 for c in query)
+    if has_japanese:
+        # 日本語の場合は2文字以上の部分文字列を抽出
+        query_words = []
+        for i in range(len(query_lower)):
+            for j in range(i + 2, min(i + 10, len(query_lower) + 1)):
+                query_words.append(query_lower[i:j])
+        hit_score, count_weight = 2, 0.2
+    else:
+        # 英語の場合は単語単位で分割
+        query_words = [word for word in query_lower.split() if len(word) > 1]
+        hit_score, count_weight = 3, 0.5
+
+    score = 0
+    # 完全一致の場合は高いスコア
+    if query_lower in content_lower:
+        score += 10
+    for word in query_words:
+        if word in content_lower:
+            score += hit_score
+            # 出現回数も考慮
+            score += content_lower.count(word) * count_weight
+    return score
+
+
+class InvertedIndex:
+    """メモリ上の転置インデックス（JSONストレージ用）"""
+
+    def __init__(self):
+        # term -> {knowledge_id: (tf, title_tf)}
+        self.postings = defaultdict(dict)
+        # knowledge_id -> ([term, ...], 本文の語数, タイトルの語数)
+        self.documents = {}
+        self.total_length = 0
+        self.total_title_length = 0
+
+    def add(self, knowledge_id, text, title=None):
+        if knowledge_id in self.documents:
+            self.remove(knowledge_id)
+        fields, length, title_length = analyze_document(text, title)
+        for term, tfs in fields.items():
+            self.postings[term][knowledge_id] = tfs
+        self.documents[knowledge_id] = (list(fields), length, title_length)
+        self.total_length += length
+        self.total_title_length += title_length
+
+    def remove(self, knowledge_id, text=None, title=None):
+        document = self.documents.pop(knowledge_id, None)
+        if document is None:
+            return
+        terms, length, title_length = document
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(knowledge_id, None)
+                if not postings:
+                    del self.postings[term]
+        self.total_length -= length
+        self.total_title_length -= title_length
+
+    def clear(self):
+        self.postings.clear()
+        self.documents.clear()
+        self.total_length = 0
+        self.total_title_length = 0
+
+    def corpus_stats(self):
+        """(エントリ数, 本文の語数の合計, タイトルの語数の合計) を返す"""
+        return len(self.documents), self.total_length, self.total_title_length
+
+    def document_frequencies(self, terms):
+        return {term: len(self.postings[term]) for term in terms if term in self.postings}
+
+    def postings_for(self, terms):
+        """{term: [(knowledge_id, tf, title_tf, 本文の語数, タイトルの語数), ...]} を返す"""
+        result = {}
+        for term in terms:
+            if term not in self.postings:
+                continue
+            result[term] = [
+                (knowledge_id, tf, title_tf, self.documents[knowledge_id][1], self.documents[knowledge_id][2])
+                for knowledge_id, (tf, title_tf) in self.postings[term].items()
+            ]
+        return result
+
+
+class SQLiteInvertedIndex:
+    """SQLiteに保存する転置インデックス
+
+    書き込みは呼び出し側のトランザクション内で行い、知識ベースの本体と常に同期させる。
+    BM25の計算に使う文書頻度（df）と語数の合計も追加・削除のたびに更新する。
+    postings の各行は知識IDの代わりに整数の docid を持ち、エントリの語数は
+    index_documents に1件につき1行だけ保存する。
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._create_tables()
+
+    def _create_tables(self):
+        with self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS index_documents (
+                    docid INTEGER PRIMARY KEY,
+                    knowledge_id TEXT NOT NULL UNIQUE,
+                    length INTEGER NOT NULL,
+                    title_length INTEGER NOT NULL
+                )"""
+            )
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS postings (
+                    term TEXT NOT NULL,
+                    docid INTEGER NOT NULL,
+                    tf INTEGER NOT NULL,
+                    title_tf INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (term, docid)
+                ) WITHOUT ROWID"""
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS index_stats (key TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+
+    def reset(self):
+        """テーブルを作り直す（インデックスの形式が変わった場合に使用）"""
+        with self.conn:
+            self.conn.execute("DROP TABLE IF EXISTS postings")
+            self.conn.execute("DROP TABLE IF EXISTS index_documents")
+            self.conn.execute("DROP TABLE IF EXISTS terms")
+            self.conn.execute("DROP TABLE IF EXISTS index_stats")
+        self._create_tables()
+
+    def _update_stats(self, doc_count, total_length, total_title_length):
+        self.conn.executemany(
+            "INSERT INTO index_stats (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+            [("doc_count", doc_count), ("total_length", total_length), ("total_title_length", total_title_length)],
+        )
+
+    def add_many(self, documents):
+        """(knowledge_id, text, title) のリストをインデックスに追加する"""
+        postings = []
+        df = Counter()
+        doc_count = total_length = total_title_length = 0
+        for knowledge_id, text, title in documents:
+            fields, length, title_length = analyze_document(text, title)
+            docid = self.conn.execute(
+                "INSERT INTO index_documents (knowledge_id, length, title_length) VALUES (?, ?, ?)",
+                (knowledge_id, length, title_length),
+            ).lastrowid
+            for term, (tf, title_tf) in fields.items():
+                postings.append((term, docid, tf, title_tf))
+            df.update(fields.keys())
+            doc_count += 1
+            total_length += length
+            total_title_length += title_length
+        # 主キーの順に挿入すると B-tree のページの分割が少なくて済む
+        # （同じ語の行は docid の順に追加しているので、語だけで安定ソートすればよい）
+        postings.sort(key=itemgetter(0))
+        self.conn.executemany("INSERT INTO postings (term, docid, tf, title_tf) VALUES (?, ?, ?, ?)", postings)
+        self.conn.executemany(
+            "INSERT INTO terms (term, df) VALUES (?, ?) ON CONFLICT(term) DO UPDATE SET df = df + excluded.df",
+            sorted(df.items()),
+        )
+        self._update_stats(doc_count, total_length, total_title_length)
+
+    def remove(self, knowledge_id, text, title=None):
+        """エントリをインデックスから削除する（語は本文から再計算する）"""
+        row = self.conn.execute(
+            "SELECT docid, length, title_length FROM index_documents WHERE knowledge_id = ?", (knowledge_id,)
+        ).fetchone()
+        if row is None:
+            return
+        docid, length, title_length = row
+        terms = sorted(analyze_document(text, title)[0])
+        self.conn.executemany(
+            "DELETE FROM postings WHERE term = ? AND docid = ?", ((term, docid) for term in terms)
+        )
+        self.conn.executemany("UPDATE terms SET df = df - 1 WHERE term = ?", ((term,) for term in terms))
+        self.conn.executemany("DELETE FROM terms WHERE term = ? AND df <= 0", ((term,) for term in terms))
+        self.conn.execute("DELETE FROM index_documents WHERE docid = ?", (docid,))
+        self._update_stats(-1, -length, -title_length)
+
+    def clear(self):
+        self.conn.execute("DELETE FROM postings")
+        self.conn.execute("DELETE FROM index_documents")
+        self.conn.execute("DELETE FROM terms")
+        self.conn.execute("DELETE FROM index_stats")
+
+    def corpus_stats(self):
+        stats = dict(self.conn.execute("SELECT key, value FROM index_stats"))
+        return stats.get("doc_count", 0), stats.get("total_length", 0), stats.get("total_title_length", 0)
+
+    def document_frequencies(self, terms):
+        terms = list(terms)
+        if not terms:
+            return {}
+        placeholders = ",".join("?" * len(terms))
+        return dict(self.conn.execute(f"SELECT term, df FROM terms WHERE term IN ({placeholders})", terms))
+
+    def postings_for(self, terms):
+        result = {}
+        for term in terms:
+            result[term] = self.conn.execute(
+                """SELECT d.knowledge_id, p.tf, p.title_tf, d.length, d.title_length
+                FROM postings p JOIN index_documents d ON d.docid = p.docid WHERE p.term = ?""",
+                (term,),
+            ).fetchall()
+        return result
+
+
+def _bm25_scores(index, postings, dfs):
+    """BM25F（本文とタイトルの2フィールド）のスコアを計算する"""
+    doc_count, total_length, total_title_length = index.corpus_stats()
+    if doc_count <= 0:
+        return {}
+    avg_length = total_length / doc_count or 1.0
+    avg_title_length = total_title_length / doc_count or 1.0
+
+    scores = defaultdict(float)
+    for term, rows in postings.items():
+        df = dfs.get(term, len(rows))
+        idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+        for knowledge_id, tf, title_tf, length, title_length in rows:
+            weighted_tf = tf / (1 - BM25_B + BM25_B * length / avg_length)
+            if title_tf:
+                weighted_tf += BM25_TITLE_WEIGHT * title_tf / (
+                    1 - BM25_TITLE_B + BM25_TITLE_B * title_length / avg_title_length
+                )
+            scores[knowledge_id] += idf * weighted_tf * (BM25_K1 + 1) / (weighted_tf + BM25_K1)
+    return scores
+
+
+def search_index(index, query, fetch_entries, limit=5, ranker="legacy", candidate_limit=50, max_postings=20000,
+                 with_scores=False):
+    """転置インデックスを使って知識ベースを検索する
+
+    クエリの語を含むエントリだけを候補として集める。ほとんどのエントリに含まれる語
+    （df が max_postings を超える語）は、他に語がある場合は候補集めに使わない。
+
+    どちらのランカーも候補集め専用の語（1文字や単語の一部の一致）を含めて候補を集める。
+    ranker="legacy" の場合は出現回数による概算スコアの上位 candidate_limit 件を
+    従来のスコア（legacy_score）で採点し直す。ranker="bm25" の場合はインデックスに保存された
+    df と語数から BM25F のスコアを計算する（単語全体の一致は単語と候補集め用の語の両方で加点される）。
+
+    Args:
+        index: InvertedIndex または SQLiteInvertedIndex
+        query (str): 検索クエリ
+        fetch_entries (callable): 知識IDのリストを受け取り {knowledge_id: entry} を返す関数
+        limit (int): 返す件数
+        ranker (str): "legacy" または "bm25"
+        with_scores (bool): True の場合は (knowledge_id, entry, score) のリストを返す
+
+    Returns:
+        list: (knowledge_id, entry) のリスト（スコアの高い順）
+    """
+    if ranker not in RANKERS:
+        raise ValueError(f"Unknown ranker: {ranker}")
+    if not query.strip():
+        return []
+
+    terms = query_lookup_terms(query)
+    scored = []
+    if terms:
+        dfs = index.document_frequencies(terms)
+        selected = [term for term in terms if 0 < dfs.get(term, 0) <= max_postings]
+        if not selected and dfs:
+            # 全ての語が頻出語の場合は最も珍しい語だけを使う
+            selected = [min(dfs, key=dfs.get)]
+        postings = index.postings_for(selected)
+
+        if ranker == "bm25":
+            scores = _bm25_scores(index, postings, dfs)
+            top = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            entries = fetch_entries([knowledge_id for knowledge_id, _ in top])
+            scored = [(score, knowledge_id, entries[knowledge_id])
+                      for knowledge_id, score in top if knowledge_id in entries]
+        else:
+            scored = _legacy_rescore(query, postings, fetch_entries, limit, candidate_limit)
+
+    if with_scores:
+        return [(knowledge_id, entry, score) for score, knowledge_id, entry in scored]
+    return [(knowledge_id, entry) for _, knowledge_id, entry in scored]
+
+
+def _legacy_rescore(query, postings, fetch_entries, limit, candidate_limit):
+    """出現回数による概算スコアで候補を絞り、従来のスコアで採点し直す"""
+    has_japanese = any(ord(c) > 127 for c in query)
+    hit_score, count_weight = (2, 0.2) if has_japanese else (3, 0.5)
+    approx = defaultdict(float)
+    for rows in postings.values():
+        for row in rows:
+            approx[row[0]] += hit_score + row[1] * count_weight
+
+    candidate_ids = heapq.nlargest(candidate_limit, approx, key=approx.get)
+    entries = fetch_entries(candidate_ids)
+    scored = []
+    for knowledge_id in candidate_ids:
+        entry = entries.get(knowledge_id)
+        if entry is None:
+            continue
+        score = legacy_score(query, entry["content"])
+        if score > 0:
+            scored.append((score, knowledge_id, entry))
+    return heapq.nlargest(limit, scored, key=lambda item: item[0])
+
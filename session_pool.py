@@ -0,0 +1,138 @@
+"""ユーザーごとのGeminiチャットセッションを上限付きで保持するプール"""
+import time
+from collections import OrderedDict
+
+
+def _content_size(content):
+    """チャット履歴の1メッセージのおおよそのサイズ（バイト）を返す"""
+    parts = content.get("parts", []) if isinstance(content, dict) else getattr(content, "parts", [])
+    size = 0
+    for part in parts:
+        text = part if isinstance(part, str) else getattr(part, "text", "")
+        size += len(text.encode("utf-8")) if text else 0
+    return size
+
+
+def _content_role(content):
+    return content.get("role") if isinstance(content, dict) else getattr(content, "role", None)
+
+
+def _session_history(session):
+    """セッションの履歴を返す。途中で止まった応答などで履歴が壊れている場合は None"""
+    try:
+        return list(getattr(session, "history", None) or [])
+    except Exception:
+        return None
+
+
+class ChatSessionPool:
+    """チャットセッションのLRUプール
+
+    セッション数が max_sessions を超えたら最も長く使われていないものを破棄し、
+    idle_ttl 秒使われていないセッションも破棄する。各セッションの履歴は
+    max_messages 件・max_bytes バイトを超えないよう古い往復から切り詰める。
+    破棄されたユーザーには、次の呼び出し時に factory で新しいセッションを作り直す。
+
+    Args:
+        factory (callable): user_id を受け取って新しいチャットセッションを返す関数
+        max_sessions (int): 保持するセッション数の上限
+        max_messages (int): 1セッションの履歴に残すメッセージ数の上限
+        max_bytes (int): 1セッションの履歴のおおよその最大サイズ（バイト）
+        idle_ttl (float): 使われていないセッションを破棄するまでの時間（秒）
+    """
+
+    def __init__(self, factory, max_sessions=1000, max_messages=20, max_bytes=256 * 1024, idle_ttl=1800):
+        self.factory = factory
+        self.max_sessions = max(1, max_sessions)
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.sessions = OrderedDict()  # user_id -> [セッション, 最後に使った時刻]
+        self.created = 0
+        self.evicted = 0
+        self.expired = 0
+        self.trimmed = 0
+
+    def get(self, user_id):
+        """ユーザーのセッションを返す（無ければ作成する）"""
+        now = time.monotonic()
+        item = self.sessions.get(user_id)
+        if item is not None and now - item[1] >= self.idle_ttl:
+            del self.sessions[user_id]
+            self.expired += 1
+            item = None
+        if item is None:
+            item = self.sessions[user_id] = [self.factory(user_id), now]
+            self.created += 1
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+                self.evicted += 1
+        else:
+            self.sessions.move_to_end(user_id)
+            item[1] = now
+        history = _session_history(item[0])
+        if history is None:
+            # 履歴が壊れたセッションは作り直す
+            item[0] = self.factory(user_id)
+            self.created += 1
+        else:
+            self._trim(item[0], history)
+        return item[0]
+
+    def _trim(self, session, history):
+        """履歴が上限を超えていたら、古いものから往復単位で削除する"""
+        if not history:
+            return
+        sizes = [_content_size(content) for content in history]
+        total = sum(sizes)
+        start = 0
+        while start < len(history) and (len(history) - start > self.max_messages or total > self.max_bytes):
+            total -= sizes[start]
+            start += 1
+        # 履歴はユーザーの発言から始まる必要がある
+        while start < len(history) and _content_role(history[start]) != "user":
+            start += 1
+        if start:
+            session.history = history[start:]
+            self.trimmed += 1
+
+    def discard(self, user_id):
+        """ユーザーのセッションを破棄する"""
+        return self.sessions.pop(user_id, None) is not None
+
+    def expire_idle(self):
+        """idle_ttl を過ぎたセッションをまとめて破棄し、破棄した数を返す"""
+        deadline = time.monotonic() - self.idle_ttl
+        expired = [user_id for user_id, (_, last_used) in self.sessions.items() if last_used <= deadline]
+        for user_id in expired:
+            del self.sessions[user_id]
+        self.expired += len(expired)
+        return len(expired)
+
+    def clear(self):
+        self.sessions.clear()
+
+    def __contains__(self, user_id):
+        return user_id in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def estimated_bytes(self):
+        """保持している全セッションの履歴のおおよそのサイズ（バイト）"""
+        return sum(
+            _content_size(content)
+            for session, _ in self.sessions.values()
+            for content in (_session_history(session) or [])
+        )
+
+    def stats(self):
+        """セッション数などの統計を返す"""
+        return {
+            "sessions": len(self.sessions),
+            "estimated_bytes": self.estimated_bytes(),
+            "created": self.created,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "trimmed": self.trimmed,
+        }
@@ -0,0 +1,52 @@
+"""シャードの割り当てに関する共通の関数（bot.py と launcher.py で使う）"""
+import json
+import urllib.request
+
+DISCORD_API = "https://discord.com/api/v10"
+
+
+def parse_shard_ids(value):
+    """"0,1,4-7" の形式の文字列をシャードIDのリストに変換する（空の場合は None）"""
+    shard_ids = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "-" in item:
+            start, end = item.split("-", 1)
+            shard_ids.extend(range(int(start), int(end) + 1))
+        else:
+            shard_ids.append(int(item))
+    return sorted(set(shard_ids)) or None
+
+
+def format_shard_ids(shard_ids):
+    return ",".join(str(shard_id) for shard_id in shard_ids)
+
+
+def assign_shards(shard_ids, workers):
+    """シャードIDを workers 個のワーカーに連続した範囲でなるべく均等に分ける"""
+    workers = max(1, min(workers, len(shard_ids)))
+    size, extra = divmod(len(shard_ids), workers)
+    assignments = []
+    start = 0
+    for worker in range(workers):
+        end = start + size + (1 if worker < extra else 0)
+        assignments.append(shard_ids[start:end])
+        start = end
+    return assignments
+
+
+def fetch_gateway_info(token, timeout=10):
+    """Discord の推奨シャード数と、同時に接続できるシャード数を取得する
+
+    Returns:
+        tuple: (推奨シャード数, 同時に IDENTIFY できる数)
+    """
+    request = urllib.request.Request(
+        f"{DISCORD_API}/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot (launcher, 1.0)"},
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        data = json.load(response)
+    return data["shards"], data.get("session_start_limit", {}).get("max_concurrency", 1)
@@ -0,0 +1,49 @@
+"""同じ処理の同時実行をまとめる（single-flight）"""
+import asyncio
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら、新しく実行せずにその結果を待つ
+
+    同時に同じURLの取得や同じクエリの検索が要求された場合に、1回だけ実行して
+    全員に同じ結果を返す。例外も待っている全員に伝わる。
+    待っている側がキャンセルされても、実行中の処理はキャンセルしない。
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> 実行中のタスク
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, factory):
+        """factory() が返すコルーチンを実行し、(結果, 他の呼び出しと共有したかどうか) を返す
+
+        Args:
+            key: 同じ処理を識別するキー（ハッシュ可能な値）
+            factory (callable): 引数なしでコルーチンを返す関数
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task), True
+
+        task = asyncio.ensure_future(factory())
+        self._calls[key] = task
+        self.calls += 1
+
+        def forget(_):
+            if self._calls.get(key) is task:
+                del self._calls[key]
+
+        task.add_done_callback(forget)
+        return await asyncio.shield(task), False
+
+    def __len__(self):
+        return len(self._calls)
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls),
+        }
@@ -0,0 +1,108 @@
+"""Geminiの応答をDiscordのメッセージとして送信するためのヘルパー"""
+import time
+
+# Discordのメッセージ1件あたりの最大文字数
+DISCORD_MESSAGE_LIMIT = 2000
+
+# 応答が空だった場合に代わりに表示するテキスト
+EMPTY_REPLY_TEXT = "（応答がありませんでした）"
+
+# 分割位置として優先する区切り（前にあるものほど優先）
+_BOUNDARIES = ("\n\n", "\n", "。", "！", "？", ". ", "! ", "? ", "、", ", ", " ")
+
+
+def find_split_point(text, limit=DISCORD_MESSAGE_LIMIT):
+    """limit 文字以内で、できるだけ自然な区切りになる分割位置を返す
+
+    段落、改行、文末、読点、空白の順に探し、メッセージの後半に見つからなければ limit で切る。
+    """
+    if len(text) <= limit:
+        return len(text)
+    window = text[:limit]
+    for boundary in _BOUNDARIES:
+        index = window.rfind(boundary)
+        if index >= limit // 2:
+            return index + len(boundary)
+    return limit
+
+
+def split_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    """長いテキストを自然な区切りで limit 文字以内のメッセージに分割する"""
+    chunks = []
+    while len(text) > limit:
+        index = find_split_point(text, limit)
+        chunks.append(text[:index])
+        text = text[index:]
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class StreamingReply:
+    """ストリーミングで届く応答を、Discordのメッセージに逐次反映する
+
+    最初のテキストが届いた時点でメッセージを送信し、その後は edit_interval 秒ごとに
+    編集して内容を更新する（Discordの編集のレート制限に引っかからないようにする）。
+    メッセージが limit 文字を超えたら自然な区切りで確定し、続きを新しいメッセージに書く。
+
+    Args:
+        destination: メッセージを送信する先（Context やチャンネルなど send() を持つもの）
+        edit_interval (float): メッセージを編集する最小間隔（秒）
+        first_message (discord.Message, optional): 最初のテキストで上書きする既存のメッセージ
+            （「処理中です」などのメッセージを再利用する場合）
+    """
+
+    def __init__(self, destination, edit_interval=1.0, first_message=None, limit=DISCORD_MESSAGE_LIMIT):
+        self.destination = destination
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self.message = first_message
+        self._reuse_first_message = first_message is not None
+        self.full_text = ""
+        # 現在のメッセージに表示するテキストと、最後に反映したテキスト
+        self._current = ""
+        self._shown = None
+        self._last_edit = 0.0
+        self.first_token_at = None
+
+    async def append(self, text):
+        """届いたテキストを追加し、必要ならメッセージを送信・編集する"""
+        if not text:
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        self.full_text += text
+        self._current += text
+
+        # 上限を超えた分は区切りの良いところで確定して、新しいメッセージに送る
+        while len(self._current) > self.limit:
+            index = find_split_point(self._current, self.limit)
+            head, self._current = self._current[:index], self._current[index:]
+            await self._show(head)
+            self.message = None
+            self._shown = None
+
+        if self.message is None or self._reuse_first_message:
+            # 最初のテキストはすぐに表示する
+            await self._show(self._current)
+        elif time.monotonic() - self._last_edit >= self.edit_interval:
+            await self._show(self._current)
+
+    async def _show(self, text):
+        if not text.strip() or text == self._shown:
+            return
+        if self.message is None:
+            self.message = await self.destination.send(text)
+        else:
+            await self.message.edit(content=text, embed=None)
+        self._reuse_first_message = False
+        self._shown = text
+        self._last_edit = time.monotonic()
+
+    async def finish(self, empty_text=EMPTY_REPLY_TEXT):
+        """最後の内容を反映し、応答全体のテキストを返す"""
+        if not self.full_text.strip():
+            await self._show(empty_text)
+            return self.full_text
+        await self._show(self._current)
+        return self.full_text
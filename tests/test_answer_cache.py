@@ -0,0 +1,69 @@
+"""回答キャッシュのキーが検索された知識に合わせて変わることを確認する（モデルは loadtest のスタブを使う）"""
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import loadtest  # noqa: E402
+
+
+class AnswerCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.cwd = os.getcwd()
+        os.environ.setdefault("MESSAGE_INDEX_ENABLED", "false")
+        os.environ.setdefault("METRICS_ENABLED", "false")
+        cls.bot = loadtest.import_bot(cls.tmpdir.name)
+        os.chdir(cls.cwd)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        bot = self.bot
+        os.chdir(self.tmpdir.name)
+        self.model = loadtest.FakeModel(loadtest.LatencyModel(0, 0))
+        loadtest.install_fakes(bot, self.model, loadtest.LatencyModel(0, 0))
+        bot.ANSWER_CACHE_MODE = "shared"
+        bot.answer_cache.clear()
+        bot.load_knowledge_base()
+        bot.knowledge_store.clear()
+        self.guild = loadtest.FakeGuild(1)
+        self.channel = loadtest.FakeChannel(100, self.guild)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+
+    def context(self, user_id, content):
+        return loadtest.FakeContext(loadtest.FakeUser(user_id), self.guild, self.channel, content,
+                                    loadtest.LatencyModel(0, 0))
+
+    def ask(self, user_id, question):
+        asyncio.run(self.bot.ask(self.context(user_id, f"!ask {question}"), question=question))
+
+    def test_forget_topic_changes_key(self):
+        bot = self.bot
+        height_id = bot.add_knowledge("東京タワーの高さは333メートルです", "admin")
+        bot.add_knowledge("東京タワーは港区にあります", "admin")
+        self.ask(1, "東京タワーの高さは？")
+        self.ask(2, "東京タワーの高さは？")
+        self.assertEqual(self.model.calls, 1)
+
+        # 検索される知識が変わらない追加ではキャッシュを使い続ける
+        bot.add_knowledge("Pythonはプログラミング言語です", "admin")
+        self.ask(3, "東京タワーの高さは？")
+        self.assertEqual(self.model.calls, 1)
+
+        asyncio.run(bot.forget_topic(self.context(1, f"!forget_topic {height_id}"), topic=height_id))
+        self.ask(4, "東京タワーの高さは？")
+        self.assertEqual(self.model.calls, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+"""知識ベースのストレージが管理する重複検出のインデックスを確認する"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knowledge_store import JSONKnowledgeStore, SQLiteKnowledgeStore  # noqa: E402
+
+
+def make_entry(content):
+    return {"content": content, "added_by": "test", "timestamp": "2024-01-01 00:00:00"}
+
+
+class StoreDedupTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rng = random.Random(1)
+        self.text = "".join(rng.choice("あいうえおかきくけこさしすせそたちつてと") for _ in range(600))
+        self.similar = self.text[:300] + "X" + self.text[301:]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def open_stores(self):
+        return [
+            JSONKnowledgeStore(os.path.join(self.tmpdir.name, "knowledge_base.json"), near_duplicates=True),
+            SQLiteKnowledgeStore(os.path.join(self.tmpdir.name, "knowledge_base.db"), near_duplicates=True),
+        ]
+
+    def test_filter_registers_nothing_until_saved(self):
+        for store in self.open_stores():
+            with self.subTest(store=type(store).__name__):
+                kept, skipped = store.filter_duplicates([
+                    ("a", make_entry(self.text)), ("b", make_entry(self.text)), ("c", make_entry(self.similar)),
+                ])
+                self.assertEqual([knowledge_id for knowledge_id, _ in kept], ["a"])
+                self.assertEqual(skipped, 2)
+                self.assertIsNone(store.find_duplicate(self.text))
+                store.add_many(kept)
+                self.assertEqual(store.find_duplicate(self.text), "a")
+                self.assertEqual(store.find_duplicate(self.similar), "a")
+                store.close()
+
+    def test_persisted_and_removed_with_entries(self):
+        for store in self.open_stores():
+            store.add_many([("a", make_entry(self.text))])
+            store.close()
+        for store in self.open_stores():
+            with self.subTest(store=type(store).__name__):
+                self.assertEqual(store.find_duplicate(self.similar), "a")
+                store.delete("a")
+                self.assertIsNone(store.find_duplicate(self.similar))
+                store.close()
+
+    def test_failed_write_is_not_registered(self):
+        store = SQLiteKnowledgeStore(os.path.join(self.tmpdir.name, "knowledge_base.db"), near_duplicates=True)
+        kept, _ = store.filter_duplicates([("a", make_entry(self.text))])
+        with self.assertRaises(sqlite3.IntegrityError):
+            store.add_many(kept + [("b", {"content": None})])
+        self.assertIsNone(store.find_duplicate(self.text))
+        self.assertEqual(len(store.dedup), 0)
+        store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""会話履歴のジャーナル（history_store.HistoryJournal）の再生とコンパクションを確認する"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history_store import META_KEY, HistoryJournal  # noqa: E402
+
+
+class HistoryJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "conversation_history.json")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def journal(self, **kwargs):
+        return HistoryJournal(defaultdict(list), self.path, fsync=False, **kwargs)
+
+    def reload(self):
+        journal = self.journal()
+        replayed = journal.load()
+        return journal.history, replayed
+
+    def test_replays_journal_after_crash(self):
+        journal = self.journal()
+        for i in range(5):
+            journal.append_message("a", {"content": f"a{i}"}, max_length=3)
+        journal.append_message("b", {"content": "b0"}, max_length=3)
+        journal.clear_user("b")
+        # close() せずに終了してもジャーナルから復元できる
+        history, replayed = self.reload()
+        self.assertEqual([m["content"] for m in history["a"]], ["a2", "a3", "a4"])
+        self.assertNotIn("b", history)
+        self.assertEqual(replayed, 9)
+
+    def test_skips_corrupted_last_line(self):
+        journal = self.journal()
+        journal.append_message("a", {"content": "a0"}, max_length=10)
+        with open(journal.journal_path, "a", encoding="utf-8") as f:
+            f.write('{"op": "append", "user_id": "a", "mess')
+        history, replayed = self.reload()
+        self.assertEqual(history["a"], [{"content": "a0"}])
+        self.assertEqual(replayed, 1)
+
+    def test_compaction_writes_snapshot_and_removes_journal(self):
+        journal = self.journal()
+        journal.append_message("a", {"content": "a0"}, max_length=10)
+        journal.close()
+        self.assertFalse(os.path.exists(journal.journal_path))
+        with open(self.path, encoding="utf-8") as f:
+            self.assertEqual(json.load(f)[META_KEY], {"compacted_segment": 1})
+
+        # 続けて書き込んだ分はスナップショットの後に再生される
+        journal.append_message("a", {"content": "a1"}, max_length=10)
+        history, replayed = self.reload()
+        self.assertEqual([m["content"] for m in history["a"]], ["a0", "a1"])
+        self.assertEqual(replayed, 1)
+
+    def test_ignores_segments_already_in_snapshot(self):
+        journal = self.journal()
+        journal.append_message("a", {"content": "a0"}, max_length=10)
+        journal.compact()
+        # スナップショットの後、セグメントを削除する前にクラッシュした状態を再現する
+        with open(f"{journal.journal_path}.1", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"op": "append", "user_id": "a", "message": {"content": "a0"}}) + "\n")
+        journal.append_message("a", {"content": "a1"}, max_length=10)
+        history, replayed = self.reload()
+        self.assertEqual([m["content"] for m in history["a"]], ["a0", "a1"])
+        self.assertEqual(replayed, 1)
+        self.assertFalse(os.path.exists(f"{journal.journal_path}.1"))
+
+    def test_group_commit_and_background_compaction(self):
+        async def main():
+            journal = self.journal(flush_interval=0.01, compact_threshold=5)
+            for i in range(8):
+                journal.append_message("a", {"content": f"a{i}"}, max_length=100)
+            # イベントループ内ではタイマーが来るまで書き込まない
+            self.assertFalse(os.path.exists(journal.journal_path))
+            await asyncio.sleep(0.2)
+            self.assertTrue(os.path.exists(self.path))
+            journal.append_message("a", {"content": "a8"}, max_length=100)
+            await journal.flush_async()
+
+        asyncio.run(main())
+        history, replayed = self.reload()
+        self.assertEqual(len(history["a"]), 9)
+        self.assertEqual(replayed, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
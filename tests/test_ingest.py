@@ -0,0 +1,64 @@
+"""一括取り込み（ingest.py）の最後のインデックスの更新を確認する"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingest import IngestStats, Ingester, Manifest  # noqa: E402
+from knowledge_store import SQLiteKnowledgeStore  # noqa: E402
+
+
+class IngesterIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "knowledge_base.db")
+        self.store = SQLiteKnowledgeStore(self.path, batch_size=2)
+        self.store.add_many([("old", {"content": "既存のエントリです", "added_by": "test", "timestamp": "t"})])
+
+    def tearDown(self):
+        self.store.close()
+        self.tmpdir.cleanup()
+
+    def ingester(self):
+        manifest = Manifest(os.path.join(self.tmpdir.name, "manifest.json"))
+        return Ingester(self.store, manifest, IngestStats(), batch_size=2)
+
+    def test_indexes_only_new_entries(self):
+        ingester = self.ingester()
+        ingester.add_document("a.txt", "1", 10, ["東京タワーの高さ", "大阪城の天守閣", "名古屋城のしゃちほこ"])
+        with mock.patch.object(self.store, "rebuild_index", side_effect=AssertionError("full rebuild")):
+            ingester.finish()
+        self.assertTrue(self.store.index_current())
+        self.assertEqual(self.store.index.corpus_stats()[0], 4)
+        for query in ("東京タワー", "天守閣", "しゃちほこ", "既存"):
+            self.assertTrue(self.store.search(query), query)
+
+        # 変更されたソースは古いエントリをインデックスからも削除して取り込み直す
+        ingester = self.ingester()
+        ingester.add_document("a.txt", "2", 10, ["札幌の時計台"])
+        ingester.finish()
+        self.assertEqual(self.store.index.corpus_stats()[0], 2)
+        self.assertEqual(self.store.search("東京タワー"), [])
+        self.assertTrue(self.store.search("時計台"))
+
+    def test_rebuilds_when_previous_run_did_not_finish(self):
+        ingester = self.ingester()
+        ingester.add_document("a.txt", "1", 10, ["東京タワーの高さ", "大阪城の天守閣"])
+        ingester.flush()
+        # finish() の前に終了した場合はインデックスが古いままになる
+        self.assertFalse(self.store.index_current())
+
+        ingester = self.ingester()
+        ingester.add_document("b.txt", "1", 10, ["札幌の時計台"])
+        with mock.patch.object(self.store, "index_entries", side_effect=AssertionError("incremental")):
+            ingester.finish()
+        self.assertTrue(self.store.index_current())
+        self.assertTrue(self.store.search("天守閣"))
+        self.assertTrue(self.store.search("時計台"))
+
+
+if __name__ == "__main__":
+    unittest.main()
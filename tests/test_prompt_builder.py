@@ -0,0 +1,82 @@
+"""プロンプトの組み立て（prompt_builder.py）の切り詰めと削除の順序を確認する"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompt_builder import TRUNCATION_MARK, PromptBuilder  # noqa: E402
+
+
+class CharEstimator:
+    """1文字を1トークンとして数える（テストで予算を計算しやすくする）"""
+
+    def estimate(self, text):
+        return len(text) if text else 0
+
+
+def builder(budget):
+    return PromptBuilder(budget, estimator=CharEstimator())
+
+
+class PromptBuilderTest(unittest.TestCase):
+    def test_drops_lowest_priority_first_and_keeps_order(self):
+        prompt = builder(60)
+        prompt.add("B" * 20, priority=2, required=False)
+        prompt.add("C" * 20, priority=1, required=False)
+        prompt.add("A" * 20, priority=3, required=False)
+        prompt.add("Q" * 10)
+        built = prompt.build()
+        # 必須の Q（10+区切り2）の残りに A と B が入り、C が削除される
+        self.assertEqual(built.text, "\n\n".join(["B" * 20, "A" * 20, "Q" * 10]))
+        self.assertEqual((built.dropped, built.truncated), (1, 0))
+        self.assertLessEqual(built.tokens, 60)
+
+    def test_required_items_are_always_included(self):
+        prompt = builder(5)
+        prompt.add("Q" * 10)
+        prompt.add("A" * 3, priority=100, required=False)
+        built = prompt.build()
+        self.assertEqual(built.text, "Q" * 10)
+        self.assertEqual(built.dropped, 1)
+
+    def test_truncates_to_remaining_budget(self):
+        prompt = builder(50)
+        prompt.add("Q" * 10)
+        prompt.add("x" * 100, priority=2, required=False, truncatable=True, min_tokens=5)
+        prompt.add("y" * 100, priority=1, required=False, truncatable=True, min_tokens=5)
+        built = prompt.build()
+        # x は残りの36トークンに切り詰め、予算が min_tokens に満たない y は削除する
+        self.assertEqual(built.text, "Q" * 10 + "\n\n" + "x" * 35 + TRUNCATION_MARK)
+        self.assertEqual((built.dropped, built.truncated), (1, 1))
+        self.assertLessEqual(built.tokens, 50)
+
+    def test_section_frame_only_when_items_fit(self):
+        prompt = builder(200)
+        section = prompt.section(header="見出し", footer="結び", empty_text="知識なし")
+        section.add("k1", priority=2)
+        section.add("k2", priority=1)
+        self.assertEqual(prompt.build().text, "見出し\n\nk1\n\nk2\n\n結び")
+
+        # どの項目も入らなければ見出しは出さず empty_text にする
+        prompt = builder(10)
+        section = prompt.section(header="見出し", footer="結び", empty_text="知識なし")
+        section.add("k" * 20)
+        built = prompt.build()
+        self.assertEqual(built.text, "知識なし")
+        self.assertEqual(built.dropped, 1)
+
+    def test_section_items_drop_by_priority(self):
+        prompt = builder(30)
+        section = prompt.section(header="H", footer="F")
+        section.add("a" * 10, priority=1)
+        section.add("b" * 10, priority=2)
+        section.add("c" * 10, priority=0)
+        built = prompt.build()
+        # 見出しと結び（各1+区切り2）の残りに b、次に a が入る
+        self.assertEqual(built.text, "H\n\n" + "a" * 10 + "\n\n" + "b" * 10 + "\n\nF")
+        self.assertEqual(built.dropped, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+"""受付スケジューラー（scheduler.py）の実行順と受付の制限を確認する"""
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scheduler  # noqa: E402
+from scheduler import Overloaded, RateLimited, RequestScheduler  # noqa: E402
+
+
+class FakeTime:
+    """scheduler モジュールの time の代わり（asyncio のイベントループの時計は変えない）"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class FairnessTest(unittest.TestCase):
+    def test_guilds_and_users_take_turns(self):
+        async def main():
+            sched = RequestScheduler(max_concurrency=1, user_rate=0, guild_rate=0, update_interval=0)
+            order = []
+            release = asyncio.Event()
+
+            async def blocker():
+                async with sched.slot("x", 3):
+                    await release.wait()
+
+            async def request(name, user_id, guild_id):
+                async with sched.slot(user_id, guild_id):
+                    order.append(name)
+
+            holder = asyncio.create_task(blocker())
+            await asyncio.sleep(0)
+            tasks = []
+            for name, user_id, guild_id in [("a1", "a", 1), ("a2", "a", 1), ("a3", "a", 1), ("b1", "b", 1), ("c1", "c", 2)]:
+                tasks.append(asyncio.create_task(request(name, user_id, guild_id)))
+                await asyncio.sleep(0)
+
+            # 待っている間の位置の見込みも実際の実行順と同じになる
+            positions = sched._compute_positions()
+            queued = sorted(positions, key=positions.get)
+            self.assertEqual([request.user.user_id for request in queued], ["a", "c", "b", "a", "a"])
+
+            release.set()
+            await asyncio.gather(holder, *tasks)
+            return order
+
+        # 1人が続けて送ったリクエスト（a2, a3）より、他のサーバーと他のユーザーが先に実行される
+        self.assertEqual(run(main()), ["a1", "c1", "b1", "a2", "a3"])
+
+    def test_one_request_per_user_at_a_time(self):
+        async def main():
+            sched = RequestScheduler(max_concurrency=4, user_rate=0, guild_rate=0)
+            running = 0
+            max_running = 0
+            others_started = asyncio.Event()
+
+            async def request(user_id):
+                nonlocal running, max_running
+                async with sched.slot(user_id, 1):
+                    running += 1
+                    max_running = max(max_running, running)
+                    if user_id == "b":
+                        others_started.set()
+                    await asyncio.sleep(0.01)
+                    running -= 1
+
+            tasks = [asyncio.create_task(request("a")) for _ in range(3)]
+            await asyncio.sleep(0)
+            # 同じユーザーの残りのリクエストは枠が空いていても待つ
+            self.assertEqual(sched.stats()["running"], 1)
+            self.assertEqual(sched.stats()["queued"], 2)
+            # 他のユーザーは空いている枠ですぐに実行される
+            tasks.append(asyncio.create_task(request("b")))
+            await asyncio.wait_for(others_started.wait(), 1)
+            self.assertEqual(sched.stats()["running"], 2)
+            await asyncio.gather(*tasks)
+            return max_running
+
+        self.assertEqual(run(main()), 2)
+
+
+class AdmissionTest(unittest.TestCase):
+    def test_rejects_when_estimated_wait_exceeds_deadline(self):
+        async def main():
+            fake_time = FakeTime()
+            with mock.patch.object(scheduler, "time", fake_time):
+                sched = RequestScheduler(max_concurrency=1, max_wait=1.0, user_rate=0, guild_rate=0)
+                # 1回の実行に5秒かかったことにする
+                async with sched.slot("a", 1):
+                    fake_time.now += 5.0
+                self.assertEqual(sched.estimated_wait(), 0.0)
+
+                release = asyncio.Event()
+
+                async def blocker():
+                    async with sched.slot("a", 1):
+                        await release.wait()
+
+                holder = asyncio.create_task(blocker())
+                await asyncio.sleep(0)
+                self.assertEqual(sched.estimated_wait(), 5.0)
+                with self.assertRaises(Overloaded):
+                    async with sched.slot("b", 1):
+                        self.fail("should not run")
+                self.assertEqual(sched.stats()["shed"], 1)
+                self.assertEqual(sched.stats()["queued"], 0)
+                release.set()
+                await holder
+
+        run(main())
+
+    def test_cancels_request_that_waits_past_deadline(self):
+        async def main():
+            sched = RequestScheduler(max_concurrency=1, max_wait=0.05, user_rate=0, guild_rate=0)
+            release = asyncio.Event()
+
+            async def blocker():
+                async with sched.slot("a", 1):
+                    await release.wait()
+
+            holder = asyncio.create_task(blocker())
+            await asyncio.sleep(0)
+            with self.assertRaises(Overloaded):
+                async with sched.slot("b", 1):
+                    self.fail("should not run")
+            self.assertEqual(sched.stats()["queued"], 0)
+            release.set()
+            await holder
+            # 取り消したリクエストは実行されず、実行枠も残らない
+            self.assertEqual(sched.stats()["running"], 0)
+            self.assertEqual(sched.stats()["completed"], 1)
+
+        run(main())
+
+    def test_rejects_when_queue_is_full(self):
+        async def main():
+            sched = RequestScheduler(max_concurrency=1, max_queue=1, user_rate=0, guild_rate=0)
+            release = asyncio.Event()
+
+            async def request(user_id):
+                async with sched.slot(user_id, 1):
+                    await release.wait()
+
+            tasks = [asyncio.create_task(request("a")), asyncio.create_task(request("b"))]
+            await asyncio.sleep(0)
+            with self.assertRaises(Overloaded):
+                async with sched.slot("c", 1):
+                    pass
+            release.set()
+            await asyncio.gather(*tasks)
+
+        run(main())
+
+    def test_token_bucket_limits_each_user(self):
+        async def main():
+            fake_time = FakeTime()
+            with mock.patch.object(scheduler, "time", fake_time):
+                sched = RequestScheduler(user_rate=0.5, user_burst=1, guild_rate=0)
+                async with sched.slot("a", 1):
+                    pass
+                with self.assertRaises(RateLimited) as raised:
+                    async with sched.slot("a", 1):
+                        pass
+                self.assertEqual(raised.exception.scope, "user")
+                self.assertAlmostEqual(raised.exception.retry_after, 2.0)
+                # 他のユーザーは制限されず、時間が経てば同じユーザーも受け付ける
+                async with sched.slot("b", 1):
+                    pass
+                fake_time.now += 2.0
+                async with sched.slot("a", 1):
+                    pass
+                self.assertEqual(sched.stats()["rate_limited"], 1)
+
+        run(main())
+
+
+if __name__ == "__main__":
+    unittest.main()
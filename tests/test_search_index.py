@@ -0,0 +1,112 @@
+"""転置インデックスによる検索（search_index）の上位5件が従来の全件走査と一致することを確認する"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knowledge_store import JSONKnowledgeStore, SQLiteKnowledgeStore  # noqa: E402
+from search_index import legacy_score  # noqa: E402
+
+ENTRIES = [
+    "猫が好きです",
+    "犬も猫も好きですが、猫の方が好きです",
+    "今日の天気は晴れです",
+    "東京の天気は雨のち晴れ",
+    "明日は雨が降るでしょう",
+    "Pythonのリストは可変です",
+    "python3 is great",
+    "Python is a programming language",
+    "The category of things",
+    "A cat sat on the mat",
+    "Cats and dogs are pets",
+    "The weather in Tokyo is sunny",
+    "Concatenate strings with the plus operator",
+    "会議は毎週月曜日の10時から",
+    "サーバーの再起動は深夜2時に行う",
+    "The server restarts at 2am every night",
+    "Discordのボットは discord.py で作られている",
+    "データベースは SQLite を使う",
+    "Use SQLite in WAL mode for concurrent readers",
+    "ログは logs ディレクトリに保存する",
+]
+
+QUERIES = [
+    "猫",
+    "猫が好き",
+    "天気",
+    "雨",
+    "cat",
+    "python",
+    "Python",
+    "the weather",
+    "server restarts",
+    "sqlite",
+    "discord.py",
+    "ボットは",
+    "月曜日の会議",
+    "ego",
+    "at",
+    "logs",
+]
+
+
+def scan_top(entries, query, limit=5):
+    """変更前の search_knowledge と同じ全件走査の上位のスコア"""
+    scores = [legacy_score(query, content) for content in entries.values()]
+    return sorted((score for score in scores if score > 0), reverse=True)[:limit]
+
+
+class SearchIndexLegacyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.entries = {str(i): content for i, content in enumerate(ENTRIES)}
+        self.stores = [
+            JSONKnowledgeStore(os.path.join(self.tmpdir.name, "knowledge_base.json")),
+            SQLiteKnowledgeStore(os.path.join(self.tmpdir.name, "knowledge_base.db")),
+        ]
+        for store in self.stores:
+            store.add_many([
+                (knowledge_id, {"content": content, "added_by": "test", "timestamp": "2024-01-01 00:00:00"})
+                for knowledge_id, content in self.entries.items()
+            ])
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        self.tmpdir.cleanup()
+
+    def test_top5_matches_legacy_scan(self):
+        for store in self.stores:
+            for query in QUERIES:
+                with self.subTest(store=type(store).__name__, query=query):
+                    results = store.search_with_scores(query, ranker="legacy")
+                    self.assertEqual([score for _, _, score in results], scan_top(self.entries, query))
+                    for knowledge_id, entry, score in results:
+                        self.assertEqual(score, legacy_score(query, self.entries[knowledge_id]))
+
+    def test_short_and_partial_word_queries(self):
+        for store in self.stores:
+            with self.subTest(store=type(store).__name__):
+                self.assertIn("0", [knowledge_id for knowledge_id, _ in store.search("猫")])
+                self.assertIn("8", [knowledge_id for knowledge_id, _ in store.search("cat")])
+                self.assertIn("6", [knowledge_id for knowledge_id, _ in store.search("python")])
+                # BM25 も候補集め専用の語で1文字や単語の一部に一致するエントリを返す
+                for query in ("猫", "cat", "python", "ego"):
+                    self.assertTrue(store.search(query, ranker="bm25"), query)
+                self.assertIn("12", [knowledge_id for knowledge_id, _ in store.search("cat", limit=10, ranker="bm25")])
+
+    def test_miss_does_not_scan_entries(self):
+        for store in self.stores:
+            with self.subTest(store=type(store).__name__):
+                def fail():
+                    raise AssertionError("iter_entries should not be called")
+                store.iter_entries = fail
+                for ranker in ("legacy", "bm25"):
+                    self.assertEqual(store.search("量子力学", ranker=ranker), [])
+                    self.assertEqual(store.search("zzzqqq", ranker=ranker), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+"""チャットセッションのプール（session_pool.py）の破棄と履歴の切り詰めを確認する"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import session_pool  # noqa: E402
+from session_pool import ChatSessionPool  # noqa: E402
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeSession:
+    def __init__(self, user_id, history=None):
+        self.user_id = user_id
+        self.history = history or []
+
+
+def message(role, text):
+    return {"role": role, "parts": [text]}
+
+
+class ChatSessionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.time = FakeTime()
+        patcher = mock.patch.object(session_pool, "time", self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_evicts_least_recently_used(self):
+        pool = ChatSessionPool(FakeSession, max_sessions=2)
+        a = pool.get("a")
+        pool.get("b")
+        # a を使うと、次に追加した時に破棄されるのは b になる
+        self.assertIs(pool.get("a"), a)
+        pool.get("c")
+        self.assertIn("a", pool)
+        self.assertNotIn("b", pool)
+        self.assertEqual(pool.stats()["evicted"], 1)
+        # 破棄されたユーザーには新しいセッションを作る
+        pool.get("b")
+        self.assertIn("b", pool)
+        self.assertNotIn("a", pool)
+        self.assertEqual(pool.stats()["created"], 4)
+
+    def test_expires_idle_sessions(self):
+        pool = ChatSessionPool(FakeSession, idle_ttl=60)
+        a = pool.get("a")
+        self.time.now += 30
+        pool.get("b")
+        self.time.now += 30
+        # 期限を過ぎたセッションは get() でも作り直す
+        self.assertIsNot(pool.get("a"), a)
+        self.assertEqual(pool.stats()["expired"], 1)
+
+        self.time.now += 30
+        # b は最後に使ってから60秒、a は30秒
+        self.assertEqual(pool.expire_idle(), 1)
+        self.assertIn("a", pool)
+        self.assertNotIn("b", pool)
+        self.assertEqual(pool.stats()["expired"], 2)
+
+    def test_trims_history_from_user_turn(self):
+        history = [message("user" if i % 2 == 0 else "model", f"m{i}") for i in range(6)]
+        pool = ChatSessionPool(lambda user_id: FakeSession(user_id, list(history)), max_messages=3)
+        session = pool.get("a")
+        # 3件に収めた上で、履歴はユーザーの発言から始める
+        self.assertEqual([part["parts"][0] for part in session.history], ["m4", "m5"])
+        self.assertEqual(pool.stats()["trimmed"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+"""同時実行をまとめる SingleFlight（singleflight.py）の結果と例外の共有を確認する"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from singleflight import SingleFlight  # noqa: E402
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_concurrent_calls_share_one_result(self):
+        async def main():
+            flight = SingleFlight()
+            calls = 0
+            release = asyncio.Event()
+
+            async def fetch():
+                nonlocal calls
+                calls += 1
+                await release.wait()
+                return "result"
+
+            waiters = [asyncio.create_task(flight.do("key", fetch)) for _ in range(3)]
+            await asyncio.sleep(0)
+            release.set()
+            results = await asyncio.gather(*waiters)
+            return results, calls, flight.stats()
+
+        results, calls, stats = asyncio.run(main())
+        self.assertEqual(results, [("result", False), ("result", True), ("result", True)])
+        self.assertEqual(calls, 1)
+        self.assertEqual(stats, {"calls": 1, "coalesced": 2, "in_flight": 0})
+
+    def test_error_reaches_every_waiter(self):
+        async def main():
+            flight = SingleFlight()
+            release = asyncio.Event()
+
+            async def fail():
+                await release.wait()
+                raise ValueError("boom")
+
+            waiters = [asyncio.create_task(flight.do("key", fail)) for _ in range(3)]
+            await asyncio.sleep(0)
+            release.set()
+            results = await asyncio.gather(*waiters, return_exceptions=True)
+            # 失敗した処理は残らず、次の呼び出しは新しく実行する
+            self.assertEqual(len(flight), 0)
+
+            async def succeed():
+                return "ok"
+
+            return results, await flight.do("key", succeed)
+
+        results, retry = asyncio.run(main())
+        self.assertEqual(len(results), 3)
+        for error in results:
+            self.assertIsInstance(error, ValueError)
+            self.assertEqual(str(error), "boom")
+        self.assertEqual(retry, ("ok", False))
+
+    def test_cancelled_waiter_does_not_cancel_call(self):
+        async def main():
+            flight = SingleFlight()
+            release = asyncio.Event()
+
+            async def fetch():
+                await release.wait()
+                return "result"
+
+            first = asyncio.create_task(flight.do("key", fetch))
+            second = asyncio.create_task(flight.do("key", fetch))
+            await asyncio.sleep(0)
+            first.cancel()
+            await asyncio.sleep(0)
+            release.set()
+            return first.cancelled(), await second
+
+        cancelled, result = asyncio.run(main())
+        self.assertTrue(cancelled)
+        self.assertEqual(result, ("result", True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+"""長い応答の分割（streaming.py）と StreamingReply の送信を確認する"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streaming import EMPTY_REPLY_TEXT, StreamingReply, find_split_point, split_message  # noqa: E402
+
+
+class SplitTest(unittest.TestCase):
+    def test_short_text_is_not_split(self):
+        self.assertEqual(find_split_point("こんにちは", limit=10), 5)
+        self.assertEqual(split_message("こんにちは", limit=10), ["こんにちは"])
+        self.assertEqual(split_message("", limit=10), [])
+
+    def test_prefers_paragraph_then_sentence(self):
+        text = "あいうえお。かきく\n\nけこさしすせそ"
+        self.assertEqual(find_split_point(text, limit=16), len("あいうえお。かきく\n\n"))
+        # 段落が無ければ文末で切る
+        text = "あいうえお。かきくけこさしすせそ"
+        self.assertEqual(find_split_point(text, limit=10), len("あいうえお。"))
+
+    def test_ignores_boundary_in_first_half(self):
+        # 前半にしか区切りが無い場合は短すぎるメッセージにせず limit で切る
+        text = "あ。" + "い" * 20
+        self.assertEqual(find_split_point(text, limit=10), 10)
+
+    def test_chunks_fit_limit_and_keep_text(self):
+        text = "これは文です。" * 50 + "\n\n" + "This is a sentence. " * 40
+        chunks = split_message(text, limit=100)
+        self.assertEqual("".join(chunks), text)
+        self.assertTrue(all(len(chunk) <= 100 for chunk in chunks))
+        self.assertTrue(all(chunk.endswith(("。", " ", "\n")) for chunk in chunks[:-1]))
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+        self.edits = [content]
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+        self.edits.append(content)
+
+
+class FakeDestination:
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, content):
+        message = FakeMessage(content)
+        self.messages.append(message)
+        return message
+
+
+class StreamingReplyTest(unittest.TestCase):
+    def test_long_reply_continues_in_new_message(self):
+        async def main():
+            destination = FakeDestination()
+            reply = StreamingReply(destination, edit_interval=0, limit=20)
+            for text in ["最初の文です。", "二番目の文です。", "三番目の文です。"]:
+                await reply.append(text)
+            self.assertEqual(await reply.finish(), "最初の文です。二番目の文です。三番目の文です。")
+            return [message.content for message in destination.messages]
+
+        self.assertEqual(asyncio.run(main()), ["最初の文です。二番目の文です。", "三番目の文です。"])
+
+    def test_empty_reply_shows_placeholder(self):
+        async def main():
+            first_message = FakeMessage("回答を生成しています...")
+            reply = StreamingReply(FakeDestination(), first_message=first_message)
+            await reply.append("\n")
+            self.assertEqual(await reply.finish(), "\n")
+            return first_message.content
+
+        self.assertEqual(asyncio.run(main()), EMPTY_REPLY_TEXT)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,399 @@
+"""知識ベースの意味検索（埋め込みベクトル）
+
+各エントリの埋め込みベクトルを正規化して float32 の行列としてファイルに保存し、
+メモリマップ経由で NumPy の内積（コサイン類似度）による総当たり検索を行う。
+
+ファイル構成:
+    <path>       埋め込みベクトルの行列（float32, 行 = エントリ）
+    <path>.ids   行と知識IDの対応（"+id" で追加、"-id" で削除を1行ずつ追記）
+    <path>.meta  次元数と埋め込みの種類
+
+シャードを複数のワーカープロセスで動かす場合は、計算したベクトルを SharedVectorStore
+（共有の SQLite）にも保存し、他のワーカーは埋め込みを計算せずにそれを読み込む。
+"""
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from search_index import extract_terms
+
+SEARCH_MODES = ("keyword", "semantic", "hybrid")
+
+
+def normalize(vectors):
+    """各行を長さ1に正規化する（ゼロベクトルはそのまま）"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class HashingEmbedder:
+    """外部APIを使わない決定的な埋め込み（オフライン環境やテスト用）
+
+    インデックスと同じ語（2-gram・単語）をハッシュで固定次元に割り当てる。
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim=256, batch_size=1000):
+        self.dim = dim
+        self.batch_size = batch_size
+
+    def _vector(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for term, tf in extract_terms(text).items():
+            digest = int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+            sign = 1.0 if digest >> 63 else -1.0
+            vector[digest % self.dim] += sign * (1.0 + math.log(tf))
+        return vector
+
+    def embed_documents(self, texts):
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return normalize(np.stack([self._vector(text) for text in texts]))
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class GeminiEmbedder:
+    """Gemini の埋め込みAPIを使う埋め込み
+
+    embed_content にテキストのリストを渡し、batch_size 件ずつまとめてリクエストする。
+    呼び出しは同期的なので、ボットからはスレッドで実行すること。
+    """
+
+    name = "gemini"
+
+    def __init__(self, model="models/text-embedding-004", dim=768, batch_size=100):
+        import google.generativeai as genai
+        self._genai = genai
+        self.model = model
+        self.dim = dim
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts):
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            result = self._genai.embed_content(
+                model=self.model,
+                content=list(texts[i:i + self.batch_size]),
+                task_type="retrieval_document",
+            )
+            vectors.extend(result["embedding"])
+        if not vectors:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return normalize(vectors)
+
+    def embed_query(self, text):
+        result = self._genai.embed_content(model=self.model, content=text, task_type="retrieval_query")
+        return normalize(result["embedding"])
+
+
+def create_embedder(name):
+    """設定名から埋め込みを作成する（"gemini" または "hashing"）"""
+    if name == "gemini":
+        return GeminiEmbedder()
+    if name == "hashing":
+        return HashingEmbedder()
+    raise ValueError(f"Unknown embedder: {name}")
+
+
+class VectorIndex:
+    """メモリマップされた行列による総当たりのベクトル検索
+
+    削除した行はゼロにして無効化し、無効な行が半分を超えたら詰め直す。
+
+    Args:
+        path (str): 行列ファイルのパス
+        dim (int): ベクトルの次元数
+        embedder_name (str): 埋め込みの種類（変わった場合はインデックスを作り直す）
+    """
+
+    def __init__(self, path, dim, embedder_name, search_batch_rows=65536):
+        self.path = path
+        self.ids_path = f"{path}.ids"
+        self.meta_path = f"{path}.meta"
+        self.dim = dim
+        self.embedder_name = embedder_name
+        self.search_batch_rows = search_batch_rows
+        self.row_ids = []  # 行番号 -> 知識ID（削除済みは None）
+        self.rows = {}  # 知識ID -> 行番号
+        self.matrix = None
+        self.alive = np.zeros(0, dtype=bool)
+        self._load()
+
+    # ---- ファイル管理 ----
+
+    def _load(self):
+        meta = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        if meta != {"dim": self.dim, "embedder": self.embedder_name}:
+            # 次元数や埋め込みの種類が変わった場合は作り直す
+            self._reset_files()
+            return
+
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if line.startswith("+"):
+                        knowledge_id = line[1:]
+                        if knowledge_id in self.rows:
+                            self.row_ids[self.rows[knowledge_id]] = None
+                        self.rows[knowledge_id] = len(self.row_ids)
+                        self.row_ids.append(knowledge_id)
+                    elif line.startswith("-"):
+                        row = self.rows.pop(line[1:], None)
+                        if row is not None:
+                            self.row_ids[row] = None
+        self._open_matrix(max(len(self.row_ids), 1024))
+        self.alive[:len(self.row_ids)] = [knowledge_id is not None for knowledge_id in self.row_ids]
+
+    def _reset_files(self):
+        self.matrix = None
+        self.alive = np.zeros(0, dtype=bool)
+        for path in (self.path, self.ids_path):
+            if os.path.exists(path):
+                os.remove(path)
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "embedder": self.embedder_name}, f)
+        self.row_ids = []
+        self.rows = {}
+        self._open_matrix(1024)
+
+    def _open_matrix(self, capacity):
+        if self.matrix is not None:
+            self.matrix.flush()
+            del self.matrix
+        size = capacity * self.dim * 4
+        with open(self.path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        capacity = os.path.getsize(self.path) // (self.dim * 4)
+        self.matrix = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:len(self.alive)] = self.alive[:capacity]
+        self.alive = alive
+
+    def _append_ids(self, lines):
+        with open(self.ids_path, "a", encoding="utf-8") as f:
+            f.write("".join(f"{line}\n" for line in lines))
+
+    # ---- 更新 ----
+
+    def add(self, knowledge_ids, vectors):
+        """知識IDと埋め込みベクトルを追加する（既存のIDは置き換える）"""
+        if len(knowledge_ids) == 0:
+            return
+        vectors = normalize(vectors)
+        lines = []
+        for knowledge_id in knowledge_ids:
+            if knowledge_id in self.rows:
+                self._remove_row(knowledge_id)
+                lines.append(f"-{knowledge_id}")
+        start = len(self.row_ids)
+        end = start + len(knowledge_ids)
+        if end > self.matrix.shape[0]:
+            self._open_matrix(max(end, self.matrix.shape[0] * 2))
+        self.matrix[start:end] = vectors
+        self.matrix.flush()
+        self.alive[start:end] = True
+        for offset, knowledge_id in enumerate(knowledge_ids):
+            self.rows[knowledge_id] = start + offset
+            self.row_ids.append(knowledge_id)
+            lines.append(f"+{knowledge_id}")
+        self._append_ids(lines)
+
+    def _remove_row(self, knowledge_id):
+        row = self.rows.pop(knowledge_id)
+        self.row_ids[row] = None
+        self.alive[row] = False
+        self.matrix[row] = 0
+
+    def remove(self, knowledge_id):
+        if knowledge_id not in self.rows:
+            return False
+        self._remove_row(knowledge_id)
+        self._append_ids([f"-{knowledge_id}"])
+        if len(self.rows) < len(self.row_ids) // 2:
+            self.compact()
+        return True
+
+    def clear(self):
+        self._reset_files()
+
+    def compact(self):
+        """削除済みの行を取り除いてファイルを詰め直す"""
+        live = [(knowledge_id, row) for row, knowledge_id in enumerate(self.row_ids) if knowledge_id is not None]
+        vectors = np.array(self.matrix[[row for _, row in live]]) if live else np.zeros((0, self.dim), np.float32)
+        self._reset_files()
+        self.add([knowledge_id for knowledge_id, _ in live], vectors)
+
+    def __contains__(self, knowledge_id):
+        return knowledge_id in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    # ---- 検索 ----
+
+    def search(self, query_vector, k=5):
+        """コサイン類似度の高い順に (knowledge_id, 類似度) を返す"""
+        count = len(self.row_ids)
+        if count == 0 or not self.rows:
+            return []
+        query_vector = normalize(query_vector).reshape(-1)
+        best_rows = []
+        best_scores = []
+        for start in range(0, count, self.search_batch_rows):
+            end = min(start + self.search_batch_rows, count)
+            scores = self.matrix[start:end] @ query_vector
+            scores[~self.alive[start:end]] = -np.inf
+            take = min(k, end - start)
+            top = np.argpartition(-scores, take - 1)[:take]
+            best_rows.append(top + start)
+            best_scores.append(scores[top])
+        rows = np.concatenate(best_rows)
+        scores = np.concatenate(best_scores)
+        order = np.argsort(-scores)[:k]
+        return [
+            (self.row_ids[rows[i]], float(scores[i]))
+            for i in order
+            if np.isfinite(scores[i]) and self.row_ids[rows[i]] is not None
+        ]
+
+
+class SharedVectorStore:
+    """複数のワーカープロセスで計算済みの埋め込みベクトルを共有する SQLite のテーブル
+
+    ベクトルを計算する前に claim で知識IDを確保し、確保できたワーカーだけが計算する。
+    確保したまま stale_after 秒以上ベクトルが保存されないもの（計算中に終了した場合など）は
+    他のワーカーが確保し直せる。
+
+    Args:
+        path (str): データベースファイルのパス（全てのワーカーで同じファイルを使う）
+        model (str): 埋め込みの種類と次元数（異なるものは別のベクトルとして扱う）
+        dim (int): ベクトルの次元数
+    """
+
+    def __init__(self, path, model, dim, stale_after=600, timeout=30.0):
+        self.model = model
+        self.dim = dim
+        self.stale_after = stale_after
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                    knowledge_id TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    vector BLOB,
+                    claimed_by TEXT,
+                    claimed_at REAL,
+                    PRIMARY KEY (knowledge_id, model)
+                ) WITHOUT ROWID"""
+            )
+
+    def _batches(self, knowledge_ids, size=500):
+        knowledge_ids = list(knowledge_ids)
+        for i in range(0, len(knowledge_ids), size):
+            yield knowledge_ids[i:i + size]
+
+    def claim(self, knowledge_ids, owner):
+        """まだ誰も計算していない知識IDを owner のものとして確保し、確保できたIDのリストを返す"""
+        claimed = []
+        now = time.time()
+        with self.conn:
+            for batch in self._batches(knowledge_ids):
+                self.conn.executemany(
+                    """INSERT INTO embeddings (knowledge_id, model, claimed_by, claimed_at) VALUES (?, ?, ?, ?)
+                       ON CONFLICT (knowledge_id, model) DO UPDATE SET
+                           claimed_by = excluded.claimed_by, claimed_at = excluded.claimed_at
+                       WHERE vector IS NULL AND claimed_at < ?""",
+                    ((knowledge_id, self.model, owner, now, now - self.stale_after) for knowledge_id in batch),
+                )
+                placeholders = ",".join("?" * len(batch))
+                claimed.extend(row[0] for row in self.conn.execute(
+                    f"""SELECT knowledge_id FROM embeddings WHERE model = ? AND claimed_by = ? AND claimed_at = ?
+                        AND vector IS NULL AND knowledge_id IN ({placeholders})""",
+                    [self.model, owner, now, *batch],
+                ))
+        return claimed
+
+    def release(self, knowledge_ids, owner):
+        """計算できなかった知識IDの確保を取り消す"""
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM embeddings WHERE knowledge_id = ? AND model = ? AND claimed_by = ? AND vector IS NULL",
+                ((knowledge_id, self.model, owner) for knowledge_id in knowledge_ids),
+            )
+
+    def put(self, knowledge_ids, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (knowledge_id, model, vector) VALUES (?, ?, ?)",
+                ((knowledge_id, self.model, vector.tobytes()) for knowledge_id, vector in zip(knowledge_ids, vectors)),
+            )
+
+    def get_many(self, knowledge_ids):
+        """計算済みのベクトルを (知識IDのリスト, 行列) で返す"""
+        found_ids, vectors = [], []
+        for batch in self._batches(knowledge_ids):
+            placeholders = ",".join("?" * len(batch))
+            for knowledge_id, blob in self.conn.execute(
+                f"""SELECT knowledge_id, vector FROM embeddings
+                    WHERE model = ? AND vector IS NOT NULL AND knowledge_id IN ({placeholders})""",
+                [self.model, *batch],
+            ):
+                found_ids.append(knowledge_id)
+                vectors.append(np.frombuffer(blob, dtype=np.float32))
+        if not vectors:
+            return [], np.zeros((0, self.dim), dtype=np.float32)
+        return found_ids, np.stack(vectors)
+
+    def delete(self, knowledge_ids):
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM embeddings WHERE knowledge_id = ?", ((knowledge_id,) for knowledge_id in knowledge_ids)
+            )
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM embeddings")
+
+    def close(self):
+        self.conn.close()
+
+
+def fuse_results(keyword_results, semantic_results, semantic_weight, limit):
+    """キーワード検索と意味検索の結果を重み付きで統合する
+
+    キーワードのスコアは最大値で割って0〜1に揃え、コサイン類似度と
+    (1 - semantic_weight) : semantic_weight の割合で足し合わせる。
+
+    Args:
+        keyword_results (list): (knowledge_id, score) のリスト
+        semantic_results (list): (knowledge_id, 類似度) のリスト
+
+    Returns:
+        list: (knowledge_id, 統合スコア) のリスト（スコアの高い順）
+    """
+    combined = {}
+    max_keyword = max((score for _, score in keyword_results), default=0) or 1.0
+    for knowledge_id, score in keyword_results:
+        combined[knowledge_id] = (1 - semantic_weight) * score / max_keyword
+    for knowledge_id, similarity in semantic_results:
+        if similarity <= 0:
+            continue
+        combined[knowledge_id] = combined.get(knowledge_id, 0.0) + semantic_weight * similarity
+    return sorted(combined.items(), key=lambda item: item[1], reverse=True)[:limit]